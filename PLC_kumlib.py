@@ -1,49 +1,99 @@
+import asyncio
+import itertools
 import logging
+import random
 import snap7
 import time
 import threading
-from typing import List, Dict
-from datetime import datetime
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any, Callable, Deque, List, Dict, Optional
+
+import metrics
+from database import CONNECTION_LOST_EVENT, DISCONNECTED_EVENT, now_ms
 
 logging.basicConfig(level=logging.WARNING)
 
+PLC_READ_SECONDS = metrics.histogram('hydrokum_plc_read_seconds', "PLC status register read latency", ['plc'])
+PLC_COMMAND_SECONDS = metrics.histogram('hydrokum_plc_command_seconds', "write_command round trip, including the pulse reset", ['plc'])
+PLC_COMMAND_LATENCY = metrics.histogram('hydrokum_plc_command_latency_seconds',
+                                        "Queued command issue to PLC acknowledge", ['plc'])
+PLC_ERRORS = metrics.counter('hydrokum_plc_errors_total', "PLC communication errors", ['plc', 'operation'])
+PLC_CONNECTED = metrics.gauge('hydrokum_plc_connected', "1 while the PLC is connected", ['plc'])
+
+# Commands that are pulses: the command word is held for a short time, then reset to 'none'
+PULSE_COMMANDS = ('open', 'close', 'estop')
+
 class MockPLC:
-    def __init__(self):
+    """Stand-in for snap7.logo.Logo, for running and benchmarking without hardware.
+
+    ``latency`` (s) is added to every call with 20% jitter, and each read flips
+    a random status bit with probability ``change_probability``. Setting
+    ``reachable`` to False makes connects and reads fail, to simulate an outage.
+    """
+
+    def __init__(self, latency: float = 0.0, change_probability: float = 0.0, status_bits: int = 8,
+                 reachable: bool = True):
         self.connected = False
         self.status = 0
+        self.latency = latency
+        self.change_probability = change_probability
+        self.status_bits = status_bits
+        self.reachable = reachable
+        self.logger = logging.getLogger(__name__)
+
+    def _delay(self):
+        if self.latency:
+            time.sleep(max(0.0, random.gauss(self.latency, self.latency * 0.2)))
 
     def connect(self, *args, **kwargs):
-        print("MockPLC: Attempting to connect.")
+        self.logger.debug("MockPLC: Attempting to connect.")
+        self._delay()
+        if not self.reachable:
+            raise snap7.Snap7Exception("MockPLC: unreachable")
         self.connected = True
-        print("MockPLC: Successfully connected.")
+        self.logger.debug("MockPLC: Successfully connected.")
         return True
 
     def disconnect(self):
-        print("MockPLC: Disconnecting.")
+        self.logger.debug("MockPLC: Disconnecting.")
         self.connected = False
 
     def write(self, address, command):
-        print(f"MockPLC: Writing command {command} to address {address}")
+        self.logger.debug(f"MockPLC: Writing command {command} to address {address}")
+        self._delay()
         if address == "V0":
             self.status = command
 
     def read(self, address):
-        print(f"MockPLC: Reading status from address {address}")
+        self.logger.debug(f"MockPLC: Reading status from address {address}")
+        self._delay()
+        if not self.reachable:
+            self.connected = False
+            raise snap7.Snap7Exception("MockPLC: unreachable")
+        if self.change_probability and random.random() < self.change_probability:
+            self.status ^= 1 << random.randrange(self.status_bits)
         return self.status
 
     def get_connected(self):
         return self.connected
+
+
 class ConfigPLC:
-    def __init__(self, ip_address: str, commands: Dict[str, int], status_bits = None, status_reg: str = "V1", update_status: bool = True, database=None):
-        """Initialize the ConfigPLC class."""
+    def __init__(self, ip_address: str, commands: Dict[str, int], status_bits = None, status_reg: str = "V1", update_status: bool = True, database=None,
+                 plc=None, command_reg: str = "V0"):
+        """Initialize the ConfigPLC class. ``plc`` replaces the snap7 client, e.g. with a MockPLC."""
         self.logger = logging.getLogger(__name__)
-        self.plc = snap7.logo.Logo()
+        self.plc = plc if plc is not None else snap7.logo.Logo()
         self.ip_address = ip_address
         self.connected = False
         self.commands = commands
         self.status_bits = status_bits
+        self.command_reg = command_reg
         self.database = database
         self.prev_status = None
+        # snap7 clients are not thread safe; status polls and commands share this
+        self.lock = threading.Lock()
 
         self.status_data = {
             'address': status_reg,
@@ -64,62 +114,92 @@ class ConfigPLC:
         if self.connected:
             if self.database:
                 self.database.insert_plc_history(
-                [datetime.datetime.now().isoformat(), self.ip_address, "Connected"])  # Add this line
+                [now_ms(), self.ip_address, "Connected"])  # Add this line
             self.logger.info("Connected")
             if self.status_thread:
                 self.status_thread.start()
 
     def disconnect(self):
         """Disconnect from the PLC."""
+        self.connected = False
         if self.status_thread and self.status_thread.is_alive():
             self.status_thread.join()
-        self.plc.disconnect()
+        with self.lock:
+            self.plc.disconnect()
         if self.database:
             self.database.insert_plc_history(
-                [datetime.datetime.now().isoformat(), self.ip_address, "Disconnected"])  # Add this line
+                [now_ms(), self.ip_address, DISCONNECTED_EVENT])  # Add this line
+        # Report the first status read after reconnecting as a change
+        self.prev_status = None
         self.logger.info("Disconnected")
 
     def write_command(self, address: str, command: int, delay: float = 0.1):
-        """Write command to the PLC."""
+        """Write command to the PLC, blocking for the pulse. CommandDispatcher does this without blocking."""
         if self.connected:
-            self.plc.write(address, command)
-            self.logger.info(f"Wrote command 0b{command:08b} to {address}")
-            if self.database:
-                self.database.insert_plc_history([datetime.datetime.now().isoformat(), self.ip_address,
-                                              f"Command: {command} written to {address}"])  # Add this line
-            if command in [self.commands.get(key) for key in ['open', 'close', 'estop']]:
-                time.sleep(delay)
-                self.plc.write(address, self.commands.get('none', 0))
-                self.logger.info(f"Wrote command 0b{self.commands.get('none', 0):08b} to {address}")
+            with PLC_COMMAND_SECONDS.time(plc=self.ip_address):
+                self.write_word(address, command)
+                if self.is_pulse(command):
+                    time.sleep(delay)
+                    self.write_word(address, self.commands.get('none', 0), log=False)
+
+    def write_word(self, address: str, command: int, log: bool = True):
+        """Write one command word; returns once the PLC has acknowledged it."""
+        try:
+            with self.lock:
+                self.plc.write(address, command)
+        except snap7.Snap7Exception:
+            PLC_ERRORS.inc(plc=self.ip_address, operation='write')
+            raise
+        self.logger.info(f"Wrote command 0b{command:08b} to {address}")
+        if log and self.database:
+            self.database.insert_plc_history([now_ms(), self.ip_address,
+                                          f"Command: {command} written to {address}"])  # Add this line
+
+    def is_pulse(self, command: int) -> bool:
+        return command in [self.commands.get(key) for key in PULSE_COMMANDS]
+
+    def poll_status(self) -> bool:
+        """Read the status register once and log it if it changed. Returns True on change."""
+        started = time.perf_counter()
+        try:
+            with self.lock:
+                new_status = self.plc.read(self.status_data['address'])
+        except snap7.Snap7Exception as e:  # Replace with the actual exception types
+            PLC_ERRORS.inc(plc=self.ip_address, operation='read')
+            self.logger.error(f"Error updating status: {e}")
+            self.connected = False
+            return False
+        PLC_READ_SECONDS.observe(time.perf_counter() - started, plc=self.ip_address)
+        if new_status == self.prev_status:  # Check if the status has changed
+            return False
+        self.status_data['status'] = new_status
+        self.prev_status = new_status
+        self.logger.info(f"Status changed to 0b{new_status:08b}")
+        if self.database:
+            try:
+                self.database.insert_status_change([now_ms(), self.ip_address, new_status])  # Log the change
+            except Exception as e:
+                self.logger.error(f"Failed to log status change to database: {e}")
+        return True
 
     def _update_status(self):
         """Update status of the PLC."""
         while self.connected:
-            try:
-                new_status = self.plc.read(self.status_data['address'])
-                if new_status != self.prev_status:  # Check if the status has changed
-                    self.status_data['status'] = new_status
-                    self.prev_status = new_status
-                    self.logger.info(f"Status changed to 0b{new_status:08b}")
-                    if self.database:
-                        try:
-                            self.database.insert_status_change([datetime.now().isoformat(), self.ip_address, new_status])  # Log the change
-                        except Exception as e:
-                            self.logger.error(f"Failed to log status change to database: {e}")
-                time.sleep(1.0)
-            except snap7.Snap7Exception as e:  # Replace with the actual exception types
-                self.logger.error(f"Error updating status: {e}")
-                self.connected = False
+            self.poll_status()
+            time.sleep(1.0)
 
     def get_status(self) -> int:
         """Get the current status of the PLC."""
         return self.status_data['status']
 
 
-def init_plcs(ip_addresses: List[str], plc_type: str, commands: Dict[str, int],status_bits= None, status_reg="V1",db=None) -> Dict[str, ConfigPLC]:
+def init_plcs(ip_addresses: List[str], plc_type: str, commands: Dict[str, int],status_bits= None, status_reg="V1",db=None,
+              update_status: bool = True, plc_factory: Optional[Callable[[], object]] = None) -> Dict[str, ConfigPLC]:
     plcs = {}
     for i, ip in enumerate(ip_addresses):
-        plcs[f"{plc_type}{i + 1}"] = ConfigPLC(ip, commands, status_bits , status_reg,db)
+        plcs[f"{plc_type}{i + 1}"] = ConfigPLC(ip, commands, status_bits, status_reg,
+                                               update_status=update_status, database=db,
+                                               plc=plc_factory() if plc_factory else None)
 
     return plcs
 
@@ -137,8 +217,413 @@ def connect_plcs(plcs):
     return plcs
 
 
-def generate_status_indicators(plc: ConfigPLC):
+
+class ConnectionManager:
+    """Connects all PLCs in parallel and reconnects the ones that drop.
+
+    start() returns at once (or after at most ``wait`` seconds) with every
+    device in the 'connecting' state, so one unreachable PLC no longer holds
+    up the others or the dashboard. A supervisor thread notices devices that
+    lost their connection, e.g. after a failed status read, and retries them
+    with jittered exponential backoff. State changes go to subscribers as
+    (plc_id, state) with state 'connecting', 'connected' or 'disconnected'.
+    """
+
+    def __init__(self, plcs: Dict[str, ConfigPLC], max_workers: int = 8, check_interval: float = 1.0,
+                 backoff_initial: float = 1.0, backoff_max: float = 60.0):
+        self.logger = logging.getLogger(__name__)
+        self.plcs = plcs
+        self.check_interval = check_interval
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="plc-connect")
+        self.states = {plc_id: 'disconnected' for plc_id in plcs}
+        self.failures = {plc_id: 0 for plc_id in plcs}
+        self.next_attempt = {plc_id: 0.0 for plc_id in plcs}
+        self.connects = {plc_id: 0 for plc_id in plcs}
+        self.subscribers: List[Callable[[str, str], None]] = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        for plc_id, plc in plcs.items():
+            PLC_CONNECTED.set_function(lambda plc=plc: int(plc.connected), plc=plc.ip_address)
+
+    def subscribe(self, callback: Callable[[str, str], None]):
+        self.subscribers.append(callback)
+
+    def start(self, wait: float = 0.0):
+        """Start connecting every PLC; optionally wait up to ``wait`` seconds for the first attempts."""
+        futures = [self._connect(plc_id) for plc_id in self.plcs]
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="plc-connections", daemon=True)
+            self._thread.start()
+        if wait:
+            deadline = time.monotonic() + wait
+            for future in futures:
+                if future is not None:
+                    try:
+                        future.result(max(0.0, deadline - time.monotonic()))
+                    except Exception:
+                        pass
+
+    def stop(self):
+        self._stop.set()
+        self.executor.shutdown(wait=False)
+
+    def _set_state(self, plc_id: str, state: str):
+        with self._lock:
+            if self.states[plc_id] == state:
+                return
+            self.states[plc_id] = state
+        for callback in self.subscribers:
+            try:
+                callback(plc_id, state)
+            except Exception as e:
+                self.logger.error(f"Connection subscriber failed: {e}")
+
+    def _connect(self, plc_id: str):
+        with self._lock:
+            if self.states[plc_id] == 'connecting':
+                return None
+        self._set_state(plc_id, 'connecting')
+        return self.executor.submit(self._attempt, plc_id)
+
+    def _attempt(self, plc_id: str):
+        plc = self.plcs[plc_id]
+        try:
+            plc.connect()
+        except Exception as e:
+            self.logger.error(f"{plc_id}: connection failed: {e}")
+        if plc.connected:
+            self.connects[plc_id] += 1
+            self.failures[plc_id] = 0
+            self._set_state(plc_id, 'connected')
+            return
+        PLC_ERRORS.inc(plc=plc.ip_address, operation='connect')
+        delay = min(self.backoff_max, self.backoff_initial * 2 ** self.failures[plc_id])
+        delay *= random.uniform(0.5, 1.0)
+        self.failures[plc_id] += 1
+        self.next_attempt[plc_id] = time.monotonic() + delay
+        self.logger.warning(f"{plc_id}: unreachable, retrying in {delay:.1f} s")
+        self._set_state(plc_id, 'disconnected')
+
+    def _run(self):
+        while not self._stop.wait(self.check_interval):
+            now = time.monotonic()
+            for plc_id, plc in self.plcs.items():
+                state = self.states[plc_id]
+                if state == 'connected' and not plc.connected:
+                    self.logger.warning(f"{plc_id}: connection lost, reconnecting")
+                    if plc.database:
+                        plc.database.insert_plc_history([now_ms(), plc.ip_address, CONNECTION_LOST_EVENT])
+                    # Report the first status read after reconnecting as a change
+                    plc.prev_status = None
+                    self.next_attempt[plc_id] = now
+                    self._set_state(plc_id, 'disconnected')
+                    state = 'disconnected'
+                if state == 'disconnected' and now >= self.next_attempt[plc_id]:
+                    self._connect(plc_id)
+
+
+StatusEvent = namedtuple('StatusEvent', ['plc_id', 'ip_address', 'time', 'previous', 'status'])
+
+
+class PLCPoller:
+    """Polls the status register of every PLC from one asyncio loop.
+
+    Each device gets its own period (``intervals`` overrides ``interval`` per
+    plc id). The blocking snap7 reads run on a small shared thread pool, so the
+    number of threads stays fixed as devices are added. Status changes are
+    published to subscribers as StatusEvent tuples, from the poller thread.
+    """
+
+    def __init__(self, plcs: Dict[str, ConfigPLC], interval: float = 1.0, intervals: Optional[Dict[str, float]] = None,
+                 max_workers: int = 4, jitter_warning: float = 0.2):
+        self.logger = logging.getLogger(__name__)
+        self.plcs = plcs
+        self.interval = interval
+        self.intervals = intervals or {}
+        self.jitter_warning = jitter_warning
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="plc-poll")
+        self.subscribers: List[Callable[[StatusEvent], None]] = []
+        self.stats = {plc_id: {'polls': 0, 'changes': 0, 'overruns': 0, 'last_read_ms': 0.0,
+                               'max_read_ms': 0.0, 'max_jitter_ms': 0.0} for plc_id in plcs}
+        self._thread: Optional[threading.Thread] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stop: Optional[asyncio.Event] = None
+
+    def subscribe(self, callback: Callable[[StatusEvent], None]):
+        """Register a callback for status changes of any PLC."""
+        self.subscribers.append(callback)
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=lambda: asyncio.run(self._main()), name="plc-poller", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        if self._loop is not None and self._stop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.executor.shutdown(wait=False)
+
+    async def _main(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        await asyncio.gather(*(self._poll_device(plc_id, plc) for plc_id, plc in self.plcs.items()))
+
+    async def _poll_device(self, plc_id: str, plc: ConfigPLC):
+        loop = asyncio.get_running_loop()
+        period = self.intervals.get(plc_id, self.interval)
+        stats = self.stats[plc_id]
+        deadline = loop.time()
+        while not self._stop.is_set():
+            jitter = loop.time() - deadline
+            stats['max_jitter_ms'] = max(stats['max_jitter_ms'], jitter * 1000)
+            if jitter > self.jitter_warning:
+                self.logger.warning(f"{plc_id}: poll started {jitter * 1000:.0f} ms late")
+
+            if plc.connected:
+                previous = plc.prev_status
+                started = loop.time()
+                try:
+                    changed = await loop.run_in_executor(self.executor, plc.poll_status)
+                except Exception as e:
+                    self.logger.error(f"{plc_id}: poll failed: {e}")
+                    changed = False
+                read_time = loop.time() - started
+                stats['polls'] += 1
+                stats['last_read_ms'] = read_time * 1000
+                stats['max_read_ms'] = max(stats['max_read_ms'], read_time * 1000)
+                if changed:
+                    stats['changes'] += 1
+                    self._publish(StatusEvent(plc_id, plc.ip_address, time.time(), previous, plc.get_status()))
+
+            deadline += period
+            now = loop.time()
+            if now > deadline:
+                # Overran the period: skip the missed ticks instead of bursting to catch up
+                stats['overruns'] += 1
+                self.logger.warning(f"{plc_id}: poll overran its {period * 1000:.0f} ms period")
+                deadline = now
+            try:
+                await asyncio.wait_for(self._stop.wait(), deadline - now)
+            except asyncio.TimeoutError:
+                pass
+
+    def _publish(self, event: StatusEvent):
+        for callback in self.subscribers:
+            try:
+                callback(event)
+            except Exception as e:
+                self.logger.error(f"Status subscriber failed: {e}")
+
+
+
+_handle_ids = itertools.count(1)
+
+
+class CommandHandle:
+    """One submitted command. Returned at once by CommandDispatcher.submit and updated as it runs.
+
+    ``state`` goes queued -> running -> done or failed, or to cancelled when an
+    estop clears the queue. ``latency`` is the time from submit to the PLC
+    acknowledging the write, queueing included.
+    """
+
+    def __init__(self, plc_id: str, name: str, word: int):
+        self.id = next(_handle_ids)
+        self.plc_id = plc_id
+        self.name = name
+        self.word = word
+        self.state = 'queued'
+        self.error: Optional[str] = None
+        self.coalesced = 0  # identical submits merged into this one while it was queued
+        self.queued_at = time.monotonic()
+        self.acked_at: Optional[float] = None
+        self._done = threading.Event()
+
+    @property
+    def latency(self) -> Optional[float]:
+        return None if self.acked_at is None else self.acked_at - self.queued_at
+
+    @property
+    def finished(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Block until the command has finished; True unless the timeout ran out."""
+        return self._done.wait(timeout)
+
+    def _finish(self, state: str, error: Optional[str] = None):
+        self.state, self.error = state, error
+        self._done.set()
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {'id': self.id, 'plc_id': self.plc_id, 'name': self.name, 'state': self.state, 'error': self.error,
+                'coalesced': self.coalesced, 'latency_ms': None if self.latency is None else self.latency * 1000}
+
+
+class CommandDispatcher:
+    """Runs PLC commands off the request threads, in order per device.
+
+    Each PLC has its own queue, served by one coroutine on a private asyncio
+    loop; the blocking snap7 writes go to a small thread pool and pulse
+    widths are awaited, so no thread is held while a pulse is on. Submitting
+    a command that is already queued for the same PLC returns the queued
+    handle, and an estop cancels everything queued for its PLC and cuts a
+    running pulse short. Finished handles are passed to subscribers.
+    """
+
+    def __init__(self, plcs: Dict[str, ConfigPLC], pulse: float = 0.1, executor: Optional[Executor] = None,
+                 max_workers: int = 2, history: int = 1000):
+        self.logger = logging.getLogger(__name__)
+        self.plcs = plcs
+        self.pulse = pulse
+        self.executor = executor or ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="plc-command")
+        self.history = history
+        self.queues: Dict[str, Deque[CommandHandle]] = {plc_id: deque() for plc_id in plcs}
+        self.handles: "OrderedDict[int, CommandHandle]" = OrderedDict()
+        self.subscribers: List[Callable[[CommandHandle], None]] = []
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._ready = threading.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stop: Optional[asyncio.Event] = None
+        self._wakeups: Dict[str, asyncio.Event] = {}
+        self._preempts: Dict[str, asyncio.Event] = {}
+        self._running: Dict[str, Optional[CommandHandle]] = {}
+
+    def subscribe(self, callback: Callable[[CommandHandle], None]):
+        """Register a callback for finished (done, failed or cancelled) commands."""
+        self.subscribers.append(callback)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._ready.clear()
+                self._thread = threading.Thread(target=lambda: asyncio.run(self._main()), name="plc-commands",
+                                                daemon=True)
+                self._thread.start()
+        self._ready.wait()
+
+    def stop(self, timeout: float = 5.0):
+        if self._loop is not None and self._stop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.executor.shutdown(wait=False)
+
+    def submit(self, plc_id: str, name: str) -> CommandHandle:
+        """Queue command ``name`` for ``plc_id`` and return its handle without waiting for the PLC."""
+        word = self.plcs[plc_id].commands[name]
+        self.start()
+        cancelled = []
+        with self._lock:
+            pending = self.queues[plc_id]
+            if name == 'estop':
+                cancelled = [handle for handle in pending if handle.word != word]
+                for handle in cancelled:
+                    pending.remove(handle)
+            handle = next((queued for queued in pending if queued.word == word), None)
+            if handle is not None:
+                handle.coalesced += 1
+            else:
+                handle = CommandHandle(plc_id, name, word)
+                pending.append(handle)
+                self.handles[handle.id] = handle
+                while len(self.handles) > self.history:
+                    self.handles.popitem(last=False)
+        for other in cancelled:
+            other._finish('cancelled', "preempted by estop")
+            self._publish(other)
+        if name == 'estop':
+            self._loop.call_soon_threadsafe(self._preempt, plc_id)
+        self._loop.call_soon_threadsafe(self._wakeups[plc_id].set)
+        return handle
+
+    def get(self, handle_id: int) -> Optional[CommandHandle]:
+        return self.handles.get(handle_id)
+
+    def stats(self) -> Dict[str, int]:
+        """Commands waiting per PLC."""
+        with self._lock:
+            return {plc_id: len(pending) for plc_id, pending in self.queues.items()}
+
+    async def _main(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        self._wakeups = {plc_id: asyncio.Event() for plc_id in self.plcs}
+        self._preempts = {plc_id: asyncio.Event() for plc_id in self.plcs}
+        self._running = {plc_id: None for plc_id in self.plcs}
+        self._ready.set()
+        workers = [asyncio.ensure_future(self._worker(plc_id)) for plc_id in self.plcs]
+        await self._stop.wait()
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    async def _worker(self, plc_id: str):
+        wakeup = self._wakeups[plc_id]
+        while True:
+            with self._lock:
+                handle = self.queues[plc_id].popleft() if self.queues[plc_id] else None
+                if handle is not None:
+                    handle.state = 'running'
+            if handle is None:
+                await wakeup.wait()
+                wakeup.clear()
+                continue
+            self._running[plc_id] = handle
+            self._preempts[plc_id].clear()
+            try:
+                await self._execute(self.plcs[plc_id], handle)
+            finally:
+                self._running[plc_id] = None
+            self._publish(handle)
+
+    def _preempt(self, plc_id: str):
+        # Runs on the loop thread, like _worker, so the running command cannot change underneath; an estop that
+        # is already running is never cut short by its own submit
+        running = self._running[plc_id]
+        if running is not None and running.name != 'estop':
+            self._preempts[plc_id].set()
+
+    async def _execute(self, plc: ConfigPLC, handle: CommandHandle):
+        loop = asyncio.get_running_loop()
+        if not plc.connected:
+            handle._finish('failed', "PLC not connected")
+            return
+        try:
+            await loop.run_in_executor(self.executor, plc.write_word, plc.command_reg, handle.word)
+            handle.acked_at = time.monotonic()
+            PLC_COMMAND_LATENCY.observe(handle.latency, plc=plc.ip_address)
+            if plc.is_pulse(handle.word):
+                try:
+                    # An estop for this PLC ends the pulse early and is written instead of the reset
+                    await asyncio.wait_for(self._preempts[handle.plc_id].wait(), self.pulse)
+                except asyncio.TimeoutError:
+                    await loop.run_in_executor(self.executor, plc.write_word, plc.command_reg,
+                                               plc.commands.get('none', 0), False)
+            handle._finish('done')
+        except Exception as e:
+            self.logger.error(f"{handle.plc_id}: command {handle.name} failed: {e}")
+            handle._finish('failed', str(e))
+
+    def _publish(self, handle: CommandHandle):
+        for callback in self.subscribers:
+            try:
+                callback(handle)
+            except Exception as e:
+                self.logger.error(f"Command subscriber failed: {e}")
+
+
+def generate_status_indicators(plc: ConfigPLC, state: Optional[str] = None):
+    """Text and colour per status bit; ``state`` is the ConnectionManager state, if one is used."""
     status_indicators = []
+    if state == 'connecting' and not plc.connected:
+        return [{'text': "Connecting...", 'color': 'orange'}]
     if plc.connected:
         status_data = plc.status_data
         binary_representation = format(status_data['status'], '08b')[::-1]
@@ -151,4 +636,3 @@ def generate_status_indicators(plc: ConfigPLC):
         return status_indicators
     else:
         return [{'text': "PLC not connected", 'color': 'red'}]
-
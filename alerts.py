@@ -0,0 +1,244 @@
+import json
+import logging
+import math
+import os
+import tempfile
+import time
+from collections import deque, namedtuple
+from typing import Any, Deque, Dict, List, Optional, Sequence, Tuple
+
+import metrics
+from database import GAS_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+ALERTS_RAISED = metrics.counter('hydrokum_alerts_raised_total', "Alerts raised", ['rule'])
+ALERTS_ACTIVE = metrics.gauge('hydrokum_alerts_active', "Alerts currently raised")
+GAS_ROLLING = metrics.gauge('hydrokum_gas_rolling', "Rolling gas statistics", ['gas', 'window', 'stat'])
+
+DEFAULT_STATS_FILE = os.path.join(tempfile.gettempdir(), 'hydrokum_stats.json')
+DEFAULT_WINDOWS = {'5m': 5 * 60, '1h': 60 * 60, '24h': 24 * 60 * 60}  # seconds
+
+Rule = namedtuple('Rule', ['name', 'gas', 'above', 'below', 'drift', 'window', 'min_samples', 'hold'])
+
+
+class RollingWindow:
+    """Mean, variance, min and max of the samples in the last ``width`` ms.
+
+    Every sample enters and leaves once: the mean and variance are updated
+    incrementally (Welford, with removal) and min/max come from monotonic
+    deques, so each update is O(1) amortized however wide the window.
+    """
+
+    def __init__(self, width: int):
+        self.width = width
+        self.samples: Deque[Tuple[int, float]] = deque()
+        self._min: Deque[Tuple[int, float]] = deque()
+        self._max: Deque[Tuple[int, float]] = deque()
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    @property
+    def count(self) -> int:
+        return len(self.samples)
+
+    @property
+    def variance(self) -> float:
+        return max(self._m2 / (self.count - 1), 0.0) if self.count > 1 else 0.0
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self.variance)
+
+    @property
+    def min(self) -> Optional[float]:
+        return self._min[0][1] if self._min else None
+
+    @property
+    def max(self) -> Optional[float]:
+        return self._max[0][1] if self._max else None
+
+    def add(self, sample_time: int, value: float):
+        self.samples.append((sample_time, value))
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((sample_time, value))
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((sample_time, value))
+        self.expire(sample_time)
+
+    def expire(self, now: int):
+        cutoff = now - self.width
+        while self.samples and self.samples[0][0] <= cutoff:
+            _, value = self.samples.popleft()
+            if self.samples:
+                delta = value - self.mean
+                self.mean -= delta / self.count
+                self._m2 -= delta * (value - self.mean)
+            else:
+                self.mean, self._m2 = 0.0, 0.0
+        while self._min and self._min[0][0] <= cutoff:
+            self._min.popleft()
+        while self._max and self._max[0][0] <= cutoff:
+            self._max.popleft()
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {'count': self.count, 'mean': self.mean if self.count else None,
+                'std': self.std if self.count else None, 'min': self.min, 'max': self.max}
+
+
+def load_rules(path: str) -> Tuple[Dict[str, int], List[Rule]]:
+    """Read the windows (name -> seconds) and alert rules from a JSON file like alerts.json."""
+    with open(path) as f:
+        config = json.load(f)
+    windows = {name: int(seconds) for name, seconds in config.get('windows', DEFAULT_WINDOWS).items()}
+    rules = []
+    for entry in config.get('rules', []):
+        try:
+            name, gas = entry['name'], entry['gas']
+        except KeyError as e:
+            raise ValueError(f"{path}: rule {entry} is missing {e}") from e
+        if gas not in GAS_COLUMNS:
+            raise ValueError(f"{path}: rule {name!r} has unknown gas {gas!r}, expected one of {GAS_COLUMNS}")
+        if not any(key in entry for key in ('above', 'below', 'drift')):
+            raise ValueError(f"{path}: rule {name!r} needs 'above', 'below' or 'drift'")
+        window = entry.get('window', next(iter(windows)))
+        if window not in windows:
+            raise ValueError(f"{path}: rule {name!r} uses unknown window {window!r}")
+        rules.append(Rule(name, gas, entry.get('above'), entry.get('below'), entry.get('drift'), window,
+                          int(entry.get('min_samples', 30)), int(entry.get('hold', 1))))
+    return windows, rules
+
+
+class StatsFile:
+    """Hands the ingest's rolling statistics to the dashboard processes through a small JSON file."""
+
+    def __init__(self, path: str = DEFAULT_STATS_FILE):
+        self.path = path
+        self._mtime: Optional[float] = None
+        self._cached: Optional[Dict[str, Any]] = None
+
+    def write(self, stats: Dict[str, Any]):
+        # Readers never see a half-written file
+        partial = f"{self.path}.{os.getpid()}.tmp"
+        with open(partial, 'w') as f:
+            json.dump(stats, f)
+        os.replace(partial, self.path)
+
+    def read(self) -> Optional[Dict[str, Any]]:
+        """The latest statistics, parsed again only when the file has changed."""
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return None
+        if mtime != self._mtime:
+            try:
+                with open(self.path) as f:
+                    self._cached = json.load(f)
+                self._mtime = mtime
+            except (OSError, ValueError) as e:
+                logger.debug(f"Could not read {self.path}: {e}")
+        return self._cached
+
+
+class AlertEngine:
+    """Rolling statistics and alert rules evaluated on every sample of the ingest loop.
+
+    Works only from the samples it is given, so it adds no database reads: the
+    windows fill up after a restart. Rule transitions are written to the
+    alerts table through the database writer, and the statistics are published
+    to ``stats_file`` at most every ``publish_interval`` seconds.
+    """
+
+    def __init__(self, db, rules: Sequence[Rule], windows: Optional[Dict[str, int]] = None,
+                 stats_file: Optional[StatsFile] = None, publish_interval: float = 1.0):
+        self.db = db
+        self.rules = list(rules)
+        self.windows = {name: {gas: RollingWindow(seconds * 1000) for gas in GAS_COLUMNS}
+                        for name, seconds in (windows or DEFAULT_WINDOWS).items()}
+        self.stats_file = stats_file
+        self.publish_interval = publish_interval
+        self.latest: Dict[str, Optional[float]] = {gas: None for gas in GAS_COLUMNS}
+        self.latest_time: Optional[int] = None
+        self.active: Dict[str, Dict[str, Any]] = {}
+        self._streak: Dict[str, int] = {rule.name: 0 for rule in self.rules}
+        self._published = 0.0
+        ALERTS_ACTIVE.set_function(lambda: len(self.active))
+        for name, gases in self.windows.items():
+            for gas, window in gases.items():
+                for stat in ('mean', 'std', 'min', 'max'):
+                    GAS_ROLLING.set_function(lambda window=window, stat=stat: window.as_dict()[stat] or 0.0,
+                                             gas=gas, window=name, stat=stat)
+
+    def _triggered(self, rule: Rule, value: float) -> Tuple[bool, Optional[float]]:
+        """Whether ``value`` breaks the rule, and the limit it was compared with."""
+        if rule.above is not None and value > rule.above:
+            return True, rule.above
+        if rule.below is not None and value < rule.below:
+            return True, rule.below
+        if rule.drift is not None:
+            # Compared with the baseline before this sample is added to it
+            window = self.windows[rule.window][rule.gas]
+            if window.count >= rule.min_samples and window.std > 0:
+                limit = window.mean + math.copysign(rule.drift * window.std, value - window.mean)
+                return abs(value - window.mean) > rule.drift * window.std, limit
+        return False, rule.above if rule.above is not None else rule.below
+
+    def update(self, sample_time: int, values: Sequence[Optional[float]]):
+        """Evaluate the rules against one (N2O, CO2, CH4, NH3) sample, then fold it into the windows."""
+        sample = dict(zip(GAS_COLUMNS, values))
+        for rule in self.rules:
+            value = sample.get(rule.gas)
+            if value is None or math.isnan(value):
+                continue
+            triggered, limit = self._triggered(rule, value)
+            raised = rule.name in self.active
+            # `hold` consecutive samples are needed to raise and to clear, so noise does not flap
+            self._streak[rule.name] = self._streak[rule.name] + 1 if triggered != raised else 0
+            if self._streak[rule.name] >= rule.hold:
+                self._streak[rule.name] = 0
+                self._transition(rule, sample_time, value, limit, 'raised' if triggered else 'cleared')
+
+        for gas, value in sample.items():
+            if value is None or math.isnan(value):
+                continue
+            self.latest[gas] = value
+            for gases in self.windows.values():
+                gases[gas].add(sample_time, value)
+        self.latest_time = sample_time
+        if self.stats_file is not None and time.monotonic() - self._published >= self.publish_interval:
+            self.publish()
+
+    def _transition(self, rule: Rule, sample_time: int, value: float, limit: Optional[float], state: str):
+        if state == 'raised':
+            self.active[rule.name] = {'rule': rule.name, 'gas': rule.gas, 'since': sample_time, 'value': value,
+                                      'limit': limit}
+            ALERTS_RAISED.inc(rule=rule.name)
+            logger.warning(f"Alert {rule.name}: {rule.gas} = {value} (limit {limit})")
+        else:
+            raised = self.active.pop(rule.name, None)
+            if limit is None and raised is not None:
+                # A drift baseline that has run short of samples: keep the threshold the alert was raised at
+                limit = raised['limit']
+            logger.info(f"Alert {rule.name} cleared: {rule.gas} = {value}")
+        self.db.insert_alert([sample_time, rule.name, rule.gas, state, value, limit])
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'time': self.latest_time,
+            'latest': self.latest,
+            'windows': {name: {gas: window.as_dict() for gas, window in gases.items()}
+                        for name, gases in self.windows.items()},
+            'active': list(self.active.values()),
+        }
+
+    def publish(self):
+        self._published = time.monotonic()
+        try:
+            self.stats_file.write(self.stats())
+        except OSError as e:
+            logger.error(f"Could not publish statistics to {self.stats_file.path}: {e}")
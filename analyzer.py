@@ -0,0 +1,181 @@
+import logging
+import random
+import select
+import socket
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, List, Optional
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+ANALYZER_REPLY_SECONDS = metrics.histogram('hydrokum_analyzer_reply_seconds', "Time from request to analyzer reply")
+ANALYZER_SAMPLES = metrics.counter('hydrokum_analyzer_samples_total', "Analyzer samples stored")
+ANALYZER_ERRORS = metrics.counter('hydrokum_analyzer_errors_total', "Analyzer errors", ['kind'])
+
+REQUEST = b"_Meas_GetConc\r"
+# Field positions of N2O, CO2, CH4 and NH3 in the ';' separated reply
+CONC_FIELDS = (2, 7, 9, 12)
+
+
+def parse_concentrations(reply: str) -> List[float]:
+    """Extract the four gas concentrations from one reply line."""
+    values = reply.strip().split(';')
+    try:
+        return [float(values[i]) for i in CONC_FIELDS]
+    except (IndexError, ValueError) as e:
+        raise ValueError(f"Malformed analyzer reply {reply!r}") from e
+
+
+class LineFramer:
+    """Splits a byte stream into reply lines terminated by CR and/or LF."""
+
+    def __init__(self, max_line: int = 64 * 1024):
+        self.buffer = b""
+        self.max_line = max_line
+
+    def feed(self, data: bytes) -> List[str]:
+        self.buffer += data
+        lines = self.buffer.replace(b"\r\n", b"\n").replace(b"\r", b"\n").split(b"\n")
+        # The last element is an incomplete line (or b"" if data ended on a terminator)
+        self.buffer = lines.pop()
+        if len(self.buffer) > self.max_line:
+            raise ValueError(f"No line terminator in {len(self.buffer)} bytes")
+        return [line.decode('utf-8', errors='replace') for line in lines if line.strip()]
+
+    def reset(self):
+        self.buffer = b""
+
+
+class AnalyzerClient:
+    """Keeps one TCP connection to the gas analyzer and samples it on a fixed schedule.
+
+    Requests are sent on an absolute tick schedule, so the sample period does
+    not drift with reply time. Up to ``pipeline_depth`` requests may be in
+    flight; replies are matched to requests in order. Connection errors close
+    the socket and reconnect with exponential backoff.
+    """
+
+    def __init__(self, host: str, port: int, connect_timeout: float = 5.0, reply_timeout: float = 5.0,
+                 backoff_initial: float = 0.5, backoff_max: float = 30.0):
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.reply_timeout = reply_timeout
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.sock: Optional[socket.socket] = None
+        self.framer = LineFramer()
+        self._stop = threading.Event()
+
+        self.samples = 0
+        self.missed_ticks = 0
+        self.parse_errors = 0
+        self.reconnects = 0
+
+    def connect(self) -> bool:
+        """Connect, retrying with exponential backoff until connected or stopped."""
+        attempt = 0
+        while not self._stop.is_set():
+            try:
+                self.sock = socket.create_connection((self.host, self.port), timeout=self.connect_timeout)
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.framer.reset()
+                logger.info(f"Connected to analyzer at {self.host}:{self.port}")
+                return True
+            except OSError as e:
+                delay = min(self.backoff_max, self.backoff_initial * 2 ** attempt)
+                delay *= random.uniform(0.8, 1.2)
+                logger.warning(f"Analyzer connection failed ({e}), retrying in {delay:.1f} s")
+                attempt += 1
+                self._stop.wait(delay)
+        return False
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def stop(self):
+        self._stop.set()
+
+    def request(self) -> List[float]:
+        """Send one request and wait for its reply."""
+        if self.sock is None and not self.connect():
+            raise ConnectionError("Stopped before connecting")
+        self.sock.sendall(REQUEST)
+        deadline = time.monotonic() + self.reply_timeout
+        while True:
+            lines = self._receive(max(0.0, deadline - time.monotonic()))
+            if lines:
+                return parse_concentrations(lines[0])
+            if time.monotonic() >= deadline:
+                raise TimeoutError("No reply from analyzer")
+
+    def poll(self, on_sample: Callable[[int, List[float]], None], period: float = 5.0, pipeline_depth: int = 1):
+        """Sample every ``period`` seconds until stop(), calling on_sample(epoch_ms, values)."""
+        pending: Deque[tuple] = deque()  # (epoch ms, monotonic send time) of requests awaiting a reply
+        next_tick = time.monotonic()
+        while not self._stop.is_set():
+            if self.sock is None:
+                if not self.connect():
+                    break
+                pending.clear()
+                next_tick = time.monotonic()
+            try:
+                now = time.monotonic()
+                if now >= next_tick:
+                    if len(pending) < pipeline_depth:
+                        pending.append((int(time.time() * 1000), now))
+                        self.sock.sendall(REQUEST)
+                    else:
+                        self.missed_ticks += 1
+                        ANALYZER_ERRORS.inc(kind='missed_tick')
+                    next_tick += period
+                    if next_tick <= now:
+                        # Fell more than a period behind: skip ticks rather than burst
+                        skipped = int((now - next_tick) // period) + 1
+                        self.missed_ticks += skipped
+                        ANALYZER_ERRORS.inc(skipped, kind='missed_tick')
+                        next_tick += skipped * period
+
+                for line in self._receive(max(0.0, next_tick - time.monotonic())):
+                    if not pending:
+                        logger.warning(f"Unsolicited analyzer reply: {line!r}")
+                        continue
+                    sample_time, sent = pending.popleft()
+                    ANALYZER_REPLY_SECONDS.observe(time.monotonic() - sent)
+                    try:
+                        values = parse_concentrations(line)
+                    except ValueError as e:
+                        self.parse_errors += 1
+                        ANALYZER_ERRORS.inc(kind='parse')
+                        logger.warning(str(e))
+                        continue
+                    self.samples += 1
+                    ANALYZER_SAMPLES.inc()
+                    on_sample(sample_time, values)
+
+                if pending and time.monotonic() - pending[0][1] > self.reply_timeout:
+                    raise TimeoutError(f"No reply within {self.reply_timeout} s")
+            except (OSError, ValueError) as e:
+                # TimeoutError and ConnectionError are OSErrors; ValueError is a framing error
+                logger.error(f"Analyzer connection lost: {e}")
+                self.close()
+                self.reconnects += 1
+                ANALYZER_ERRORS.inc(kind='reconnect')
+        self.close()
+
+    def _receive(self, timeout: float) -> List[str]:
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        if not readable:
+            return []
+        data = self.sock.recv(4096)
+        if not data:
+            raise ConnectionError("Analyzer closed the connection")
+        return self.framer.feed(data)
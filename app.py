@@ -1,11 +1,13 @@
 # Standard Library Imports
+import json
 import os
 import time
 from datetime import datetime as dt
+from urllib.parse import urlencode
 from datetime import timedelta
 
 # Dash and Plotly Imports
-from dash import dcc, html, Dash, Input, Output, State, callback_context, no_update
+from dash import dcc, html, Dash, Input, Output, State, ALL, MATCH, ClientsideFunction, callback_context, no_update
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 
@@ -14,51 +16,70 @@ import pandas as pd
 import sqlite3
 from sqlite3 import Error
 
-# Image and Requests Imports
-import requests
-from PIL import Image
-from io import BytesIO
-import base64
-
 # Custom Libraries Imports
-from database import Database
-from PLC_kumlib import ConfigPLC, init_plcs, generate_status_indicators,connect_plcs
+from database import MIN_ROLLUP_RESOLUTION, Database, now_ms, rollup_resolution
+from downsample import downsample, envelope
+from alerts import DEFAULT_STATS_FILE, StatsFile
+from camera import CameraFrameCache, register_camera_route
+from export import register_export_route
+from figure_cache import FigureCache
+from metrics import register_metrics_route
+from push import EventBroker, register_push_route
+from ringbuffer import LiveBuffer
+from fleet import load_fleet
+from plc_client import PLCClient, PLCDaemonError
 
 # Environment Variables Imports
 from dotenv import load_dotenv
 
 # Load Environment Variables
 load_dotenv()
-USER_NAME = os.getenv("USER_NAME")
-PASSWORD = os.getenv("PASSWORD")
-BASE_URL = os.getenv("BASE_URL")
+DB_PATH = os.getenv("DB_PATH", "my_database.sqlite")
+LIVE_BUFFER = os.getenv("LIVE_BUFFER", "hydrokum_live")  # shared memory written by the ingest, "" to disable
+STATS_FILE = os.getenv("STATS_FILE", DEFAULT_STATS_FILE)  # rolling statistics and alerts from the ingest
+# devices, command maps, status bits and registers
+FLEET_FILE = os.getenv("FLEET_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "fleet.json"))
 
 # Define Constants
-IP_ADDRESSES = ["192.168.0.11", "192.168.0.12", "192.168.0.13", "192.168.0.14", "192.168.0.15", "192.168.0.16"]
-IP_ADDRESS_MULTIPLEXER = "192.168.0.100"
-COMMANDS_KUM = {'open': 0b0000011, 'close': 0b0000101, 'estop': 0b0010000, 'none': 0b0000000}
-STATUS_BITS_KUM = {0: "Estop Trigged", 1: "Motor Dir", 2: "Motor run", 3: "Warning buzzer", 4: "Open endstop", 5: "Close endstop"}
-COMMANDS_MULTIPLEXER = {'kum1': 0b01000001, 'kum2': 0b01000010, 'kum3': 0b01000100, 'kum4': 0b01001000, 'kum5': 0b01010000, 'kum6': 0b01100000, 'POW': 0b01000111, 'off': 0b00000000}
-STATUS_BITS_MULTIPLEXER = {0: "CH1", 1: "CH2", 2: "CH3", 3: "CH4", 4: "CH5", 5: "CH6", 7: "Pumpe"}
+DATA_COLUMNS = ['time', 'N2O ppm', 'CO2 ppm', 'CH4 ppm', 'NH3 ppb']
+TIME_RANGES = {'1h': timedelta(hours=1), '24h': timedelta(days=1), '7d': timedelta(days=7), '30d': timedelta(days=30)}
+DEFAULT_PLOT_WIDTH = 1200  # px, used until the browser reports the real graph width
+PLOT_WIDTH_STEP = 100  # px; widths are rounded down to this so similar windows share cached figures
+# Updates are pushed over /events; the interval only catches up after a dropped connection
+FALLBACK_INTERVAL = 60 * 1000  # ms
+
+db = Database(DB_PATH, archive_dir='archive', live=LiveBuffer(LIVE_BUFFER) if LIVE_BUFFER else None)
+db.create_table()
+
+# Rolling statistics and active alerts kept by the ingest's AlertEngine, no database reads
+STATS = StatsFile(STATS_FILE)
 
-db = Database('my_database.sqlite')
+# Full graph builds are shared by every session looking at the same range and data
+FIGURE_CACHE = FigureCache(max_entries=32)
 
-# Initialize PLCS
-PLCS = init_plcs(IP_ADDRESSES,"KUM", COMMANDS_KUM,STATUS_BITS_KUM,  "V1", db)
-# Add PLC_multiplexer to PLCS
-PLCS['multiplexer'] = ConfigPLC(IP_ADDRESS_MULTIPLEXER, COMMANDS_MULTIPLEXER,STATUS_BITS_MULTIPLEXER,"V1", db)
-connect_plcs(PLCS)
+# The fleet file only lays out the dashboard; the PLCs themselves belong to plc_daemon.py, so any
+# number of workers can serve the app without each one opening its own PLC connections
+FLEET = load_fleet(FLEET_FILE)
+PLC = PLCClient()
 
 # Initialize Global Variable
 LAST_FETCHED_TIME = dt(1970, 1, 1)  # Initialized to UNIX epoch time
-
-# Split PLCS into COLUMNS for the layout
-N_COLUMNS = 3
-PLCS_IDS = list(PLCS.keys())
-COLUMNS = [PLCS_IDS[i::N_COLUMNS] for i in range(N_COLUMNS)]
+LOCAL_TZ = dt.now().astimezone().tzinfo
 
 
 app = Dash(__name__)
+server = app.server  # WSGI entry point, e.g. gunicorn app:server
+
+# plc_daemon.py grabs the camera once for all workers; each worker keeps the newest frame for its tabs
+CAMERA = CameraFrameCache(PLC.camera_frame)
+CAMERA_ROUTE = register_camera_route(app.server, CAMERA)
+EXPORT_ROUTE = register_export_route(app.server, db)
+METRICS_ROUTE = register_metrics_route(app.server)
+
+
+def to_local_datetime(times):
+    """Convert a series of epoch milliseconds to naive local datetimes for plotting."""
+    return pd.to_datetime(times, unit='ms', utc=True).dt.tz_convert(LOCAL_TZ).dt.tz_localize(None)
 
 
 def generate_html_status(status_indicators):
@@ -70,181 +91,253 @@ def generate_html_status(status_indicators):
     return html_elements
 
 
-def generate_plc_div(PLCS, COLUMNS):
-    return html.Div(
-        [html.Div(
-            [
-                html.P(
-                    f"PLC{plc_id.split('plc')[-1]}: {'Connected' if PLCS[plc_id].connected else 'Unreachable'}"),
-                html.Div([html.Button(f'{cmd}', id=f'button-{plc_id}-{cmd}', n_clicks=0) for cmd in
-                          PLCS[plc_id].commands.keys()]),
-                html.Div(id=f'status-indicator-{plc_id}'),
-                html.Div(id=f'output-{plc_id}')
-            ], style={'margin-right': '50px'}
-        )
+def describe_command(handle):
+    """Text for a command handle as returned by the PLC daemon."""
+    if handle['state'] == 'done':
+        return f"Command {handle['name']} sent to {handle['plc_id']} in {handle['latency_ms']:.0f} ms"
+    if handle['state'] in ('failed', 'cancelled'):
+        return f"Command {handle['name']} to {handle['plc_id']} {handle['state']}: {handle['error']}"
+    return f"Command {handle['name']} queued for {handle['plc_id']}"
 
-            for plc_id in [id for col in COLUMNS for id in col if "multiplexer" not in id]
 
-        ], style={'display': 'flex', 'justify-content': 'space-around'}
+def daemon_down_payload(plc_id):
+    return {'plc_id': plc_id, 'state': 'unavailable', 'signature': 'daemon-down',
+            'indicators': [{'text': "PLC daemon not running", 'color': 'red'}]}
+
+
+def status_payloads():
+    """plc id -> status payload with signature and indicators, from the PLC daemon."""
+    try:
+        return PLC.status()
+    except PLCDaemonError:
+        return {plc_id: daemon_down_payload(plc_id) for plc_id in FLEET}
+
+
+def generate_plc_div(plc_id, device):
+    # Pattern-matching ids, so one callback of each kind serves every device in the fleet
+    return html.Div(
+        [
+            html.P(f"{device.label} {plc_id}"),
+            html.Div([html.Button(cmd, id={'type': 'plc-command', 'plc': plc_id, 'cmd': cmd}, n_clicks=0)
+                      for cmd in device.commands.keys()]),
+            html.Div(id={'type': 'plc-status', 'plc': plc_id}),
+            html.Div(id={'type': 'plc-output', 'plc': plc_id})
+        ], style={'margin-right': '50px', 'margin-bottom': '20px'}
     )
 
 
-def generate_multiplex_div(PLCS):
+def generate_fleet_div(FLEET):
+    # One wrapping row per device type, in the order the types first appear in the fleet file
+    device_types = list(dict.fromkeys(device.device_type for device in FLEET.values()))
     return html.Div([
-        html.P("PLC Multiplexer: Connected" if PLCS['multiplexer'].connected else "PLC Multiplexer: NOT Connected"),
-        html.Div([html.Button(f'{cmd}', id=f'button-multiplexer-{cmd}', n_clicks=0) for cmd in
-                  PLCS['multiplexer'].commands.keys()]),
-        html.Div(id=f'status-indicator-multiplexer'),
-        html.Div(id=f'output-multiplexer')
-    ], style={'margin-right': '50px'})
+        html.Div([generate_plc_div(plc_id, device)
+                  for plc_id, device in FLEET.items() if device.device_type == device_type],
+                 style={'display': 'flex', 'flex-wrap': 'wrap', 'justify-content': 'space-around'})
+        for device_type in device_types
+    ])
 
 
-def create_layout(PLCS, COLUMNS, graph_interval=10 * 1000):
+def create_layout(FLEET, graph_interval=FALLBACK_INTERVAL):
     return html.Div(
         [
             html.Img(id='live-feed', src='')  # camera feed
             ,
+            html.Div([
+                dcc.RadioItems(id='time-range', options=list(TIME_RANGES.keys()), value='1h', inline=True),
+                dcc.RadioItems(id='downsample-mode', options=[{'label': 'LTTB', 'value': 'lttb'},
+                                                              {'label': 'Min/max', 'value': 'minmax'}],
+                               value='lttb', inline=True),
+            ], style={'display': 'flex', 'gap': '40px'})
+            ,
+            html.Div(id='latest-values')
+            ,
+            html.Div(id='gas-stats')  # rolling statistics and active alerts
+            ,
+            dcc.Interval(id='stats-interval', interval=5 * 1000, n_intervals=0)
+            ,
             dcc.Graph(id='live-update-graph')   # live graph
             ,
+            dcc.Store(id='graph-width')
+            ,
             dcc.Interval( id='interval-component',interval=graph_interval,n_intervals=0)
             ,
-            dcc.Store(id='stored-data', storage_type='session')
+            dcc.Store(id='stored-data')  # cursor of what the live graph already shows
+            ,
+            dcc.Store(id='status-signatures')  # plc id -> status_signature the browser is showing
             ,
-            generate_plc_div(PLCS, COLUMNS)
+            dcc.Store(id='push-status')  # written by assets/push.js from /events
             ,
-            generate_multiplex_div(PLCS)
+            dcc.Store(id='push-data')
             ,
-            html.Button("Download CSV", id="btn_csv")
+            dcc.Store(id='graph-refresh')  # set by assets/push.js when a bucketed graph needs redrawing
             ,
-            dcc.Download(id="download-dataframe-csv")
+            generate_fleet_div(FLEET)
+            ,
+            html.Div([
+                dcc.Dropdown(id='timeline-device', options=list(FLEET), value=next(iter(FLEET), None),
+                             clearable=False, style={'width': '200px'}),
+                html.Div(id='timeline-summary', style={'display': 'flex', 'gap': '30px'}),
+            ], style={'display': 'flex', 'gap': '40px', 'align-items': 'center'})
+            ,
+            dcc.Graph(id='status-timeline')  # when each status bit of the chosen device was set
+            ,
+            html.Div([
+                dcc.DatePickerRange(id='export-range', start_date=(dt.now() - timedelta(days=7)).date(),
+                                    end_date=dt.now().date()),
+                dcc.Dropdown(id='export-format', options=['csv', 'csv.gz', 'parquet'], value='csv',
+                             clearable=False, style={'width': '120px'}),
+                html.A(html.Button("Download"), id='export-link', href=EXPORT_ROUTE),
+            ], style={'display': 'flex', 'gap': '20px', 'align-items': 'center'})
             ,
         ]
     )
 
 
-app.layout = create_layout(PLCS, COLUMNS)
+app.layout = create_layout(FLEET)
+
+# Push status changes, command results, new rows and camera frames to every open tab as they happen
+BROKER = EventBroker()
+
+
+def forward_plc_event(event, data):
+    if event == 'command':
+        BROKER.publish('command', {'plc_id': data['plc_id'], 'text': describe_command(data)})
+    elif event == 'camera':
+        CAMERA.announce(data['etag'])
+        BROKER.publish('camera', {'src': f"{CAMERA_ROUTE}?v={data['etag']}"})
+    elif event == 'data':
+        BROKER.publish('data', dict(data, columns=DATA_COLUMNS[1:]))
+    else:
+        BROKER.publish(event, data)
+
+
+# Each worker follows the daemon's event stream, which also carries new data rows and camera frames, and
+# relays it to its own browsers
+PLC.subscribe(forward_plc_event)
+PUSH_ROUTE = register_push_route(app.server, BROKER,
+                                 snapshot=lambda: [('status', payload) for payload in status_payloads().values()])
 
 
 @app.callback(
-    Output("download-dataframe-csv", "data"),
-    Input("btn_csv", "n_clicks"),
-    State('stored-data', 'data'),
-    prevent_initial_call=True
+    Output('export-link', 'href'),
+    Input('export-range', 'start_date'),
+    Input('export-range', 'end_date'),
+    Input('export-format', 'value')
 )
-def func(n_clicks, stored_data):
-    if n_clicks:
-        df = pd.DataFrame(stored_data)
-        timestamp = dt.now().strftime('%Y-%m-%d_%H-%M-%S')
-        return dcc.send_data_frame(df.to_csv, f"data_{timestamp}.csv")
+def update_export_link(start_date, end_date, fmt):
+    # The export is streamed by EXPORT_ROUTE straight from SQLite; the end date is inclusive
+    params = {'format': fmt}
+    if start_date:
+        params['start'] = start_date
+    if end_date:
+        params['end'] = (dt.fromisoformat(end_date) + timedelta(days=1)).date().isoformat()
+    return f"{EXPORT_ROUTE}?{urlencode(params)}"
 
 
 @app.callback(
-    [Output(f'status-indicator-{plc_id}', 'children') for plc_id in PLCS.keys()],
-    Input('interval-component', 'n_intervals')
+    Output({'type': 'plc-status', 'plc': ALL}, 'children'),
+    Output('status-signatures', 'data'),
+    Input('interval-component', 'n_intervals'),
+    State('status-signatures', 'data')
 )
-def update_status(n):
-    return [generate_html_status(generate_status_indicators(PLCS[plc_id])) for plc_id in PLCS.keys()]
-
-# Creating separate callbacks for each PLC
-for plc_id in PLCS.keys():
-    @app.callback(
-        Output(f'output-{plc_id}', 'children'),
-        [Input(f'button-{plc_id}-{cmd}', 'n_clicks') for cmd in PLCS[plc_id].commands.keys()],
-        [State(f'button-{plc_id}-{cmd}', 'n_clicks') for cmd in PLCS[plc_id].commands.keys()],
-    )
-    def send_command(*args):
-        ctx = callback_context
-        if not ctx.triggered:
-            return no_update
+def update_status(n, shown):
+    # Only indicators whose status changed since the last tick are sent to the browser
+    shown = shown or {}
+    outputs = callback_context.outputs_list[0]
+    payloads = status_payloads()
+    signatures = {}
+    children = []
+    for output in outputs:
+        plc_id = output['id']['plc']
+        payload = payloads.get(plc_id) or daemon_down_payload(plc_id)
+        signatures[plc_id] = payload['signature']
+        if shown.get(plc_id) == signatures[plc_id]:
+            children.append(no_update)
         else:
-            button_id = ctx.triggered[0]['prop_id'].split('.')[0]
-            plc_id, cmd = button_id.split('-')[1:]
-            n_clicks = ctx.states[f'{button_id}.n_clicks']
-            if n_clicks > 0:
-                PLCS[plc_id].write_command("V0", PLCS[plc_id].commands[cmd])
-                return f"Command {cmd} sent to {plc_id}"
+            children.append(generate_html_status(payload['indicators']))
+    return children, (no_update if signatures == shown else signatures)
 
 
-@app.callback(Output('live-feed', 'src'),
-              Input('interval-component', 'n_intervals'))
-def update_image(n):
+app.clientside_callback(
+    ClientsideFunction(namespace='push', function_name='apply_status'),
+    Output({'type': 'plc-status', 'plc': ALL}, 'children', allow_duplicate=True),
+    Output('status-signatures', 'data', allow_duplicate=True),
+    Input('push-status', 'data'),
+    State({'type': 'plc-status', 'plc': ALL}, 'id'),
+    State('status-signatures', 'data'),
+    prevent_initial_call=True
+)
+
+
+@app.callback(
+    Output({'type': 'plc-output', 'plc': MATCH}, 'children'),
+    Input({'type': 'plc-command', 'plc': MATCH, 'cmd': ALL}, 'n_clicks'),
+    prevent_initial_call=True
+)
+def send_command(n_clicks):
+    button_id = callback_context.triggered_id
+    if not button_id or not any(n_clicks):
+        return no_update
+    # Returns as soon as the command is queued; the result is pushed when the PLC has acknowledged it
     try:
-        # Create the URL using environment variables
-        url = f"{BASE_URL}&user={USER_NAME}&password={PASSWORD}&width=640&height=480"
-        unique_url = f"{url}&t={time.time()}"  # append a unique timestamp to the URL
-
-        # Get the image from the URL with a timeout
-        response = requests.get(unique_url, timeout=10)
-
-        # Validate the response
-        response.raise_for_status()
-        if "image" not in response.headers.get("Content-Type", "").lower():
-            raise ValueError("Invalid content received, expected an image")
-
-        # Open and process the image
-        img = Image.open(BytesIO(response.content))
-        top, bottom, left = 190, 200, 250
-        width, height = img.size
-        img_cropped = img.crop((left, top, width, height - bottom))
-
-        # Convert to JPEG and encode
-        buffered = BytesIO()
-        img_cropped.save(buffered, format="JPEG")
-        img_str = base64.b64encode(buffered.getvalue()).decode()
-
-        return 'data:image/jpeg;base64,{}'.format(img_str)
-    except (requests.RequestException, ValueError, IOError) as e:
-        # Log the error for debugging
-        print(f"An error occurred: {e}")
-        return None  # return a default image or error message
-
-
-@app.callback(Output('live-update-graph', 'figure'),
-              [Input('interval-component', 'n_intervals')],
-              [State('stored-data', 'data')])  # Use State to get the current data from dcc.Store
-def update_graph_live(n, stored_data, lim=3600):
-    # Query all data from the database
-    new_data = pd.DataFrame( db.query_data(None, lim), columns=['time', 'N2O ppm', 'CO2 ppm', 'CH4 ppm', 'NH3 ppb'])
-
-    # if there's no stored data, store the new data
-    if stored_data is None:
-        df = new_data
-    else:
-        # If there's stored data, append new data to it
-        df = pd.concat([pd.DataFrame(stored_data), new_data])
+        handle = PLC.command(button_id['plc'], button_id['cmd'])
+    except PLCDaemonError as e:
+        # After a reply timeout the command may still run; it is never sent twice
+        return f"{button_id['cmd']} not confirmed: {e}"
+    except ValueError as e:
+        return str(e)
+    return describe_command(handle)
 
-    # Limit the data to the last 1000 records
-    df = df.tail(lim)
 
-    if df.empty:
-        return go.Figure()  # Return an empty figure
+@app.callback(Output('live-feed', 'src'),
+              Input('interval-component', 'n_intervals'),
+              State('live-feed', 'src'))
+def update_image(n, current_src):
+    # The frame itself is served by CAMERA_ROUTE; only point the browser at a new version
+    _, etag = CAMERA.latest()
+    if etag is None:
+        return no_update
+    src = f"{CAMERA_ROUTE}?v={etag}"
+    return no_update if src == current_src else src
+
+
+# Report the rendered graph width so the server only sends as many points as can be drawn
+app.clientside_callback(
+    """
+    function(n, current) {
+        var el = document.getElementById('live-update-graph');
+        var width = el ? el.offsetWidth : window.innerWidth;
+        return width === current ? window.dash_clientside.no_update : width;
+    }
+    """,
+    Output('graph-width', 'data'),
+    Input('interval-component', 'n_intervals'),
+    State('graph-width', 'data')
+)
+
+
+def build_figure(df, n_points, mode, extremes=None):
+    """Build the four-gas figure from a full query result.
+
+    ``extremes`` maps each gas column to the (min, max) Series of bucketed
+    rows; the traces then show every bucket's range instead of downsampling.
+    """
+    times = to_local_datetime(df['time'])
 
     # Create the graph
     fig = make_subplots(rows=4, cols=1, vertical_spacing=0.05)
     fig.update_layout(height=800)
 
     for i, col in enumerate(df.columns[1:]):
-        fig.add_trace(go.Scatter(x=df['time'], y=df[col], name=col), row=i + 1, col=1)
-
-    # Update xaxis properties
-    fig.update_xaxes(range=[min(df['time']), max(df['time'])])
-
-    # Add annotations with the latest values
-    annotations = []
-    for i, col in enumerate(df.columns[1:]):
-        latest_value = df[col].iloc[1]  # Get the last value
-        latest_time = pd.to_datetime(df['time'].iloc[1])  # Converts 'time' string to datetime object
-        latest_time_with_offset = latest_time + timedelta(seconds=1)  # Adds a 1 minute offset
-
-        # Adjust yref to point to the correct yaxis (e.g., y2, y3, ...)
-        annotations.append(
-            dict(xref='x', yref=f'y{i + 1}', x=latest_time_with_offset, y=latest_value, xanchor='left',
-                 yanchor='middle',
-                 text=str(latest_value), showarrow=False, font=dict(size=15)))
+        if extremes is not None:
+            x, y = envelope(times, *extremes[col])
+        else:
+            x, y = downsample(times, df[col], n_points, mode)
+        fig.add_trace(go.Scatter(x=x, y=y, name=col), row=i + 1, col=1)
 
-    # Update layout with annotations and move the legend below the graph
+    # Keep zoom/pan across extendData updates; move the legend above the graph
     fig.update_layout(
-        annotations=annotations,
+        uirevision=True,
         legend=dict(
             orientation="h",
             yanchor="bottom",
@@ -257,27 +350,164 @@ def update_graph_live(n, stored_data, lim=3600):
     return fig
 
 
-@app.callback(Output('stored-data', 'data'),
-              [Input('live-update-graph', 'figure')],
-              [State('stored-data', 'data')])
-def update_stored_data(_, stored_data, lim=1000):
-    if stored_data:
-        last_plotted_time = max(row['time'] for row in stored_data)
-    else:
-        last_plotted_time = None
+def format_duration(ms):
+    minutes = ms // 60000
+    return f"{minutes // 60}h {minutes % 60:02d}m" if minutes >= 60 else f"{minutes}m {ms // 1000 % 60:02d}s"
+
+
+def build_timeline(device, intervals, start, end):
+    """Gantt-style bars, one row per status bit, from Database.status_intervals rows."""
+    names = [device.status_bits[bit] for bit, _, _ in intervals]
+    starts = pd.Series([max(begin, start) for _, begin, _ in intervals], dtype='int64')
+    durations = [min(finish if finish is not None else end, end) - max(begin, start) for _, begin, finish in intervals]
+    fig = go.Figure(go.Bar(y=names, x=durations, base=to_local_datetime(starts), orientation='h',
+                           hovertext=[format_duration(ms) for ms in durations]))
+    fig.update_layout(height=80 + 30 * len(device.status_bits), uirevision=True, margin=dict(t=20, b=20),
+                      yaxis=dict(categoryorder='array', categoryarray=list(device.status_bits.values())[::-1]))
+    fig.update_xaxes(type='date', range=list(to_local_datetime(pd.Series([start, end]))))
+    return fig
 
-    new_data = pd.DataFrame(db.query_data(last_plotted_time, lim),
-                            columns=['time', 'N2O ppm', 'CO2 ppm', 'CH4 ppm', 'NH3 ppb'])
 
-    if stored_data is None:
-        df = new_data
+def generate_gas_stats(stats):
+    def number(value):
+        return "-" if value is None else f"{value:.4g}"
+
+    alerts = [html.Div(f"ALERT {alert['rule']}: {alert['gas']} {number(alert['value'])} "
+                       f"(limit {number(alert['limit'])}) since "
+                       f"{dt.fromtimestamp(alert['since'] / 1000).strftime('%Y-%m-%d %H:%M:%S')}",
+                       style={'color': 'red', 'font-weight': 'bold'})
+              for alert in stats['active']]
+    rows = []
+    for gas, label in zip(stats['latest'], DATA_COLUMNS[1:]):
+        parts = [f"{label}: {number(stats['latest'][gas])}"]
+        for name, gases in stats['windows'].items():
+            window = gases[gas]
+            parts.append(f"{name} {number(window['mean'])} \u00b1 {number(window['std'])} "
+                         f"[{number(window['min'])}, {number(window['max'])}]")
+        rows.append(html.Div("   ".join(parts), style={'font-size': '13px', 'white-space': 'pre'}))
+    return alerts + rows
+
+
+def build_graph(time_range, n_points, mode):
+    """Figure, cursor and latest values for a full redraw, or None without data."""
+    span = int(TIME_RANGES[time_range].total_seconds() * 1000)
+    start = now_ms() - span
+    extremes = None
+    resolution = span // n_points
+    if resolution >= MIN_ROLLUP_RESOLUTION:
+        # Long ranges are read from the rollup tables instead of raw rows. Min/max draws two points per
+        # bucket, so it asks for half as many buckets
+        if mode == 'minmax':
+            resolution = span // (n_points // 2)
+        # Whole rollup buckets only, as query_summary would round it; the cursor needs the real width
+        resolution = rollup_resolution(resolution)
+        summary = pd.DataFrame(db.query_summary(start=start, resolution=resolution),
+                               columns=['time'] + [f"{col} {stat}" for col in DATA_COLUMNS[1:]
+                                                   for stat in ('min', 'mean', 'max')])
+        df = summary[['time'] + [f"{col} mean" for col in DATA_COLUMNS[1:]]].set_axis(DATA_COLUMNS, axis=1)
+        if mode == 'minmax':
+            extremes = {col: (summary[f"{col} min"], summary[f"{col} max"]) for col in DATA_COLUMNS[1:]}
     else:
-        df = pd.concat([pd.DataFrame(stored_data), new_data])
+        df = pd.DataFrame(db.query_data(start=start), columns=DATA_COLUMNS)
+    if df.empty:
+        return None
+    fig = build_figure(df, n_points, mode, extremes)
+    # Only a graph of every raw row can be extended with new rows: appending them to rollup buckets or
+    # downsampled points would push whole buckets out, so those are redrawn once per `bucket` ms instead
+    raw = resolution < MIN_ROLLUP_RESOLUTION and len(df) <= n_points
+    cursor = {
+        'range': time_range,
+        'start': start,
+        'last_time': int(df['time'].iloc[-1]),
+        # Raw rows shown, and how many fit before the graph has to be redrawn downsampled
+        'rows': len(df),
+        'max_points': n_points,
+        'bucket': None if raw else resolution,
+    }
+    # Plain JSON types, so Dash re-serializes a cached figure without going through plotly's encoder
+    return json.loads(fig.to_json()), cursor, generate_latest_values(df)
+
+
+@app.callback(Output('gas-stats', 'children'),
+              Input('stats-interval', 'n_intervals'))
+def update_gas_stats(n):
+    stats = STATS.read()
+    return generate_gas_stats(stats) if stats else []
+
+
+@app.callback(Output('status-timeline', 'figure'),
+              Output('timeline-summary', 'children'),
+              Input('timeline-device', 'value'),
+              Input('time-range', 'value'),
+              Input('interval-component', 'n_intervals'))
+def update_timeline(plc_id, time_range, n):
+    # Read from the status_intervals table, so a month costs no more than an hour
+    if plc_id not in FLEET:
+        return go.Figure(), []
+    device = FLEET[plc_id]
+    end = now_ms()
+    start = end - int(TIME_RANGES[time_range].total_seconds() * 1000)
+    intervals = db.status_intervals(device.ip_address, device.status_bits, start, end)
+    totals = db.status_durations(device.ip_address, start, end, device.status_bits)
+    summary = [html.Span(f"{name}: {format_duration(totals.get(bit, (0, 0))[0])}, {totals.get(bit, (0, 0))[1]}x")
+               for bit, name in device.status_bits.items()]
+    return build_timeline(device, intervals, start, end), summary
+
+
+app.clientside_callback(
+    ClientsideFunction(namespace='push', function_name='apply_data'),
+    Output('live-update-graph', 'extendData', allow_duplicate=True),
+    Output('stored-data', 'data', allow_duplicate=True),
+    Output('latest-values', 'children', allow_duplicate=True),
+    Output('graph-refresh', 'data'),
+    Input('push-data', 'data'),
+    State('stored-data', 'data'),
+    prevent_initial_call=True
+)
+
 
-    df = df.sort_values('time')
-    df = df.tail(lim)
+def generate_latest_values(df):
+    latest = df.iloc[-1]
+    return [html.Span(f"{col}: {latest[col]}", style={'margin-right': '30px', 'font-size': '15px'})
+            for col in df.columns[1:]]
 
-    return df.to_dict('records')
+
+@app.callback([Output('live-update-graph', 'figure'),
+               Output('live-update-graph', 'extendData'),
+               Output('stored-data', 'data'),
+               Output('latest-values', 'children')],
+              [Input('interval-component', 'n_intervals'),
+               Input('time-range', 'value'),
+               Input('downsample-mode', 'value'),
+               Input('graph-width', 'data'),
+               Input('graph-refresh', 'data')],
+              [State('stored-data', 'data')])
+def update_graph_live(n, time_range, mode, width, refresh, cursor):
+    # About one point per horizontal pixel is all the browser can show
+    n_points = max(PLOT_WIDTH_STEP, int(width or DEFAULT_PLOT_WIDTH) // PLOT_WIDTH_STEP * PLOT_WIDTH_STEP)
+    triggered = {t['prop_id'] for t in callback_context.triggered}
+
+    if cursor and cursor.get('bucket') is None and triggered == {'interval-component.n_intervals'}:
+        # Only send rows newer than what the client already has
+        df = pd.DataFrame(db.query_data(cursor['last_time']), columns=DATA_COLUMNS)
+        if df.empty:
+            return no_update, no_update, no_update, no_update
+        if cursor['rows'] + len(df) <= cursor['max_points']:
+            times = to_local_datetime(df['time']).astype(str).tolist()
+            extend = dict(x=[times] * len(df.columns[1:]), y=[df[col].tolist() for col in df.columns[1:]])
+            cursor = dict(cursor, last_time=int(df['time'].iloc[-1]), rows=cursor['rows'] + len(df))
+            return no_update, [extend, list(range(len(df.columns[1:]))), cursor['max_points']], cursor, \
+                generate_latest_values(df)
+        # More rows than the graph can show: redraw it downsampled below
+
+    # Keyed on the newest row: rebuilt once per new sample, whatever the number of open tabs
+    latest = db.latest_time()
+    graph = FIGURE_CACHE.get((time_range, n_points, mode, latest),
+                             lambda: build_graph(time_range, n_points, mode)) if latest is not None else None
+    if graph is None:
+        return go.Figure(), no_update, None, []  # Return an empty figure
+    fig, cursor, latest_values = graph
+    return fig, no_update, cursor, latest_values
 
 
 if __name__ == '__main__':
@@ -0,0 +1,145 @@
+import argparse
+import logging
+import os
+from contextlib import closing
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Tuple
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from database import Database, GAS_COLUMNS, now_ms
+
+logger = logging.getLogger(__name__)
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+# Archived tables and their columnar schema; time stays epoch ms like in SQLite
+TABLES = {
+    'data': pa.schema([('time', pa.int64())] + [(col, pa.float64()) for col in GAS_COLUMNS]),
+    'status_history': pa.schema([('time', pa.int64()), ('ip_address', pa.string()), ('status', pa.int64())]),
+    'plc_history': pa.schema([('time', pa.int64()), ('ip_address', pa.string()), ('event', pa.string())]),
+}
+
+
+def partition_path(archive_dir: str, table: str, day_start: int) -> str:
+    """archive_dir/<table>/date=YYYY-MM-DD/part-0.parquet, dates in UTC."""
+    day = datetime.fromtimestamp(day_start / 1000, tz=timezone.utc).date()
+    return os.path.join(archive_dir, table, f"date={day.isoformat()}", "part-0.parquet")
+
+
+def read_range(archive_dir: str, table: str, start: int, end: int, chunk_size: int = 50000) -> Iterator[List[Tuple]]:
+    """Yield archived rows of `table` in [start, end) oldest first.
+
+    Only the partitions for days overlapping the range are opened, and the time
+    filter is pushed down to the Parquet row groups.
+    """
+    table_dir = os.path.join(archive_dir, table)
+    if not os.path.isdir(table_dir):
+        return
+    days = sorted(name for name in os.listdir(table_dir) if name.startswith("date="))
+    for name in days:
+        day_start = int(datetime.fromisoformat(name[5:]).replace(tzinfo=timezone.utc).timestamp() * 1000)
+        if day_start + DAY_MS <= start or day_start >= end:
+            continue
+        path = os.path.join(table_dir, name, "part-0.parquet")
+        if not os.path.exists(path):
+            continue
+        result = pq.read_table(path, filters=[('time', '>=', start), ('time', '<', end)]).sort_by('time')
+        for batch in result.to_batches(max_chunksize=chunk_size):
+            columns = [column.to_pylist() for column in batch.columns]
+            yield list(zip(*columns))
+
+
+class Archiver:
+    """Moves whole days older than a cutoff from SQLite into Parquet partitions.
+
+    Each table's progress is kept as a watermark in the archive_state table,
+    which Database.iter_rows uses to split queries between archive and SQLite.
+    Re-running is safe: a day is rewritten whole and the watermark only moves
+    forward after its partition is on disk.
+    """
+
+    def __init__(self, db: Database, archive_dir: str = 'archive', compression: str = 'zstd'):
+        self.db = db
+        self.archive_dir = archive_dir
+        self.compression = compression
+
+    def archive(self, older_than_days: int, prune: bool = False, vacuum: bool = False) -> Dict[str, int]:
+        """Archive rows older than N days (rounded down to a UTC day) and return rows written per table."""
+        cutoff = now_ms() - older_than_days * DAY_MS
+        cutoff -= cutoff % DAY_MS
+        written = {}
+        for table in TABLES:
+            written[table] = self._archive_table(table, cutoff)
+            if prune:
+                self.prune(table)
+        if prune and vacuum:
+            conn = self.db.create_connection()
+            with closing(conn):
+                conn.execute("VACUUM")
+        return written
+
+    def _archive_table(self, table: str, cutoff: int) -> int:
+        conn = self.db.create_connection()
+        with closing(conn):
+            watermark = self.db.archive_watermark(table)
+            if watermark is None:
+                first = conn.execute(f"SELECT min(time) FROM {table}").fetchone()[0]
+                if first is None:
+                    return 0
+                watermark = first - first % DAY_MS
+            n_rows = 0
+            for day_start in range(watermark, cutoff, DAY_MS):
+                rows = conn.execute(f"SELECT * FROM {table} WHERE time >= ? AND time < ? ORDER BY time",
+                                    (day_start, day_start + DAY_MS)).fetchall()
+                if rows:
+                    self._write_partition(table, day_start, rows)
+                    n_rows += len(rows)
+                with conn:
+                    conn.execute("INSERT OR REPLACE INTO archive_state (table_name, watermark) VALUES (?, ?)",
+                                 (table, day_start + DAY_MS))
+        logger.info(f"Archived {n_rows} rows of {table} up to "
+                    f"{datetime.fromtimestamp(cutoff / 1000, tz=timezone.utc).date()}")
+        return n_rows
+
+    def _write_partition(self, table: str, day_start: int, rows: List[Tuple]):
+        schema = TABLES[table]
+        path = partition_path(self.archive_dir, table, day_start)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        columns = [pa.array(col, type=field.type) for col, field in zip(zip(*rows), schema)]
+        tmp = path + ".tmp"
+        pq.write_table(pa.Table.from_arrays(columns, schema=schema), tmp, compression=self.compression)
+        os.replace(tmp, path)
+
+    def prune(self, table: str) -> int:
+        """Delete rows of `table` that are already archived from SQLite."""
+        watermark = self.db.archive_watermark(table)
+        if watermark is None:
+            return 0
+        self.db.flush()
+        conn = self.db.create_connection()
+        with closing(conn), conn:
+            deleted = conn.execute(f"DELETE FROM {table} WHERE time < ?", (watermark,)).rowcount
+        logger.info(f"Pruned {deleted} archived rows from {table}")
+        return deleted
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move old measurements into date-partitioned Parquet files")
+    parser.add_argument('--db', default='my_database.sqlite', help="SQLite database file")
+    parser.add_argument('--archive-dir', default='archive', help="directory for the Parquet partitions")
+    parser.add_argument('--older-than', type=int, default=90, help="archive rows older than this many days")
+    parser.add_argument('--prune', action='store_true', help="delete archived rows from SQLite")
+    parser.add_argument('--vacuum', action='store_true', help="VACUUM the database after pruning")
+    args = parser.parse_args()
+
+    db = Database(args.db, archive_dir=args.archive_dir)
+    db.create_table()
+    written = Archiver(db, args.archive_dir).archive(args.older_than, args.prune, args.vacuum)
+    for table, n_rows in written.items():
+        print(f"{table}: {n_rows} rows archived")
+
+
+if __name__ == "__main__":
+    main()
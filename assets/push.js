@@ -0,0 +1,112 @@
+// Applies the Server-Sent Events from push.py (/events) to the dashboard.
+// Events are folded into cumulative state before being handed to the push-* Stores,
+// so nothing is lost when several arrive before Dash runs the clientside callbacks.
+(function () {
+    var MAX_ROWS = 1000;
+    var state = {status: {}, rows: [], columns: []};
+
+    function pad(n, width) {
+        return String(n).padStart(width || 2, '0');
+    }
+
+    // Same format as to_local_datetime(...).astype(str) on the server
+    function localTime(ms) {
+        var d = new Date(ms);
+        return d.getFullYear() + '-' + pad(d.getMonth() + 1) + '-' + pad(d.getDate()) + ' ' +
+            pad(d.getHours()) + ':' + pad(d.getMinutes()) + ':' + pad(d.getSeconds()) + '.' +
+            pad(d.getMilliseconds(), 3);
+    }
+
+    function component(type, children, style) {
+        return {namespace: 'dash_html_components', type: type, props: {children: children, style: style}};
+    }
+
+    function connect() {
+        var dc = window.dash_clientside;
+        // Wait until the renderer is up and the layout is on the page
+        if (!dc || !dc.set_props || !document.getElementById('live-update-graph')) {
+            setTimeout(connect, 250);
+            return;
+        }
+        var source = new EventSource('/events');
+        source.addEventListener('status', function (e) {
+            var event = JSON.parse(e.data);
+            state.status[event.plc_id] = event;
+            dc.set_props('push-status', {data: Object.assign({}, state.status)});
+        });
+        source.addEventListener('data', function (e) {
+            var event = JSON.parse(e.data);
+            state.columns = event.columns;
+            state.rows = state.rows.concat(event.rows).slice(-MAX_ROWS);
+            dc.set_props('push-data', {data: {columns: state.columns, rows: state.rows}});
+        });
+        source.addEventListener('command', function (e) {
+            var event = JSON.parse(e.data);
+            dc.set_props({type: 'plc-output', plc: event.plc_id}, {children: event.text});
+        });
+        source.addEventListener('camera', function (e) {
+            dc.set_props('live-feed', {src: JSON.parse(e.data).src});
+        });
+    }
+
+    window.dash_clientside = window.dash_clientside || {};
+    window.dash_clientside.push = {
+        apply_status: function (pushed, ids, shown) {
+            var nu = window.dash_clientside.no_update;
+            shown = Object.assign({}, shown || {});
+            var changed = false;
+            var children = ids.map(function (id) {
+                var event = pushed && pushed[id.plc];
+                if (!event || shown[id.plc] === event.signature) {
+                    return nu;
+                }
+                shown[id.plc] = event.signature;
+                changed = true;
+                return event.indicators.map(function (indicator) {
+                    return component('Div', indicator.text, {color: indicator.color});
+                });
+            });
+            return changed ? [children, shown] : [nu, nu];
+        },
+
+        apply_data: function (pushed, cursor) {
+            var nu = window.dash_clientside.no_update;
+            if (!pushed || !cursor) {
+                return [nu, nu, nu, nu];
+            }
+            // Rows the graph already has (from the server or an earlier event) are skipped
+            var rows = pushed.rows.filter(function (row) { return row[0] > cursor.last_time; });
+            if (!rows.length) {
+                return [nu, nu, nu, nu];
+            }
+            var last = rows[rows.length - 1];
+            var latest = pushed.columns.map(function (column, i) {
+                return component('Span', column + ': ' + last[i + 1], {'margin-right': '30px', 'font-size': '15px'});
+            });
+            var advanced = Object.assign({}, cursor, {last_time: last[0]});
+            if (cursor.bucket) {
+                // Rollup or downsampled graph: raw rows would push whole buckets out, so have the server
+                // redraw it once a new bucket starts
+                var started = Math.floor(last[0] / cursor.bucket) > Math.floor(cursor.last_time / cursor.bucket);
+                return [nu, advanced, latest, started ? last[0] : nu];
+            }
+            if (cursor.rows + rows.length > cursor.max_points) {
+                // More rows than the graph can show: have the server redraw it downsampled
+                return [nu, advanced, latest, last[0]];
+            }
+            advanced.rows = cursor.rows + rows.length;
+            var times = rows.map(function (row) { return localTime(row[0]); });
+            var x = [], y = [], traces = [];
+            pushed.columns.forEach(function (column, i) {
+                x.push(times);
+                y.push(rows.map(function (row) { return row[i + 1]; }));
+                traces.push(i);
+            });
+            return [[{x: x, y: y}, traces, cursor.max_points], advanced, latest, nu];
+        }
+    };
+
+    if (window.EventSource) {
+        connect();
+    }
+})();
@@ -0,0 +1,469 @@
+"""Hardware-free benchmarks for the ingest path, database, PLC polling, Dash callbacks and flux fitting.
+
+A local TCP server emulates the gas analyzer's _Meas_GetConc protocol and a
+fleet of MockPLCs stands in for the LOGO! controllers, so everything runs on a
+laptop. Each run is appended to benchmarks/results.jsonl (git-ignored; --results
+writes elsewhere) and compared with the previous run of the same configuration.
+
+    python benchmark.py                 # everything
+    python benchmark.py --quick         # shorter runs and a smaller database
+    python benchmark.py --only queries,callbacks
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import closing
+from typing import Callable, Dict, List, Optional
+
+from analyzer import AnalyzerClient
+from database import Database, INSERT_DATA_SQL, now_ms
+
+logger = logging.getLogger(__name__)
+
+# Kept out of version control (see .gitignore); --results writes elsewhere
+RESULTS_FILE = os.getenv("BENCHMARK_RESULTS", os.path.join('benchmarks', 'results.jsonl'))
+SECTIONS = ('write', 'ingest', 'queries', 'plcs', 'callbacks', 'flux')
+
+
+def percentiles(samples: List[float], prefix: str) -> Dict[str, float]:
+    """p50/p95/p99/max of samples given in seconds, reported in milliseconds."""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+    return {f"{prefix}_p50_ms": pick(0.50), f"{prefix}_p95_ms": pick(0.95), f"{prefix}_p99_ms": pick(0.99),
+            f"{prefix}_max_ms": ordered[-1] * 1000}
+
+
+def timed(func: Callable, repeat: int) -> List[float]:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def max_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+class FakeAnalyzer(socketserver.ThreadingTCPServer):
+    """Answers _Meas_GetConc requests with a plausible reply after ``latency`` seconds."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency: float = 0.002):
+        self.latency = latency
+        self.requests = 0
+        super().__init__(('127.0.0.1', 0), FakeAnalyzerHandler)
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def reply(self) -> bytes:
+        fields = ['0'] * 13
+        fields[2] = f"{0.33 + random.gauss(0, 0.002):.4f}"   # N2O
+        fields[7] = f"{420 + random.gauss(0, 2):.2f}"        # CO2
+        fields[9] = f"{1.9 + random.gauss(0, 0.01):.4f}"     # CH4
+        fields[12] = f"{15 + random.gauss(0, 1):.2f}"        # NH3
+        return (';'.join(fields) + '\r\n').encode()
+
+
+class FakeAnalyzerHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        buffer = b""
+        while True:
+            data = self.request.recv(4096)
+            if not data:
+                return
+            buffer += data
+            while b"\r" in buffer:
+                _, buffer = buffer.split(b"\r", 1)
+                if self.server.latency:
+                    time.sleep(self.server.latency)
+                self.server.requests += 1
+                self.request.sendall(self.server.reply())
+
+
+def populate(db: Database, days: float, period_s: float = 5.0) -> int:
+    """Fill the data table with `days` of samples ending now, and build the rollups."""
+    db.create_table()
+    step = int(period_s * 1000)
+    end = now_ms()
+    start = end - int(days * 86400 * 1000)
+    conn = db.create_connection()
+    with closing(conn):
+        for chunk_start in range(start, end, step * 100000):
+            rows = [(t, 0.33 + random.gauss(0, 0.002), 420 + random.gauss(0, 2), 1.9 + random.gauss(0, 0.01),
+                     15 + random.gauss(0, 1)) for t in range(chunk_start, min(end, chunk_start + step * 100000), step)]
+            with conn:
+                conn.executemany(INSERT_DATA_SQL, rows)
+    db.backfill_rollups()
+    return (end - start) // step
+
+
+def bench_write(workdir: str, n_rows: int) -> Dict[str, float]:
+    """Raw insert throughput of the batched writer."""
+    db = Database(os.path.join(workdir, 'write.sqlite'))
+    db.create_table()
+    t0 = now_ms() - n_rows * 1000
+    enqueue = []
+    started = time.perf_counter()
+    for i in range(n_rows):
+        t = time.perf_counter()
+        db.insert_data([t0 + i * 1000, 0.33, 420.0, 1.9, 15.0])
+        enqueue.append(time.perf_counter() - t)
+    db.flush()
+    elapsed = time.perf_counter() - started
+    stats = db.stats()
+    db.close()
+    result = {'write_rows_per_s': n_rows / elapsed, 'write_avg_commit_ms': stats['avg_commit_ms'],
+              'write_max_commit_ms': stats['max_commit_ms']}
+    result.update(percentiles(enqueue, 'write_enqueue'))
+    return result
+
+
+def bench_ingest(workdir: str, duration: float, period: float, pipeline: int) -> Dict[str, float]:
+    """End-to-end analyzer -> database ingest against the fake analyzer."""
+    server = FakeAnalyzer()
+    db = Database(os.path.join(workdir, 'ingest.sqlite'))
+    db.create_table()
+    client = AnalyzerClient('127.0.0.1', server.port)
+    lag = []
+
+    def store(sample_time, values):
+        db.insert_data([sample_time] + values)
+        lag.append(time.time() - sample_time / 1000)
+
+    thread = threading.Thread(target=client.poll, args=(store, period, pipeline), daemon=True)
+    thread.start()
+    time.sleep(duration)
+    client.stop()
+    thread.join()
+    db.flush()
+    stored = len(db.query_data(start=0))
+    db.close()
+    server.shutdown()
+    result = {'ingest_rows_per_s': stored / duration, 'ingest_target_rows_per_s': 1 / period,
+              'ingest_missed_ticks': client.missed_ticks}
+    result.update(percentiles(lag, 'ingest_sample_lag'))
+    return result
+
+
+def bench_queries(workdir: str, days: float, repeat: int) -> Dict[str, float]:
+    """Latency of the queries behind the live graph, on a database holding `days` of 5 s samples."""
+    db = Database(os.path.join(workdir, 'queries.sqlite'))
+    rows = populate(db, days)
+    now = now_ms()
+    result = {'queries_db_rows': rows}
+    cases = {
+        'query_newest_3600': lambda: db.query_data(None, 3600),
+        'query_since_1min': lambda: db.query_data(now - 60 * 1000),
+        'query_range_1h': lambda: db.query_data(start=now - 3600 * 1000),
+        'query_range_24h_raw': lambda: db.query_data(start=now - 86400 * 1000),
+        'query_range_7d_rollup': lambda: db.query_data(start=now - 7 * 86400 * 1000, resolution=7 * 86400 * 1000 // 1200),
+        'query_range_30d_rollup': lambda: db.query_data(start=now - 30 * 86400 * 1000,
+                                                        resolution=30 * 86400 * 1000 // 1200),
+    }
+    for name, func in cases.items():
+        result.update(percentiles(timed(func, repeat), name))
+
+    # The same live-view queries answered from a shared ring buffer holding the newest day
+    from ringbuffer import LiveBuffer, SharedRingBuffer
+    name = f"hydrokum_bench_{os.getpid()}"
+    writer = SharedRingBuffer.create(name, 86400 // 5)
+    for row in db.query_data(start=now - 86400 * 1000):
+        writer.append(row[0], row[1:])
+    live_db = Database(db.db_name, live=LiveBuffer(name))
+    cases = {
+        'query_live_newest_3600': lambda: live_db.query_data(None, 3600),
+        'query_live_since_1min': lambda: live_db.query_data(now - 60 * 1000),
+        'query_live_range_1h': lambda: live_db.query_data(start=now - 3600 * 1000),
+        'query_live_range_24h': lambda: live_db.query_data(start=now - 86400 * 1000),
+    }
+    try:
+        for case, func in cases.items():
+            result.update(percentiles(timed(func, repeat), case))
+    finally:
+        writer.close()
+        writer.unlink()
+    return result
+
+
+def bench_plcs(workdir: str, n_plcs: int, duration: float, interval: float, latency: float) -> Dict[str, float]:
+    """Status polling of a simulated PLC fleet through PLCPoller."""
+    from PLC_kumlib import ConfigPLC, ConnectionManager, MockPLC, PLCPoller
+
+    db = Database(os.path.join(workdir, 'plcs.sqlite'))
+    db.create_table()
+    plcs = {f"KUM{i + 1}": ConfigPLC(f"10.0.0.{i + 1}", {'none': 0}, {0: "bit0"}, update_status=False, database=db,
+                                     plc=MockPLC(latency=latency, change_probability=0.05))
+            for i in range(n_plcs)}
+    # Parallel startup: bounded by the slowest connect, not the sum of them
+    started = time.perf_counter()
+    connections = ConnectionManager(plcs)
+    connections.start(wait=30.0)
+    startup = time.perf_counter() - started
+    events = []
+    poller = PLCPoller(plcs, interval=interval)
+    poller.subscribe(lambda event: events.append(time.time() - event.time))
+    poller.start()
+    time.sleep(duration)
+    threads = threading.active_count()
+    poller.stop()
+    connections.stop()
+    db.close()
+
+    polls = sum(stats['polls'] for stats in poller.stats.values())
+    return {
+        'plcs_devices': n_plcs,
+        'plcs_polls_per_s': polls / duration,
+        'plcs_target_polls_per_s': n_plcs / interval,
+        'plcs_status_changes': len(events),
+        'plcs_overruns': sum(stats['overruns'] for stats in poller.stats.values()),
+        'plcs_max_read_ms': max(stats['max_read_ms'] for stats in poller.stats.values()),
+        'plcs_max_jitter_ms': max(stats['max_jitter_ms'] for stats in poller.stats.values()),
+        'plcs_threads': threads,
+        'plcs_startup_ms': startup * 1000,
+    }
+
+
+def dash_request(client, output: str, inputs: List[Dict], state: List[Dict], changed: List[str],
+                 outputs: Optional[List] = None):
+    """POST one callback request the way the Dash renderer does.
+
+    Pattern-matching outputs cannot be derived from the output string, pass them in ``outputs``.
+    """
+    if outputs is None:
+        outputs = []
+        for spec in output.strip('.').split('...'):
+            component_id, prop = spec.rsplit('.', 1)
+            outputs.append({'id': component_id, 'property': prop})
+    payload = {'output': output, 'outputs': outputs if len(outputs) > 1 else outputs[0],
+               'inputs': inputs, 'state': state, 'changedPropIds': changed}
+    return client.post('/_dash-update-component', json=payload)
+
+
+def bench_callbacks(workdir: str, days: float, repeat: int) -> Dict[str, float]:
+    """Time the Dash callbacks through the Flask test client, including JSON serialization."""
+    db_path = os.path.join(workdir, 'app.sqlite')
+    populate(Database(db_path), days)
+    os.environ['DB_PATH'] = db_path
+    # The dashboard reaches the PLCs through the daemon; run one in-process against MockPLCs
+    socket_path = os.path.join(workdir, 'plc.sock')
+    os.environ['PLC_SOCKET'] = socket_path
+    from fleet import load_fleet
+    from plc_daemon import PLCDaemon
+    from PLC_kumlib import MockPLC
+    fleet_file = os.environ.get('FLEET_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fleet.json'))
+    daemon = PLCDaemon(load_fleet(fleet_file), plc_factory=lambda: MockPLC(latency=0.01), socket_path=socket_path)
+    daemon.start()
+    import app as dash_app
+
+    client = dash_app.app.server.test_client()
+    graph_output = next(key for key in dash_app.app.callback_map if 'live-update-graph.figure' in key)
+    result = {}
+
+    def graph_inputs(time_range):
+        return [{'id': 'interval-component', 'property': 'n_intervals', 'value': 1},
+                {'id': 'time-range', 'property': 'value', 'value': time_range},
+                {'id': 'downsample-mode', 'property': 'value', 'value': 'lttb'},
+                {'id': 'graph-width', 'property': 'data', 'value': 1200},
+                {'id': 'graph-refresh', 'property': 'data', 'value': None}]
+
+    # Full redraws with an empty figure cache (first tab after new data) and a warm one (every other tab)
+    for time_range in ('1h', '24h', '7d', '30d'):
+        for name, cached in (('full', False), ('cached', True)):
+            samples, sizes = [], []
+            for _ in range(repeat):
+                if not cached:
+                    dash_app.FIGURE_CACHE.clear()
+                started = time.perf_counter()
+                response = dash_request(client, graph_output, graph_inputs(time_range),
+                                        [{'id': 'stored-data', 'property': 'data', 'value': None}],
+                                        ['time-range.value'])
+                samples.append(time.perf_counter() - started)
+                sizes.append(len(response.data))
+            result.update(percentiles(samples, f"cb_graph_{name}_{time_range}"))
+            result[f"cb_graph_{name}_{time_range}_bytes"] = sum(sizes) / len(sizes)
+    result['figure_cache_hit_ratio'] = dash_app.FIGURE_CACHE.stats()['hit_ratio']
+
+    # Incremental ticks: the cursor from a full build, then one new row per tick
+    response = dash_request(client, graph_output, graph_inputs('1h'),
+                            [{'id': 'stored-data', 'property': 'data', 'value': None}], ['time-range.value'])
+    cursor = response.get_json()['response']['stored-data']['data']
+    samples, sizes = [], []
+    for _ in range(repeat):
+        dash_app.db.insert_data([now_ms(), 0.33, 420.0, 1.9, 15.0])
+        dash_app.db.flush()
+        started = time.perf_counter()
+        response = dash_request(client, graph_output, graph_inputs('1h'),
+                                [{'id': 'stored-data', 'property': 'data', 'value': cursor}],
+                                ['interval-component.n_intervals'])
+        samples.append(time.perf_counter() - started)
+        sizes.append(len(response.data))
+        body = response.get_json() or {}
+        cursor = body.get('response', {}).get('stored-data', {}).get('data', cursor)
+    result.update(percentiles(samples, 'cb_graph_tick'))
+    result['cb_graph_tick_bytes'] = sum(sizes) / len(sizes)
+
+    # Status: the first tick sends every indicator, later ticks only the ones that changed
+    status_output = next(key for key in dash_app.app.callback_map if 'plc-status' in key)
+    status_outputs = [[{'id': {'type': 'plc-status', 'plc': plc_id}, 'property': 'children'}
+                       for plc_id in dash_app.FLEET],
+                      {'id': 'status-signatures', 'property': 'data'}]
+
+    def status_tick(shown):
+        return dash_request(client, status_output,
+                            [{'id': 'interval-component', 'property': 'n_intervals', 'value': 1}],
+                            [{'id': 'status-signatures', 'property': 'data', 'value': shown}],
+                            ['interval-component.n_intervals'], outputs=status_outputs)
+
+    for name, incremental in (('cb_status_full', False), ('cb_status_tick', True)):
+        samples, sizes = [], []
+        signatures = status_tick(None).get_json()['response']['status-signatures']['data']
+        for _ in range(repeat):
+            started = time.perf_counter()
+            response = status_tick(signatures if incremental else None)
+            samples.append(time.perf_counter() - started)
+            sizes.append(len(response.data))
+            if incremental and response.status_code == 200:
+                signatures = response.get_json()['response'].get('status-signatures', {}).get('data', signatures)
+        result.update(percentiles(samples, name))
+        result[f"{name}_bytes"] = sum(sizes) / len(sizes)
+    daemon.stop()
+    return result
+
+
+def bench_flux(workdir: str, days: float, cycle_s: float = 600.0) -> Dict[str, float]:
+    """Segment and fit `days` of chamber cycles from scratch, then time one live update step."""
+    from fleet import load_fleet
+    from flux import FluxEngine, fleet_channels
+
+    db = Database(os.path.join(workdir, 'flux.sqlite'))
+    rows = populate(db, days)
+    fleet = load_fleet(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fleet.json'))
+    multiplexer, channels = fleet_channels(fleet)
+    # The multiplexer steps through the chambers, each closed while it is sampled
+    step = int(cycle_s * 1000)
+    end = now_ms()
+    status = []
+    for i, cycle_start in enumerate(range(end - int(days * 86400 * 1000), end - step, step)):
+        channel = channels[i % len(channels)]
+        status += [(cycle_start, multiplexer.ip_address, 1 << 6 | 1 << channel.channel_bit),
+                   (cycle_start, channel.ip_address, 1 << channel.closed_bit),
+                   (cycle_start + step - 1000, channel.ip_address, 0)]
+    conn = db.create_connection()
+    with closing(conn), conn:
+        conn.executemany("INSERT INTO status_history (time, ip_address, status) VALUES (?, ?, ?)", status)
+
+    engine = FluxEngine(db, fleet, settle=0)
+    started = time.perf_counter()
+    cycles = engine.process(end=end)
+    batch = time.perf_counter() - started
+    started = time.perf_counter()
+    engine.update()
+    return {'flux_cycles': cycles, 'flux_batch_ms': batch * 1000, 'flux_rows_per_s': rows / batch,
+            'flux_update_ms': (time.perf_counter() - started) * 1000}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def load_previous(path: str, config: Dict) -> Dict:
+    if not os.path.exists(path):
+        return {}
+    previous = {}
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get('config') == config:
+                previous = record
+    return previous
+
+
+def report(results: Dict[str, float], previous: Dict):
+    old = previous.get('results', {})
+    if previous:
+        print(f"Compared with {previous['revision']} ({previous['timestamp']}):")
+    for name, value in results.items():
+        line = f"{name:40s} {value:14.2f}"
+        if old.get(name):
+            line += f"   {(value - old[name]) / abs(old[name]) * 100:+7.1f}%"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ingest, database, PLC polling, Dash callbacks and flux fitting")
+    parser.add_argument('--quick', action='store_true', help="short runs and a 2 day database")
+    parser.add_argument('--only', help=f"comma separated subset of {','.join(SECTIONS)}")
+    parser.add_argument('--plcs', type=int, default=50, help="number of simulated PLCs")
+    parser.add_argument('--results', default=RESULTS_FILE, help="JSON lines file the results are appended to")
+    parser.add_argument('--no-save', action='store_true', help="do not append to the results file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, force=True)
+
+    sections = args.only.split(',') if args.only else SECTIONS
+    config = {
+        'quick': args.quick, 'sections': sorted(sections), 'plcs': args.plcs,
+        'days': 2 if args.quick else 30, 'duration': 3.0 if args.quick else 10.0,
+        'repeat': 5 if args.quick else 20, 'write_rows': 20000 if args.quick else 200000,
+    }
+    results: Dict[str, float] = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for section in sections:
+            print(f"Running {section}...", file=sys.stderr)
+            started = time.perf_counter()
+            if section == 'write':
+                results.update(bench_write(workdir, config['write_rows']))
+            elif section == 'ingest':
+                results.update(bench_ingest(workdir, config['duration'], period=0.01, pipeline=4))
+            elif section == 'queries':
+                results.update(bench_queries(workdir, config['days'], config['repeat']))
+            elif section == 'plcs':
+                results.update(bench_plcs(workdir, args.plcs, config['duration'], interval=0.25, latency=0.005))
+            elif section == 'callbacks':
+                results.update(bench_callbacks(workdir, config['days'], config['repeat']))
+            elif section == 'flux':
+                results.update(bench_flux(workdir, config['days']))
+            else:
+                parser.error(f"Unknown section {section!r}")
+            results[f"{section}_seconds"] = time.perf_counter() - started
+            results[f"{section}_max_rss_mb"] = max_rss_mb()
+
+    previous = load_previous(args.results, config)
+    report(results, previous)
+    if not args.no_save:
+        if os.path.dirname(args.results):
+            os.makedirs(os.path.dirname(args.results), exist_ok=True)
+        record = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'revision': git_revision(),
+                  'python': platform.python_version(), 'config': config, 'results': results}
+        with open(args.results, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import hashlib
+import logging
+import threading
+import time
+from io import BytesIO
+from typing import Callable, List, Optional, Tuple
+
+import requests
+from flask import Response, request
+from PIL import Image
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+CAMERA_GRAB_SECONDS = metrics.histogram('hydrokum_camera_grab_seconds', "Camera snapshot fetch and re-encode time")
+CAMERA_ERRORS = metrics.counter('hydrokum_camera_errors_total', "Failed camera grabs")
+CAMERA_FRAME_AGE = metrics.gauge('hydrokum_camera_frame_age_seconds', "Age of the cached camera frame")
+
+
+class CameraGrabber:
+    """Fetches camera snapshots in the background and keeps the latest cropped JPEG.
+
+    One grabber serves every browser tab, so the camera is hit once per
+    ``interval`` no matter how many viewers there are, and a slow camera only
+    delays this thread.
+    """
+
+    def __init__(self, url: str, interval: float = 10.0, timeout: float = 10.0,
+                 crop: Tuple[int, int, int] = (190, 200, 250), quality: int = 80):
+        self.url = url
+        self.interval = interval
+        self.timeout = timeout
+        self.crop = crop  # pixels removed from top, bottom and left
+        self.quality = quality
+        self.frame: Optional[bytes] = None
+        self.etag: Optional[str] = None
+        self.updated = 0.0
+        self.errors = 0
+        self.subscribers: List[Callable[[str], None]] = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._session = requests.Session()
+        CAMERA_FRAME_AGE.set_function(lambda: time.time() - self.updated if self.updated else float('nan'))
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="camera-grabber", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def subscribe(self, callback: Callable[[str], None]):
+        """Register a callback, called with the new ETag whenever the frame changes."""
+        self.subscribers.append(callback)
+
+    def latest(self) -> Tuple[Optional[bytes], Optional[str]]:
+        """The last good frame and its ETag, or (None, None) before the first grab."""
+        with self._lock:
+            return self.frame, self.etag
+
+    def grab(self):
+        """Fetch, crop and re-encode one snapshot."""
+        # append a unique timestamp to the URL so no proxy serves a stale snapshot
+        response = self._session.get(f"{self.url}&t={time.time()}", timeout=self.timeout)
+        response.raise_for_status()
+        if "image" not in response.headers.get("Content-Type", "").lower():
+            raise ValueError("Invalid content received, expected an image")
+
+        img = Image.open(BytesIO(response.content))
+        top, bottom, left = self.crop
+        width, height = img.size
+        img_cropped = img.crop((left, top, width, height - bottom))
+
+        buffered = BytesIO()
+        img_cropped.convert("RGB").save(buffered, format="JPEG", quality=self.quality)
+        frame = buffered.getvalue()
+        etag = hashlib.sha1(frame).hexdigest()[:16]
+        with self._lock:
+            changed = etag != self.etag
+            self.frame, self.etag, self.updated = frame, etag, time.time()
+        if changed:
+            for callback in self.subscribers:
+                try:
+                    callback(etag)
+                except Exception as e:
+                    logger.error(f"Camera subscriber failed: {e}")
+
+    def _run(self):
+        while not self._stop.is_set():
+            started = time.monotonic()
+            try:
+                with CAMERA_GRAB_SECONDS.time():
+                    self.grab()
+            except (requests.RequestException, ValueError, IOError) as e:
+                self.errors += 1
+                CAMERA_ERRORS.inc()
+                logger.warning(f"Camera grab failed: {e}")
+            self._stop.wait(max(0.0, self.interval - (time.monotonic() - started)))
+
+
+class CameraFrameCache:
+    """The latest frame of a CameraGrabber in another process, fetched once per new ETag.
+
+    ``fetch`` returns (frame, etag), or (None, None) without a frame. Each
+    dashboard worker keeps one of these, and announce() is called with the
+    ETag of every new frame the grabber's owner publishes.
+    """
+
+    def __init__(self, fetch: Callable[[], Tuple[Optional[bytes], Optional[str]]]):
+        self.fetch = fetch
+        self.frame: Optional[bytes] = None
+        self.etag: Optional[str] = None
+        self.announced: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def announce(self, etag: str):
+        self.announced = etag
+
+    def latest(self) -> Tuple[Optional[bytes], Optional[str]]:
+        """The newest frame and its ETag, fetched if a newer one was announced or none is cached yet."""
+        with self._lock:
+            if self.etag is None or self.announced != self.etag:
+                wanted = self.announced
+                try:
+                    frame, etag = self.fetch()
+                except (ConnectionError, ValueError) as e:
+                    logger.debug(f"Camera frame unavailable: {e}")
+                else:
+                    if frame is not None:
+                        self.frame, self.etag = frame, etag
+                        # The fetched frame is at least as new as the announcement, unless another came meanwhile
+                        if self.announced == wanted:
+                            self.announced = etag
+            return self.frame, self.etag
+
+
+def register_camera_route(server, grabber, route: str = '/camera/latest.jpg'):
+    """Serve the cached frame of a CameraGrabber or CameraFrameCache, answering If-None-Match with 304."""
+
+    def camera_frame():
+        frame, etag = grabber.latest()
+        if frame is None:
+            return Response("No camera frame yet", status=503)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(frame, mimetype='image/jpeg')
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+        return response
+
+    server.add_url_rule(route, 'camera_frame', camera_frame)
+    return route
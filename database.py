@@ -1,101 +1,842 @@
+import argparse
+import atexit
 import logging
 import datetime
-import socket
+import heapq
+import os
+import queue
+import signal
+import sys
+import threading
 import time
 import sqlite3
+from contextlib import closing
 from sqlite3 import Error
-from typing import List, Tuple, Optional, Any
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple, Optional, Any
+
+import metrics
+from analyzer import AnalyzerClient
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+DB_COMMIT_SECONDS = metrics.histogram('hydrokum_db_commit_seconds', "Writer batch commit latency", ['db'])
+DB_ROWS_WRITTEN = metrics.counter('hydrokum_db_rows_written_total', "Rows committed by the writer", ['db'])
+DB_ROWS_DROPPED = metrics.counter('hydrokum_db_rows_dropped_total', "Rows the writer failed to commit", ['db'])
+DB_QUEUE_DEPTH = metrics.gauge('hydrokum_db_queue_depth', "Rows waiting for the writer", ['db'])
+DB_QUERY_SECONDS = metrics.histogram('hydrokum_db_query_seconds', "Read query latency", ['kind'])
+
+SCHEMA_VERSION = 7
+GAS_COLUMNS = ('N2O_ppm', 'CO2_ppm', 'CH4_ppm', 'NH3_ppb')
+
+# Times are stored as integer epoch milliseconds; data.time is the rowid so range scans walk the table in order
+SCHEMA = {
+    'data': '''CREATE TABLE IF NOT EXISTS data
+               (time INTEGER PRIMARY KEY, N2O_ppm real, CO2_ppm real, CH4_ppm real, NH3_ppb real)''',
+    'plc_history': '''CREATE TABLE IF NOT EXISTS plc_history
+                      (time INTEGER NOT NULL, ip_address text, event text)''',
+    'status_history': '''CREATE TABLE IF NOT EXISTS status_history
+                         (time INTEGER NOT NULL, ip_address text, status int)''',
+    # Rows of `table_name` older than `watermark` live in the Parquet archive (see archive.py)
+    'archive_state': '''CREATE TABLE IF NOT EXISTS archive_state
+                        (table_name text PRIMARY KEY, watermark INTEGER NOT NULL)''',
+}
+# Rollup table -> bucket width in ms. Each keeps min/max/sum/count per gas, so means
+# and longer periods can be derived without touching raw rows.
+ROLLUPS = {'data_1m': 60 * 1000, 'data_1h': 60 * 60 * 1000}
+ROLLUP_STATS = ('min', 'max', 'sum', 'count')
+ROLLUP_COLUMNS = [f"{gas}_{stat}" for gas in GAS_COLUMNS for stat in ROLLUP_STATS]
+# Range queries at this resolution (ms) or coarser are answered from the rollups
+MIN_ROLLUP_RESOLUTION = min(ROLLUPS.values())
+for _table in ROLLUPS:
+    SCHEMA[_table] = (f"CREATE TABLE IF NOT EXISTS {_table} (bucket INTEGER PRIMARY KEY, "
+                      + ", ".join(f"{col} {'INTEGER' if col.endswith('count') else 'real'}" for col in ROLLUP_COLUMNS)
+                      + ")")
+
+# Per-cycle concentration slopes from flux.py: one row per chamber closure measured by the analyzer.
+# time/end_time bound the cycle; slopes are per hour over the fit window, intercepts at its start.
+FLUX_STATS = ('slope', 'intercept', 'r2')
+FLUX_COLUMNS = [f"{gas}_{stat}" for gas in GAS_COLUMNS for stat in FLUX_STATS]
+SCHEMA['flux'] = ("CREATE TABLE IF NOT EXISTS flux (time INTEGER NOT NULL, chamber text NOT NULL, "
+                  "end_time INTEGER NOT NULL, samples INTEGER, "
+                  + ", ".join(f"{col} real" for col in FLUX_COLUMNS) + ", PRIMARY KEY (chamber, time))")
+
+# One row per stretch a status bit was set, maintained from status_history as it is written.
+# end_time is NULL while the bit is still set; a lost connection ends every open interval of the PLC.
+SCHEMA['status_intervals'] = '''CREATE TABLE IF NOT EXISTS status_intervals
+                                (ip_address text NOT NULL, bit INTEGER NOT NULL, start INTEGER NOT NULL,
+                                 end_time INTEGER)'''
+STATUS_WORD_BITS = 16
+# Alert rule transitions from alerts.py; state is 'raised' or 'cleared', limit what the value was compared with
+SCHEMA['alerts'] = '''CREATE TABLE IF NOT EXISTS alerts
+                      (time INTEGER NOT NULL, rule text, gas text, state text, value real, limit_value real)'''
+
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_plc_history_ip_time ON plc_history (ip_address, time)",
+    "CREATE INDEX IF NOT EXISTS idx_status_history_ip_time ON status_history (ip_address, time, status)",
+    "CREATE INDEX IF NOT EXISTS idx_status_history_time ON status_history (time)",
+    "CREATE INDEX IF NOT EXISTS idx_flux_time ON flux (time)",
+    "CREATE INDEX IF NOT EXISTS idx_alerts_time ON alerts (time)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_status_intervals ON status_intervals (ip_address, bit, start)",
+    "CREATE INDEX IF NOT EXISTS idx_status_intervals_open ON status_intervals (ip_address) WHERE end_time IS NULL",
+]
+
+INSERT_DATA_SQL = "INSERT OR IGNORE INTO data (time, N2O_ppm, CO2_ppm, CH4_ppm, NH3_ppb) VALUES (?, ?, ?, ?, ?)"
+INSERT_STATUS_SQL = "INSERT INTO status_history (time, ip_address, status) VALUES (?, ?, ?)"
+INSERT_PLC_HISTORY_SQL = "INSERT INTO plc_history (time, ip_address, event) VALUES (?, ?, ?)"
+INSERT_ALERT_SQL = "INSERT INTO alerts (time, rule, gas, state, value, limit_value) VALUES (?, ?, ?, ?, ?, ?)"
+CONNECTION_LOST_EVENT = "Connection lost"
+DISCONNECTED_EVENT = "Disconnected"
+# plc_history events after which a PLC's status is unknown until it is read again
+STATUS_UNKNOWN_EVENTS = (CONNECTION_LOST_EVENT, DISCONNECTED_EVENT)
+
+_STOP = object()
+
+
+def _rollup_upsert_sql(table: str) -> str:
+    updates = []
+    for gas in GAS_COLUMNS:
+        for stat in ('min', 'max'):
+            col = f"{gas}_{stat}"
+            # Scalar min()/max() return NULL if either side is NULL
+            updates.append(f"{col} = {stat}(coalesce({col}, excluded.{col}), coalesce(excluded.{col}, {col}))")
+        for stat in ('sum', 'count'):
+            col = f"{gas}_{stat}"
+            updates.append(f"{col} = coalesce({col}, 0) + coalesce(excluded.{col}, 0)")
+    return (f"INSERT INTO {table} (bucket, {', '.join(ROLLUP_COLUMNS)}) "
+            f"VALUES ({', '.join('?' * (len(ROLLUP_COLUMNS) + 1))}) "
+            f"ON CONFLICT(bucket) DO UPDATE SET {', '.join(updates)}")
+
+
+ROLLUP_UPSERT_SQL = {table: _rollup_upsert_sql(table) for table in ROLLUPS}
+
+
+def rollup_source(resolution: int) -> Tuple[int, str]:
+    """(width, table) of the coarsest rollup not coarser than ``resolution`` ms."""
+    usable = [(width, table) for table, width in ROLLUPS.items() if width <= resolution]
+    if not usable:
+        raise ValueError(f"Resolution {resolution} ms is finer than the finest rollup")
+    return max(usable)
+
+
+def rollup_resolution(resolution: int) -> int:
+    """``resolution`` rounded up to a whole number of buckets of the rollup it is read from."""
+    width, _ = rollup_source(resolution)
+    return -(-resolution // width) * width
+
+
+def aggregate_rows(rows: List[Tuple], width: int) -> List[Tuple]:
+    """Fold (time, *gases) rows into (bucket, min, max, sum, count per gas) rows."""
+    buckets: Dict[int, List] = {}
+    for row in rows:
+        bucket = row[0] - row[0] % width
+        stats = buckets.get(bucket)
+        if stats is None:
+            stats = buckets[bucket] = [None, None, 0.0, 0] * len(GAS_COLUMNS)
+        for i, value in enumerate(row[1:]):
+            if value is None:
+                continue
+            j = i * 4
+            stats[j] = value if stats[j] is None else min(stats[j], value)
+            stats[j + 1] = value if stats[j + 1] is None else max(stats[j + 1], value)
+            stats[j + 2] += value
+            stats[j + 3] += 1
+    return [(bucket, *stats) for bucket, stats in buckets.items()]
+
+
+def apply_status_changes(conn: sqlite3.Connection, changes: Iterable[Tuple[int, str, Optional[int]]]) -> None:
+    """Open and close status_intervals rows for (time, ip_address, status) changes in time order.
+
+    A status of None means the PLC stopped answering and ends all its open intervals.
+    """
+    open_bits: Dict[str, set] = {}
+    for change_time, ip_address, status in changes:
+        if ip_address not in open_bits:
+            open_bits[ip_address] = {bit for (bit,) in conn.execute(
+                "SELECT bit FROM status_intervals WHERE ip_address = ? AND end_time IS NULL", (ip_address,))}
+        was_set = open_bits[ip_address]
+        now_set = {bit for bit in range(STATUS_WORD_BITS) if status >> bit & 1} if status is not None else set()
+        conn.executemany("UPDATE status_intervals SET end_time = ? WHERE ip_address = ? AND bit = ? "
+                         "AND end_time IS NULL", [(change_time, ip_address, bit) for bit in was_set - now_set])
+        conn.executemany("INSERT OR IGNORE INTO status_intervals (ip_address, bit, start) VALUES (?, ?, ?)",
+                         [(ip_address, bit, change_time) for bit in now_set - was_set])
+        open_bits[ip_address] = now_set
+
+
+def now_ms() -> int:
+    """Current time as epoch milliseconds."""
+    return int(time.time() * 1000)
+
+
+def to_epoch_ms(value: Any) -> Optional[int]:
+    """Convert an ISO string, datetime or number to epoch milliseconds.
+
+    Numbers are taken to already be epoch milliseconds. Naive datetimes and
+    strings are local time, as written by ``str(datetime.now())``.
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        try:
+            value = datetime.datetime.fromisoformat(value.strip())
+        except ValueError:
+            return None
+    if isinstance(value, datetime.datetime):
+        return int(value.timestamp() * 1000)
+    if isinstance(value, datetime.date):
+        return int(datetime.datetime.combine(value, datetime.time()).timestamp() * 1000)
+    raise TypeError(f"Cannot convert {value!r} to epoch milliseconds")
+
+
+class DatabaseWriter:
+    """Owns one long-lived WAL connection and commits queued writes in groups.
+
+    Callers only put (sql, params) on a queue, so the PLC status threads and the
+    analyzer loop never wait on SQLite. A batch is committed when it reaches
+    ``batch_size`` rows or when its oldest row is ``flush_interval`` seconds old.
+    """
+
+    def __init__(self, db_name: str, batch_size: int = 200, flush_interval: float = 0.5,
+                 slow_commit: float = 1.0):
+        self.db_name = db_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.slow_commit = slow_commit
+        self.queue: "queue.Queue[Any]" = queue.Queue()
+        # Called as hook(conn, rows) inside the same transaction after `sql` is written
+        self.hooks: Dict[str, Callable[[sqlite3.Connection, List[Tuple]], None]] = {}
+        # Rows the statement before a hook actually changed; fewer than it was given when INSERT OR IGNORE skips some
+        self.changes = 0
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._closed = False
+
+        self.commits = 0
+        self.rows_written = 0
+        self.errors = 0
+        self.last_commit_latency = 0.0
+        self.max_commit_latency = 0.0
+        self._total_commit_latency = 0.0
+        DB_QUEUE_DEPTH.set_function(self.queue.qsize, db=db_name)
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            if self._thread is None:
+                atexit.register(self.close)
+            self._closed = False
+            self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+            self._thread.start()
+
+    def submit(self, sql: str, params: Tuple) -> None:
+        """Queue one row for writing."""
+        if self._closed:
+            # Late writes during shutdown go straight to disk instead of being lost
+            logger.warning("Writer closed, writing row synchronously.")
+            with closing(sqlite3.connect(self.db_name, timeout=30)) as conn:
+                self._commit(conn, [(sql, params)])
+            return
+        self.start()
+        self.queue.put((sql, params))
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Block until everything queued before this call is committed."""
+        if self._thread is None or not self._thread.is_alive():
+            return True
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout: float = 10.0) -> None:
+        """Flush pending rows and stop the writer thread."""
+        with self._lock:
+            if self._closed or self._thread is None:
+                return
+            self._closed = True
+        self.queue.put(_STOP)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.error(f"Writer did not stop within {timeout}s, {self.queue.qsize()} rows pending.")
+
+    def stats(self) -> Dict[str, float]:
+        """Queue depth and commit latency figures for monitoring."""
+        return {
+            'queue_depth': self.queue.qsize(),
+            'commits': self.commits,
+            'rows_written': self.rows_written,
+            'errors': self.errors,
+            'last_commit_ms': self.last_commit_latency * 1000,
+            'avg_commit_ms': (self._total_commit_latency / self.commits * 1000) if self.commits else 0.0,
+            'max_commit_ms': self.max_commit_latency * 1000,
+        }
+
+    def _run(self) -> None:
+        conn = sqlite3.connect(self.db_name, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        batch: List[Tuple[str, Tuple]] = []
+        waiters: List[threading.Event] = []
+        deadline = 0.0
+        stop = False
+        try:
+            while not stop:
+                timeout = max(0.0, deadline - time.monotonic()) if batch else None
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    item = None
+
+                if item is _STOP:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                elif item is not None:
+                    if not batch:
+                        deadline = time.monotonic() + self.flush_interval
+                    batch.append(item)
+
+                if batch and (stop or waiters or len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                    self._commit(conn, batch)
+                    batch = []
+                for waiter in waiters:
+                    waiter.set()
+                waiters = []
+        finally:
+            conn.close()
+
+    def _commit(self, conn: sqlite3.Connection, batch: List[Tuple[str, Tuple]]) -> None:
+        start = time.perf_counter()
+        # Group consecutive rows sharing a statement so ordering between tables is kept
+        groups: List[Tuple[str, List[Tuple]]] = []
+        for sql, params in batch:
+            if groups and groups[-1][0] == sql:
+                groups[-1][1].append(params)
+            else:
+                groups.append((sql, [params]))
+        try:
+            with conn:
+                for sql, rows in groups:
+                    self.changes = conn.executemany(sql, rows).rowcount
+                    if sql in self.hooks:
+                        self.hooks[sql](conn, rows)
+        except Exception as e:
+            # Hooks may raise anything (a bad status value, say); only the offending row may be lost
+            logger.error(f"Batch commit of {len(batch)} rows failed, retrying row by row: {e!r}")
+            self._commit_rows(conn, batch)
+        else:
+            self.rows_written += len(batch)
+            DB_ROWS_WRITTEN.inc(len(batch), db=self.db_name)
+
+        latency = time.perf_counter() - start
+        DB_COMMIT_SECONDS.observe(latency, db=self.db_name)
+        self.commits += 1
+        self.last_commit_latency = latency
+        self._total_commit_latency += latency
+        self.max_commit_latency = max(self.max_commit_latency, latency)
+        if latency > self.slow_commit:
+            logger.warning(f"Slow commit: {len(batch)} rows in {latency * 1000:.0f} ms, "
+                           f"queue depth {self.queue.qsize()}")
+
+    def _commit_rows(self, conn: sqlite3.Connection, batch: List[Tuple[str, Tuple]]) -> None:
+        for sql, params in batch:
+            try:
+                with conn:
+                    self.changes = conn.execute(sql, params).rowcount
+                    if sql in self.hooks:
+                        self.hooks[sql](conn, [params])
+                self.rows_written += 1
+                DB_ROWS_WRITTEN.inc(db=self.db_name)
+            except Exception as e:
+                self.errors += 1
+                DB_ROWS_DROPPED.inc(db=self.db_name)
+                logger.error(f"Dropped row {params}: {e!r}")
+
+
 class Database:
-    def __init__(self, db_name: str):
+    def __init__(self, db_name: str, batch_size: int = 200, flush_interval: float = 0.5,
+                 archive_dir: Optional[str] = None, live: Optional[Any] = None):
         self.db_name = db_name
+        self.archive_dir = archive_dir
+        # ringbuffer.LiveBuffer of the newest rows shared by the ingest process; read before SQLite
+        self.live = live
         self.logger = logger  # Initialize logger
+        self.writer = DatabaseWriter(db_name, batch_size, flush_interval)
+        self.writer.hooks[INSERT_DATA_SQL] = self._update_rollups
+        self.writer.hooks[INSERT_STATUS_SQL] = apply_status_changes
+        self.writer.hooks[INSERT_PLC_HISTORY_SQL] = self._close_status_intervals
+
     def create_connection(self) -> Optional[sqlite3.Connection]:
         try:
-            conn = sqlite3.connect(self.db_name)
+            conn = sqlite3.connect(self.db_name, timeout=30)
             return conn
         except Error as e:
             print(e)
         return None
 
     def create_table(self) -> None:
-        conn = self.create_connection()
+        """Create the tables, migrating an older database in place if needed."""
         try:
-            with conn:
-                conn.execute('''CREATE TABLE IF NOT EXISTS data
-                             (time text, N2O_ppm real, CO2_ppm real, CH4_ppm real, NH3_ppb real)''')
-                conn.execute('''CREATE TABLE IF NOT EXISTS plc_history
-                             (time text, ip_address text, event text)''')
-                conn.execute('''CREATE TABLE IF NOT EXISTS status_history
-                             (time text, ip_address text, status int)''')
+            self.migrate()
         except Error as e:
             logger.error(f"Failed to create table: {e}")
 
-    def insert_status_change(self, data: List) -> None:
+    def migrate(self) -> int:
+        """Bring the schema up to SCHEMA_VERSION and return the version found.
+
+        Older databases stored time as free-form text. Those tables are renamed,
+        copied into the new layout with the text converted to epoch milliseconds
+        and dropped, all in one transaction.
+        """
         conn = self.create_connection()
-        if conn is None:
-            logger.error("Database connection failed for status change.")
-            return
-        try:
-            with conn:
-                conn.execute("INSERT INTO status_history (time, ip_address, status) VALUES (?, ?, ?)", data)
-        except Error as e:
-            logger.error(f"Failed to insert status change: {e}")
-    def insert_plc_history(self, data: List) -> None:
+        with closing(conn):
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.isolation_level = None
+            conn.create_function("to_epoch_ms", 1, to_epoch_ms, deterministic=True)
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                if version < SCHEMA_VERSION:
+                    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+                    for table, ddl in SCHEMA.items():
+                        if table not in existing:
+                            conn.execute(ddl)
+                        elif version < 2:
+                            self._migrate_table(conn, table, ddl)
+                    for ddl in INDEXES:
+                        conn.execute(ddl)
+                    if version < 3:
+                        self._build_rollups(conn)
+                    if version < 6:
+                        self._build_status_intervals(conn)
+                    conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+                conn.execute("COMMIT")
+            except Error:
+                conn.execute("ROLLBACK")
+                raise
+        if version < SCHEMA_VERSION:
+            logger.info(f"Migrated {self.db_name} from schema version {version} to {SCHEMA_VERSION}")
+        return version
+
+    def _migrate_table(self, conn: sqlite3.Connection, table: str, ddl: str) -> None:
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+        old = f"{table}_v1"
+        conn.execute(f"ALTER TABLE {table} RENAME TO {old}")
+        conn.execute(ddl)
+        rest = ", ".join(columns[1:])
+        before = conn.execute(f"SELECT count(*) FROM {old}").fetchone()[0]
+        # Rows whose time cannot be parsed are dropped; duplicate data timestamps keep the first row
+        conn.execute(f"""INSERT OR IGNORE INTO {table} ({", ".join(columns)})
+                         SELECT t, {rest} FROM (SELECT to_epoch_ms(time) AS t, {rest} FROM {old})
+                         WHERE t IS NOT NULL ORDER BY t""")
+        after = conn.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+        conn.execute(f"DROP TABLE {old}")
+        logger.info(f"Migrated {after} rows of {table}, skipped {before - after}")
+
+    def _build_rollups(self, conn: sqlite3.Connection, start: int = 0, end: int = sys.maxsize) -> None:
+        """Recompute the rollup buckets overlapping [start, end) from the raw data.
+
+        Rows older than the archive watermark are read from the Parquet archive,
+        as they may have been pruned from SQLite; without the archive, buckets
+        before the watermark are left as they are.
+        """
+        watermark = self._archive_watermark(conn, 'data')
+        archived = watermark is not None and self.archive_dir is not None and os.path.isdir(self.archive_dir)
+        if watermark is not None and not archived:
+            start = max(start, watermark)
+            if start >= end:
+                return
+        finest = None
+        for table, width in sorted(ROLLUPS.items(), key=lambda item: item[1]):
+            lo, hi = start - start % width, end - end % width + width if end < sys.maxsize else end
+            conn.execute(f"DELETE FROM {table} WHERE bucket >= ? AND bucket < ?", (lo, hi))
+            if finest is None:
+                stats = ", ".join(f"{stat}({gas})" if stat != 'sum' else f"total({gas})"
+                                  for gas in GAS_COLUMNS for stat in ROLLUP_STATS)
+                source, key = "data", "time"
+                if archived and lo < watermark:
+                    from archive import read_range
+                    # The watermark is a day boundary, so no bucket is split between archive and SQLite
+                    for rows in read_range(self.archive_dir, 'data', lo, min(hi, watermark)):
+                        conn.executemany(ROLLUP_UPSERT_SQL[table], aggregate_rows(rows, width))
+                    lo = max(lo, watermark)
+            else:
+                # Coarser rollups are built from the finer one instead of the raw rows
+                stats = ", ".join(f"{'sum' if stat == 'count' else 'total' if stat == 'sum' else stat}({gas}_{stat})"
+                                  for gas in GAS_COLUMNS for stat in ROLLUP_STATS)
+                source, key = finest, "bucket"
+            conn.execute(f"""INSERT INTO {table} (bucket, {', '.join(ROLLUP_COLUMNS)})
+                             SELECT {key} - {key} % {width}, {stats} FROM {source}
+                             WHERE {key} >= ? AND {key} < ? GROUP BY 1""", (lo, hi))
+            finest = table
+
+    def backfill_rollups(self, start: Any = None, end: Any = None) -> None:
+        """Rebuild the rollup tables from raw data, for all time or a range."""
+        self.flush()
         conn = self.create_connection()
-        if conn is None:
-            logger.error("Database connection failed for history write.")
-            return
-        try:
-            with conn:
-                conn.execute("INSERT INTO plc_history (time, ip_address, event) VALUES (?, ?, ?)", data)
-        except Error as e:
-            logger.error(f"Failed to insert history: {e}")
+        with closing(conn), conn:
+            self._build_rollups(conn, to_epoch_ms(start) or 0, to_epoch_ms(end) or sys.maxsize)
 
-    def insert_data(self, data: List) -> None:
+    def _build_status_intervals(self, conn: sqlite3.Connection) -> None:
+        """Replay status_history and connection losses into status_intervals.
+
+        History older than the archive watermarks is read from the Parquet
+        archive, as it may have been pruned from SQLite; without the archive,
+        intervals that started before the watermarks are kept and only the later
+        history is replayed.
+        """
+        archived = self.archive_dir is not None and os.path.isdir(self.archive_dir)
+        watermarks = [watermark for watermark in (self._archive_watermark(conn, table)
+                                                  for table in ('status_history', 'plc_history'))
+                      if watermark is not None]
+        start = 0
+        if watermarks and not archived:
+            start = max(watermarks)
+            # Intervals still open at `start` are reopened; the replay closes them again
+            conn.execute("DELETE FROM status_intervals WHERE start >= ?", (start,))
+            conn.execute("UPDATE status_intervals SET end_time = NULL WHERE end_time >= ?", (start,))
+        else:
+            conn.execute("DELETE FROM status_intervals")
+        losses = ((row[0], row[1], None) for row in self._history_rows(conn, 'plc_history', start, archived)
+                  if row[2] in STATUS_UNKNOWN_EVENTS)
+        apply_status_changes(conn, heapq.merge(self._history_rows(conn, 'status_history', start, archived), losses,
+                                               key=lambda row: row[0]))
+
+    def _history_rows(self, conn: sqlite3.Connection, table: str, start: int, archived: bool) -> Iterator[Tuple]:
+        """Rows of status_history or plc_history from ``start`` on in time order, pruned days from the archive."""
+        watermark = self._archive_watermark(conn, table)
+        if archived and watermark is not None and start < watermark:
+            from archive import read_range
+            for rows in read_range(self.archive_dir, table, start, watermark):
+                yield from rows
+            start = watermark
+        yield from conn.execute(f"SELECT time, ip_address, {'status' if table == 'status_history' else 'event'} "
+                                f"FROM {table} WHERE time >= ? ORDER BY time", (start,))
+
+    def rebuild_status_intervals(self) -> None:
+        """Recreate the status_intervals table from the recorded history."""
+        self.flush()
         conn = self.create_connection()
-        if conn is None:
-            logger.error("Database connection failed for data write.")
+        with closing(conn), conn:
+            self._build_status_intervals(conn)
+
+    def _close_status_intervals(self, conn: sqlite3.Connection, rows: List[Tuple]) -> None:
+        # Runs in the writer thread; the status of a PLC that was disconnected or stopped answering is unknown
+        # until it is back
+        apply_status_changes(conn, [(row[0], row[1], None) for row in rows if row[2] in STATUS_UNKNOWN_EVENTS])
+
+    def _update_rollups(self, conn: sqlite3.Connection, rows: List[Tuple]) -> None:
+        # Runs in the writer thread, inside the transaction that inserted `rows`
+        if self.writer.changes != len(rows):
+            # Rows already stored were ignored and must not be counted twice: recount their buckets from data
+            times = [row[0] for row in rows]
+            self._build_rollups(conn, min(times), max(times) + 1)
             return
-        try:
-            with conn:
-                conn.execute("INSERT INTO data (time, N2O_ppm, CO2_ppm, CH4_ppm, NH3_ppb) VALUES (?, ?, ?, ?, ?)", data)
-        except Error as e:
-            logger.error(f"Failed to insert status change: {e}")
+        for table, width in ROLLUPS.items():
+            conn.executemany(ROLLUP_UPSERT_SQL[table], aggregate_rows(rows, width))
+
+    def _submit(self, sql: str, data: List) -> None:
+        row_time = to_epoch_ms(data[0])
+        if row_time is None:
+            # A NULL time is a distinct key to SQLite, so the row would be stored but never read back
+            logger.error(f"Dropped row {data}: invalid time {data[0]!r}")
+            return
+        self.writer.submit(sql, (row_time, *data[1:]))
+
+    def insert_status_change(self, data: List) -> None:
+        self._submit(INSERT_STATUS_SQL, data)
+
+    def insert_plc_history(self, data: List) -> None:
+        self._submit(INSERT_PLC_HISTORY_SQL, data)
+
+    def insert_alert(self, data: List) -> None:
+        self._submit(INSERT_ALERT_SQL, data)
+
+    def insert_data(self, data: List) -> None:
+        self._submit(INSERT_DATA_SQL, data)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until all queued inserts are committed."""
+        return self.writer.flush(timeout)
+
+    def close(self) -> None:
+        """Flush queued inserts and stop the writer."""
+        self.writer.close()
+
+    def stats(self) -> Dict[str, float]:
+        return self.writer.stats()
+
+    def query_data(self, last_plotted_time: Any = None, lim: int = 1000,
+                   start: Any = None, end: Any = None, resolution: Optional[int] = None) -> List[Tuple]:
+        """Return data rows oldest first, with time in epoch milliseconds.
+
+        With ``start``/``end`` the half-open range [start, end) is returned, with
+        ``last_plotted_time`` every row after it, and otherwise the newest ``lim``
+        rows. Times may be epoch milliseconds, datetimes or ISO strings.
 
-    def query_data(self, last_plotted_time: Optional[str] = None, lim: int = 1000) -> List[Tuple]:
+        A range query with a ``resolution`` (ms) of a minute or more returns one
+        row of mean values per ``resolution`` bucket, read from the rollups;
+        query_summary has the minima and maxima as well.
+        """
+        if resolution is not None and resolution >= MIN_ROLLUP_RESOLUTION and last_plotted_time is None:
+            return [(row[0], *row[2::3]) for row in self.query_summary(start, end, resolution)]
+        buffer = self.live.get() if self.live is not None else None
+        if buffer is not None:
+            with DB_QUERY_SECONDS.time(kind='live'):
+                rows = self._query_live(buffer, last_plotted_time, lim, start, end)
+            if rows is not None:
+                return rows
+        if start is not None or end is not None:
+            with DB_QUERY_SECONDS.time(kind='range'):
+                return [row for chunk in self.iter_data(start, end) for row in chunk]
         conn = self.create_connection()
-        with conn:
+        with closing(conn), conn, DB_QUERY_SECONDS.time(kind='since' if last_plotted_time is not None else 'latest'):
             cur = conn.cursor()
-            if last_plotted_time is None:
-                cur.execute(f"SELECT * FROM data ORDER BY time DESC LIMIT {lim}")
+            if last_plotted_time is not None:
+                cur.execute("SELECT * FROM data WHERE time > ? ORDER BY time ASC", (to_epoch_ms(last_plotted_time),))
             else:
-                cur.execute("SELECT * FROM data WHERE time > ? ORDER BY time ASC", (last_plotted_time,))
+                cur.execute("SELECT * FROM (SELECT * FROM data ORDER BY time DESC LIMIT ?) ORDER BY time ASC", (lim,))
             return cur.fetchall()
 
+    def latest_time(self) -> Optional[int]:
+        """Time of the newest data row, which versions everything plotted from the data."""
+        buffer = self.live.get() if self.live is not None else None
+        if buffer is not None and buffer.head:
+            return int(buffer.latest(1)[0][0])
+        conn = self.create_connection()
+        with closing(conn), DB_QUERY_SECONDS.time(kind='latest_time'):
+            return conn.execute("SELECT max(time) FROM data").fetchone()[0]
 
-def main():
-    HOST = '10.0.20.3'
-    PORT = 51020
-    db = Database('my_database.sqlite')
-    db.create_table()
+    def iter_data(self, start: Any = None, end: Any = None, chunk_size: int = 50000) -> Iterator[List[Tuple]]:
+        """Yield the data rows in [start, end) oldest first, ``chunk_size`` rows at a time."""
+        return self.iter_rows('data', start, end, chunk_size)
+
+    def iter_rows(self, table: str, start: Any = None, end: Any = None,
+                  chunk_size: int = 50000) -> Iterator[List[Tuple]]:
+        """Yield rows of data, status_history or plc_history in [start, end) in time order.
+
+        With an ``archive_dir``, the part of the range older than the table's
+        archive watermark is read from the Parquet partitions and the rest from
+        SQLite, so pruned history stays queryable.
+        """
+        start = to_epoch_ms(start) if start is not None else 0
+        end = to_epoch_ms(end) if end is not None else sys.maxsize
+        watermark = self.archive_watermark(table) if self.archive_dir else None
+        if watermark is not None and start < watermark:
+            from archive import read_range
+            yield from read_range(self.archive_dir, table, start, min(end, watermark), chunk_size)
+            start = watermark
+        if start >= end:
+            return
+        conn = self.create_connection()
+        with closing(conn):
+            cur = conn.execute(f"SELECT * FROM {table} WHERE time >= ? AND time < ? ORDER BY time ASC",
+                               (start, end))
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+
+    def archive_watermark(self, table: str) -> Optional[int]:
+        """Epoch ms before which rows of `table` have been archived, or None."""
+        conn = self.create_connection()
+        with closing(conn):
+            return self._archive_watermark(conn, table)
+
+    @staticmethod
+    def _archive_watermark(conn: sqlite3.Connection, table: str) -> Optional[int]:
+        try:
+            row = conn.execute("SELECT watermark FROM archive_state WHERE table_name = ?", (table,)).fetchone()
+        except Error:
+            return None
+        return row[0] if row else None
+
+    def _query_live(self, buffer, last_plotted_time: Any, lim: int, start: Any, end: Any) -> Optional[List[Tuple]]:
+        """Answer query_data from the shared ring buffer, or None if it does not reach back far enough.
 
-    while True:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((HOST, PORT))
-            s.sendall(b"_Meas_GetConc\r")
-            data = s.recv(1024).decode('utf-8')
+        A range starting before the buffer reads only the older part from SQLite.
+        """
+        from ringbuffer import to_rows
+
+        oldest = buffer.oldest_time()
+        if oldest is None:
+            return None
+        if last_plotted_time is None and start is None and end is None:
+            if min(buffer.head, buffer.capacity) < lim:
+                return None
+            return to_rows(*buffer.latest(lim))
+        if last_plotted_time is not None:
+            # Integer ms times, so "after t" is the range starting at t + 1
+            start, end = to_epoch_ms(last_plotted_time) + 1, None
+        else:
+            start, end = to_epoch_ms(start) if start is not None else 0, to_epoch_ms(end) if end is not None else None
+        rows = to_rows(*buffer.read(start=max(start, oldest), end=end))
+        if start < oldest:
+            # The buffer may hold rows SQLite has not committed yet, so split at its oldest row
+            older = [row for chunk in self.iter_data(start, oldest if end is None else min(end, oldest))
+                     for row in chunk]
+            rows = older + rows
+        return rows
+
+    def status_intervals(self, ip_address: str, bits: Optional[Iterable[int]] = None, start: Any = None,
+                         end: Any = None) -> List[Tuple[int, int, Optional[int]]]:
+        """(bit, start, end_time) of the intervals overlapping [start, end), by start time.
+
+        end_time is None while the bit is still set. Intervals of one bit never
+        overlap, so besides an index range scan only the last interval starting
+        before ``start`` has to be looked up per bit.
+        """
+        start = to_epoch_ms(start) if start is not None else 0
+        end = to_epoch_ms(end) if end is not None else sys.maxsize
+        bits = list(bits) if bits is not None else range(STATUS_WORD_BITS)
+        conn = self.create_connection()
+        with closing(conn), DB_QUERY_SECONDS.time(kind='intervals'):
+            rows = []
+            for bit in bits:
+                earlier = conn.execute("""SELECT bit, start, end_time FROM status_intervals
+                                          WHERE ip_address = ? AND bit = ? AND start < ?
+                                          ORDER BY start DESC LIMIT 1""", (ip_address, bit, start)).fetchone()
+                if earlier and (earlier[2] is None or earlier[2] > start):
+                    rows.append(earlier)
+                rows += conn.execute("""SELECT bit, start, end_time FROM status_intervals
+                                        WHERE ip_address = ? AND bit = ? AND start >= ? AND start < ?
+                                        ORDER BY start""", (ip_address, bit, start, end)).fetchall()
+        return sorted(rows, key=lambda row: row[1])
 
-        values = data.strip().split(';')
-        values_to_plot = [float(values[2]), float(values[7]), float(values[9]), float(values[12])]
+    def status_durations(self, ip_address: str, start: Any, end: Any = None,
+                         bits: Optional[Iterable[int]] = None) -> Dict[int, Tuple[int, int]]:
+        """bit -> (ms it was set within [start, end), times it was set in that range)."""
+        start = to_epoch_ms(start)
+        end = to_epoch_ms(end) if end is not None else now_ms()
+        totals: Dict[int, Tuple[int, int]] = {}
+        for bit, begin, finish in self.status_intervals(ip_address, bits, start, end):
+            duration, count = totals.get(bit, (0, 0))
+            overlap = min(finish if finish is not None else end, end) - max(begin, start)
+            totals[bit] = (duration + max(overlap, 0), count + (begin >= start))
+        return totals
+
+    def query_summary(self, start: Any = None, end: Any = None, resolution: int = 60 * 1000) -> List[Tuple]:
+        """Return (bucket, then min, mean, max per gas) rows for [start, end) from the rollups.
+
+        Gases without samples in a bucket have None for all three.
+        """
+        width = len(ROLLUP_STATS)
+        rows = []
+        for row in self.query_rollup(start, end, resolution):
+            summary = [row[0]]
+            for i in range(len(GAS_COLUMNS)):
+                low, high, total, count = row[1 + i * width:1 + (i + 1) * width]
+                summary += [low, total / count, high] if count else [None, None, None]
+            rows.append(tuple(summary))
+        return rows
+
+    def query_rollup(self, start: Any = None, end: Any = None, resolution: int = 60 * 60 * 1000) -> List[Tuple]:
+        """Return (bucket, min, max, sum, count per gas) rows for [start, end).
+
+        Reads the coarsest rollup table not coarser than ``resolution`` and
+        merges its buckets into ``resolution``-wide buckets aligned to the epoch
+        (UTC), e.g. 86400000 for daily summaries. ``resolution`` is rounded up
+        to a multiple of that table's width (see rollup_resolution). Columns
+        follow ROLLUP_COLUMNS.
+        """
+        width, table = rollup_source(resolution)
+        # A whole number of source buckets in each output bucket, so the output is evenly spaced
+        resolution = rollup_resolution(resolution)
+        stats = ", ".join(f"{'sum' if stat == 'count' else 'total' if stat == 'sum' else stat}({gas}_{stat})"
+                          for gas in GAS_COLUMNS for stat in ROLLUP_STATS)
+        conn = self.create_connection()
+        with closing(conn), conn, DB_QUERY_SECONDS.time(kind='rollup'):
+            return conn.execute(f"""SELECT bucket - bucket % ?, {stats} FROM {table}
+                                    WHERE bucket >= ? AND bucket < ? GROUP BY 1 ORDER BY 1""",
+                                (resolution, to_epoch_ms(start) or 0,
+                                 to_epoch_ms(end) if end is not None else sys.maxsize)).fetchall()
+
+
+def run_analyzer(db: Database, host: str = '10.0.20.3', port: int = 51020, period: float = 5.0,
+                 pipeline_depth: int = 1, live: Optional[Any] = None, alerts: Optional[Any] = None) -> None:
+    """Poll the analyzer into the database, the ``live`` SharedRingBuffer and the ``alerts`` AlertEngine."""
+    client = AnalyzerClient(host, port)
+    # main.py stops us with SIGTERM; exit normally so queued rows are flushed
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    def store(sample_time: int, values: List[float]) -> None:
         # Insert new data into the database
-        db.insert_data([str(datetime.datetime.now())] + values_to_plot)
-        logger.info(f"Inserted data: {values_to_plot}")
-        # Sleep for 5 seconds
-        time.sleep(5)
+        db.insert_data([sample_time] + values)
+        if live is not None:
+            live.append(sample_time, values)
+        if alerts is not None:
+            alerts.update(sample_time, values)
+        logger.info(f"Inserted data: {values}")
+
+    try:
+        client.poll(store, period, pipeline_depth)
+    finally:
+        client.stop()
+        db.close()
+        if live is not None:
+            live.close()
+        logger.info(f"Analyzer stopped: {client.samples} samples, {client.missed_ticks} missed ticks, "
+                    f"{client.reconnects} reconnects. Database writer: {db.stats()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gas analyzer ingest and database maintenance")
+    parser.add_argument('--db', default='my_database.sqlite', help="SQLite database file")
+    parser.add_argument('--host', default='10.0.20.3', help="gas analyzer address")
+    parser.add_argument('--port', type=int, default=51020, help="gas analyzer port")
+    parser.add_argument('--period', type=float, default=5.0, help="sample period in seconds, e.g. 1 for 1 Hz")
+    parser.add_argument('--pipeline', type=int, default=1, help="number of requests kept in flight")
+    parser.add_argument('--metrics-port', type=int, default=9101, help="Prometheus /metrics port, 0 to disable")
+    parser.add_argument('--live-buffer', default='hydrokum_live',
+                        help="shared memory ring buffer of recent rows for the dashboard, '' to disable")
+    parser.add_argument('--live-rows', type=int, default=2 ** 17, help="rows kept in the live buffer")
+    parser.add_argument('--alerts', default='alerts.json', help="alert rules and rolling windows, '' to disable")
+    parser.add_argument('--stats-file', default=os.getenv("STATS_FILE"), help="where rolling statistics are published for the dashboard")
+    parser.add_argument('--archive-dir', default='archive',
+                        help="Parquet archive that rollups and status intervals of pruned days are rebuilt from")
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('run', help="poll the gas analyzer and store readings (default)")
+    commands.add_parser('migrate', help="upgrade the database schema in place")
+    backfill = commands.add_parser('backfill-rollups', help="rebuild the 1 minute / 1 hour rollup tables")
+    backfill.add_argument('--start', help="ISO timestamp, default: beginning of data")
+    backfill.add_argument('--end', help="ISO timestamp, default: end of data")
+    commands.add_parser('rebuild-intervals', help="rebuild the status bit intervals from the status history")
+    args = parser.parse_args()
+
+    db = Database(args.db, archive_dir=args.archive_dir)
+    if args.command == 'migrate':
+        version = db.migrate()
+        print(f"{args.db}: schema version {version} -> {SCHEMA_VERSION}")
+        return
+    if args.command == 'backfill-rollups':
+        db.create_table()
+        db.backfill_rollups(args.start, args.end)
+        print(f"{args.db}: rollups rebuilt")
+        return
+    if args.command == 'rebuild-intervals':
+        db.create_table()
+        db.rebuild_status_intervals()
+        print(f"{args.db}: status intervals rebuilt")
+        return
+
+    db.create_table()
+    if args.metrics_port:
+        metrics.start_http_server(args.metrics_port)
+    live = None
+    if args.live_buffer:
+        from ringbuffer import SharedRingBuffer
+        live = SharedRingBuffer.create(args.live_buffer, args.live_rows)
+    alerts = None
+    if args.alerts and os.path.exists(args.alerts):
+        from alerts import DEFAULT_STATS_FILE, AlertEngine, StatsFile, load_rules
+        windows, rules = load_rules(args.alerts)
+        alerts = AlertEngine(db, rules, windows, StatsFile(args.stats_file or DEFAULT_STATS_FILE))
+    elif args.alerts:
+        logger.warning(f"No alert rules at {args.alerts}, alerts disabled")
+    run_analyzer(db, args.host, args.port, args.period, args.pipeline, live, alerts)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,87 @@
+import logging
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+MODES = ('lttb', 'minmax')
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """Indices of the points kept by Largest-Triangle-Three-Buckets.
+
+    Bucket edges and the average point of every bucket are computed up front;
+    only the choice of the point in each bucket depends on the previous choice,
+    so the remaining loop runs once per output point and is vectorized inside.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    # n_out - 2 buckets between the fixed first and last points
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    counts = np.diff(edges)
+    avg_x = np.add.reduceat(x[:n - 1], edges[:-1]) / counts
+    avg_y = np.add.reduceat(y[:n - 1], edges[:-1]) / counts
+    next_x = np.append(avg_x[1:], x[-1])
+    next_y = np.append(avg_y[1:], y[-1])
+
+    out = np.empty(n_out, dtype=np.int64)
+    out[0], out[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        area = np.abs((x[a] - next_x[i]) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (next_y[i] - y[a]))
+        a = lo + int(np.argmax(area))
+        out[i + 1] = a
+    return out
+
+
+def minmax_indices(y: np.ndarray, n_out: int) -> np.ndarray:
+    """Indices of the minimum and maximum of each of n_out / 2 equal-count buckets."""
+    n = len(y)
+    if n_out >= n or n_out < 4:
+        return np.arange(n)
+    n_buckets = n_out // 2
+    bucket = np.arange(n) * n_buckets // n
+    # Sorting by (bucket, y) puts each bucket's min first and max last
+    order = np.lexsort((y, bucket))
+    starts = np.searchsorted(bucket[order], np.arange(n_buckets))
+    ends = np.append(starts[1:], n) - 1
+    return np.unique(np.concatenate(([0, n - 1], order[starts], order[ends])))
+
+
+def downsample(x: pd.Series, y: pd.Series, n_out: int, mode: str = 'lttb') -> Tuple[pd.Series, pd.Series]:
+    """Reduce one trace to about n_out points, keeping its visual shape.
+
+    NaN values are dropped first; x must be numeric or datetime and sorted ascending.
+    """
+    valid = y.notna().to_numpy()
+    x, y = x[valid], y[valid]
+    if len(y) <= n_out:
+        return x, y
+    if mode == 'lttb':
+        xv = x.to_numpy()
+        if np.issubdtype(xv.dtype, np.datetime64):
+            xv = xv.astype('datetime64[ns]').astype(np.int64)
+        idx = lttb_indices(xv.astype(np.float64), y.to_numpy(dtype=np.float64), n_out)
+    elif mode == 'minmax':
+        idx = minmax_indices(y.to_numpy(dtype=np.float64), n_out)
+    else:
+        raise ValueError(f"Unknown downsampling mode {mode!r}, expected one of {MODES}")
+    return x.iloc[idx], y.iloc[idx]
+
+
+def envelope(x: pd.Series, low: pd.Series, high: pd.Series) -> Tuple[pd.Series, pd.Series]:
+    """One trace drawing each bucket as a stroke from its minimum to its maximum.
+
+    For data that is already bucketed, e.g. rollup rows; buckets without values are dropped.
+    """
+    valid = (low.notna() & high.notna()).to_numpy()
+    xs = np.repeat(x.to_numpy()[valid], 2)
+    ys = np.column_stack((low.to_numpy(dtype=np.float64)[valid], high.to_numpy(dtype=np.float64)[valid])).ravel()
+    return pd.Series(xs), pd.Series(ys)
@@ -0,0 +1,211 @@
+import argparse
+import csv
+import io
+import logging
+import os
+import sys
+import zlib
+from datetime import datetime
+from typing import Any, Iterator, List, Optional, Tuple
+
+from database import Database, GAS_COLUMNS, to_epoch_ms
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {'csv': 'text/csv', 'csv.gz': 'application/gzip', 'parquet': 'application/vnd.apache.parquet'}
+EXPORT_COLUMNS = ['time', *GAS_COLUMNS]
+
+
+def parse_time(value: Optional[str]) -> Optional[int]:
+    """Accept epoch milliseconds or an ISO date/time string (local time)."""
+    if value is None or value == '':
+        return None
+    if value.isdigit():
+        return int(value)
+    ms = to_epoch_ms(value)
+    if ms is None:
+        raise ValueError(f"Invalid time {value!r}")
+    return ms
+
+
+def _format_rows(rows: List[Tuple]) -> List[Tuple]:
+    return [(datetime.fromtimestamp(row[0] / 1000).isoformat(sep=' ', timespec='milliseconds'), *row[1:])
+            for row in rows]
+
+
+def iter_csv(db: Database, start: Any = None, end: Any = None, compress: bool = False,
+             chunk_size: int = 50000) -> Iterator[bytes]:
+    """Yield the range as CSV (optionally gzip) bytes, one chunk of rows at a time."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # wbits=31 makes zlib emit a gzip container
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+    def drain() -> bytes:
+        data = buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+        return compressor.compress(data) if compressor else data
+
+    writer.writerow(EXPORT_COLUMNS)
+    yield drain()
+    for rows in db.iter_data(start, end, chunk_size):
+        writer.writerows(_format_rows(rows))
+        chunk = drain()
+        if chunk:
+            yield chunk
+    if compressor:
+        yield compressor.flush()
+
+
+def _pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)") from e
+    return pa, pq
+
+
+def _parquet_schema(pa):
+    return pa.schema([('time', pa.timestamp('ms', tz='UTC'))] + [(col, pa.float64()) for col in GAS_COLUMNS])
+
+
+def _parquet_table(pa, schema, rows: List[Tuple]):
+    columns = [pa.array(col, type=field.type) for col, field in zip(zip(*rows), schema)]
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def write_parquet(db: Database, target, start: Any = None, end: Any = None, chunk_size: int = 100000) -> int:
+    """Write the range to a Parquet file (path or binary file object), one row group per chunk."""
+    pa, pq = _pyarrow()
+    schema = _parquet_schema(pa)
+    n_rows = 0
+    with pq.ParquetWriter(target, schema, compression='zstd') as writer:
+        for rows in db.iter_data(start, end, chunk_size):
+            writer.write_table(_parquet_table(pa, schema, rows))
+            n_rows += len(rows)
+    return n_rows
+
+
+class _ChunkSink:
+    """Write-only file object that hands back what was written since the last drain()."""
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def iter_parquet(db: Database, start: Any = None, end: Any = None, chunk_size: int = 100000) -> Iterator[bytes]:
+    """Yield the range as Parquet bytes, one row group per chunk of rows.
+
+    Parquet writes its footer last and never seeks back, so the file can be
+    streamed as it is written. Raises RuntimeError up front when pyarrow is missing.
+    """
+    pa, pq = _pyarrow()
+    schema = _parquet_schema(pa)
+
+    def generate():
+        sink = _ChunkSink()
+        with pq.ParquetWriter(pa.PythonFile(sink, mode='w'), schema, compression='zstd') as writer:
+            for rows in db.iter_data(start, end, chunk_size):
+                writer.write_table(_parquet_table(pa, schema, rows))
+                chunk = sink.drain()
+                if chunk:
+                    yield chunk
+        yield sink.drain()
+
+    return generate()
+
+
+def export_filename(fmt: str, start: Optional[int], end: Optional[int]) -> str:
+    def label(ms):
+        return datetime.fromtimestamp(ms / 1000).strftime('%Y-%m-%d_%H-%M-%S') if ms is not None else 'all'
+    return f"data_{label(start)}_{label(end)}.{fmt}"
+
+
+def register_export_route(server, db: Database, route: str = '/export'):
+    """Add a streaming download route: /export?start=...&end=...&format=csv|csv.gz|parquet"""
+    from flask import Response, request
+
+    def export_data():
+        fmt = request.args.get('format', 'csv')
+        if fmt not in FORMATS:
+            return Response(f"Unknown format {fmt!r}", status=400)
+        try:
+            start, end = parse_time(request.args.get('start')), parse_time(request.args.get('end'))
+        except ValueError as e:
+            return Response(str(e), status=400)
+        filename = export_filename(fmt, start, end)
+
+        if fmt == 'parquet':
+            try:
+                body = iter_parquet(db, start, end)
+            except RuntimeError as e:
+                return Response(str(e), status=501)
+            return Response(body, mimetype=FORMATS[fmt],
+                            headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+        body = iter_csv(db, start, end, compress=(fmt == 'csv.gz'))
+        return Response(body, mimetype=FORMATS[fmt],
+                        headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+    server.add_url_rule(route, 'export_data', export_data)
+    return route
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export measurements for a time range")
+    parser.add_argument('--db', default='my_database.sqlite', help="SQLite database file")
+    parser.add_argument('--archive-dir', default='archive', help="Parquet archive to read older rows from")
+    parser.add_argument('--start', help="ISO time or epoch ms, default: beginning of data")
+    parser.add_argument('--end', help="ISO time or epoch ms (exclusive), default: end of data")
+    parser.add_argument('--format', choices=FORMATS, default='csv')
+    parser.add_argument('--output', '-o', help="output file, '-' for stdout (CSV only); default: derived from range")
+    args = parser.parse_args()
+
+    db = Database(args.db, archive_dir=args.archive_dir)
+    start, end = parse_time(args.start), parse_time(args.end)
+    output = args.output or export_filename(args.format, start, end)
+
+    if args.format == 'parquet':
+        if output == '-':
+            parser.error("Parquet cannot be written to stdout")
+        n_rows = write_parquet(db, output, start, end)
+        print(f"Wrote {n_rows} rows to {output}", file=sys.stderr)
+        return
+
+    out = sys.stdout.buffer if output == '-' else open(output, 'wb')
+    try:
+        for chunk in iter_csv(db, start, end, compress=(args.format == 'csv.gz')):
+            out.write(chunk)
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+    if output != '-':
+        print(f"Wrote {os.path.getsize(output)} bytes to {output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
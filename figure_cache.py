@@ -0,0 +1,82 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable
+
+import metrics
+
+FIGURE_CACHE_REQUESTS = metrics.counter('hydrokum_figure_cache_requests_total', "Figure cache lookups", ['result'])
+FIGURE_CACHE_EVICTIONS = metrics.counter('hydrokum_figure_cache_evictions_total', "Figures evicted from the cache")
+FIGURE_CACHE_ENTRIES = metrics.gauge('hydrokum_figure_cache_entries', "Figures held in the cache")
+FIGURE_BUILD_SECONDS = metrics.histogram('hydrokum_figure_build_seconds', "Time to build a cached figure")
+
+
+class FigureCache:
+    """Size-bounded LRU of built figures shared by every browser session.
+
+    Keys name what a figure shows, including the newest data row, so an entry
+    never goes stale: new data makes a new key and old entries age out. When
+    several sessions miss the same key at once only one of them builds it and
+    the others wait for the result.
+    """
+
+    def __init__(self, max_entries: int = 32):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: 'OrderedDict[Hashable, Any]' = OrderedDict()
+        self._building: Dict[Hashable, threading.Lock] = {}
+        self._lock = threading.Lock()
+        FIGURE_CACHE_ENTRIES.set_function(lambda: len(self._entries))
+
+    def _lookup(self, key: Hashable):
+        # Caller holds self._lock
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            FIGURE_CACHE_REQUESTS.inc(result='hit')
+            return True, self._entries[key]
+        return False, None
+
+    def get(self, key: Hashable, build: Callable[[], Any]) -> Any:
+        """The cached value for ``key``, calling ``build()`` once to create it if missing."""
+        with self._lock:
+            found, value = self._lookup(key)
+            if found:
+                return value
+            build_lock = self._building.setdefault(key, threading.Lock())
+        with build_lock:
+            with self._lock:
+                # Built by another session while this one waited
+                found, value = self._lookup(key)
+                if found:
+                    return value
+            try:
+                with FIGURE_BUILD_SECONDS.time():
+                    value = build()
+            except BaseException:
+                with self._lock:
+                    self._building.pop(key, None)
+                raise
+            with self._lock:
+                self.misses += 1
+                FIGURE_CACHE_REQUESTS.inc(result='miss')
+                self._entries[key] = value
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+                    FIGURE_CACHE_EVICTIONS.inc()
+                # Dropped together with storing the entry, so a session missing the key now finds the entry
+                # instead of a fresh build lock
+                self._building.pop(key, None)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'hit_ratio': self.hits / lookups if lookups else 0.0}
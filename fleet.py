@@ -0,0 +1,79 @@
+import json
+import logging
+from collections import namedtuple
+from typing import TYPE_CHECKING, Callable, Dict, Optional
+
+if TYPE_CHECKING:
+    from PLC_kumlib import ConfigPLC
+
+logger = logging.getLogger(__name__)
+
+Device = namedtuple('Device', ['plc_id', 'ip_address', 'device_type', 'label', 'commands', 'status_bits',
+                               'status_reg', 'command_reg', 'poll_interval'])
+
+DEFAULTS = {'label': '', 'status_reg': 'V1', 'command_reg': 'V0', 'poll_interval': 1.0}
+
+
+def _parse_int(value) -> int:
+    # Command words are written as "0b0000011" strings in the file, JSON has no binary literals
+    return value if isinstance(value, int) else int(value, 0)
+
+
+def load_fleet(path: str = 'fleet.json') -> Dict[str, Device]:
+    """Read the fleet definition, in file order, keyed by device id.
+
+    Each device inherits commands, status bits, registers and poll interval from
+    its entry in ``device_types`` and may override any of them.
+    """
+    with open(path) as f:
+        config = json.load(f)
+    types = config.get('device_types', {})
+    fleet = {}
+    for entry in config.get('devices', []):
+        try:
+            plc_id, ip_address, device_type = entry['id'], entry['ip'], entry['type']
+        except KeyError as e:
+            raise ValueError(f"{path}: device {entry} is missing {e}") from e
+        if device_type not in types:
+            raise ValueError(f"{path}: device {plc_id} has unknown type {device_type!r}")
+        if plc_id in fleet:
+            raise ValueError(f"{path}: duplicate device id {plc_id!r}")
+        settings = dict(DEFAULTS, **types[device_type], **entry)
+        fleet[plc_id] = Device(
+            plc_id=plc_id,
+            ip_address=ip_address,
+            device_type=device_type,
+            label=settings['label'] or device_type,
+            commands={name: _parse_int(word) for name, word in settings.get('commands', {}).items()},
+            status_bits={int(bit): text for bit, text in settings.get('status_bits', {}).items()},
+            status_reg=settings['status_reg'],
+            command_reg=settings['command_reg'],
+            poll_interval=float(settings['poll_interval']),
+        )
+    logger.info(f"Loaded {len(fleet)} devices from {path}")
+    return fleet
+
+
+def build_plcs(fleet: Dict[str, Device], db=None, update_status: bool = False,
+               plc_factory: Optional[Callable[[], object]] = None) -> Dict[str, 'ConfigPLC']:
+    """Create one ConfigPLC per device; ``plc_factory`` replaces the snap7 client, e.g. with MockPLC."""
+    # Imported here so the dashboard can read the fleet without snap7 installed
+    from PLC_kumlib import ConfigPLC
+
+    return {plc_id: ConfigPLC(device.ip_address, device.commands, device.status_bits, device.status_reg,
+                              update_status=update_status, database=db,
+                              plc=plc_factory() if plc_factory else None, command_reg=device.command_reg)
+            for plc_id, device in fleet.items()}
+
+
+def status_bit(device: Device, name: str) -> int:
+    """Bit number of the status bit called ``name``, e.g. "Motor run"."""
+    for bit, bit_name in device.status_bits.items():
+        if bit_name == name:
+            return bit
+    raise ValueError(f"{device.plc_id} has no status bit {name!r}")
+
+
+def poll_intervals(fleet: Dict[str, Device]) -> Dict[str, float]:
+    """Per-device periods for PLCPoller."""
+    return {plc_id: device.poll_interval for plc_id, device in fleet.items()}
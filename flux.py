@@ -0,0 +1,280 @@
+import argparse
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from contextlib import closing
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+import metrics
+from database import FLUX_COLUMNS, GAS_COLUMNS, STATUS_UNKNOWN_EVENTS, Database, now_ms, to_epoch_ms
+from fleet import Device, load_fleet
+
+logger = logging.getLogger(__name__)
+
+FLUX_CYCLES = metrics.counter('hydrokum_flux_cycles_total', "Chamber cycles fitted and stored", ['chamber'])
+FLUX_UPDATE_SECONDS = metrics.histogram('hydrokum_flux_update_seconds', "Time to segment, fit and store cycles")
+
+CLOSED_BIT_NAME = "Close endstop"
+UNKNOWN = -1  # status while a PLC was not connected
+DEFAULT_DEAD_TIME = 30 * 1000  # ms after closing while the sample line still carries the previous chamber's air
+
+INSERT_FLUX_SQL = (f"INSERT OR REPLACE INTO flux (time, chamber, end_time, samples, {', '.join(FLUX_COLUMNS)}) "
+                   f"VALUES ({', '.join('?' * (4 + len(FLUX_COLUMNS)))})")
+
+Channel = namedtuple('Channel', ['chamber', 'ip_address', 'channel_bit', 'closed_bit'])
+
+
+def fleet_channels(fleet: Dict[str, Device]) -> Tuple[Device, List[Channel]]:
+    """The multiplexer and, for each chamber it serves, its channel and closed endstop bits.
+
+    Chambers are the devices with a "Close endstop" status bit; the n-th of them in
+    the fleet file is sampled on the multiplexer's n-th channel bit (CH1, CH2, ...).
+    """
+    multiplexers = [device for device in fleet.values() if device.device_type == 'multiplexer']
+    if not multiplexers:
+        raise ValueError("The fleet has no multiplexer")
+    multiplexer = multiplexers[0]
+    channel_bits = sorted(bit for bit, name in multiplexer.status_bits.items() if name.upper().startswith('CH'))
+    channels = []
+    for device in fleet.values():
+        closed = [bit for bit, name in device.status_bits.items() if name == CLOSED_BIT_NAME]
+        if not closed:
+            continue
+        if len(channels) == len(channel_bits):
+            logger.warning(f"No multiplexer channel left for {device.plc_id}")
+            break
+        channels.append(Channel(device.plc_id, device.ip_address, channel_bits[len(channels)], closed[0]))
+    return multiplexer, channels
+
+
+def state_at(times: np.ndarray, states: np.ndarray, at: np.ndarray) -> np.ndarray:
+    """Value of the step function (times, states) at each of ``at``, UNKNOWN before its first step."""
+    if not len(times):
+        return np.full(len(at), UNKNOWN)
+    index = np.searchsorted(times, at, side='right') - 1
+    return np.where(index >= 0, states[np.maximum(index, 0)], UNKNOWN)
+
+
+def active_intervals(breakpoints: np.ndarray, active: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """(starts, ends) of the runs where ``active`` holds; a run still open at the end is left out."""
+    edges = np.diff(np.concatenate(([0], active.astype(np.int8), [0])))
+    first, stop = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    closed = stop < len(breakpoints)
+    return breakpoints[first[closed]], breakpoints[stop[closed]]
+
+
+def fit_cycles(times: np.ndarray, values: np.ndarray, starts: np.ndarray, ends: np.ndarray,
+               min_samples: int = 5) -> Tuple[np.ndarray, np.ndarray]:
+    """Least-squares line through each [start, end) window of every value column, all at once.
+
+    ``times`` must be sorted. Returns the row count per window and an array of
+    shape (windows, columns, 3) holding slope per hour, intercept at the window
+    start and r²; NaN where a column has fewer than ``min_samples`` readings.
+    """
+    first = np.searchsorted(times, starts, side='left')
+    counts = np.searchsorted(times, ends, side='left') - first
+    n_windows = len(starts)
+    window = np.repeat(np.arange(n_windows), counts)
+    rows = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - first, counts)
+    # Seconds since the window start keeps the sums small enough for float64
+    x = (times[rows] - starts[window]) / 1000.0
+    y = values[rows]
+    valid = ~np.isnan(y)
+
+    result = np.full((n_windows, values.shape[1], 3), np.nan)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for column in range(values.shape[1]):
+            v = valid[:, column]
+            xs, ys = np.where(v, x, 0.0), np.where(v, y[:, column], 0.0)
+            n, sx, sy, sxx, sxy, syy = (np.bincount(window, weights=w, minlength=n_windows)
+                                        for w in (v.astype(float), xs, ys, xs * xs, xs * ys, ys * ys))
+            var_x, cov, var_y = sxx - sx * sx / n, sxy - sx * sy / n, syy - sy * sy / n
+            slope = cov / var_x
+            fitted = n >= max(min_samples, 2)
+            result[fitted, column, 0] = slope[fitted] * 3600
+            result[fitted, column, 1] = ((sy - slope * sx) / n)[fitted]
+            result[fitted, column, 2] = (cov * cov / (var_x * var_y))[fitted]
+    return counts, result
+
+
+class FluxEngine:
+    """Turns multiplexer and chamber status history into per-cycle gas fluxes.
+
+    A cycle is a stretch during which the multiplexer samples exactly one
+    chamber's channel while that chamber's closed endstop is made. Cycles are
+    found from status_history (plus connection losses in plc_history) with
+    array operations, and fitted in batches of ``chunk`` ms of data, so months
+    of history take seconds. start() keeps the flux table current by fitting
+    each cycle shortly after it ends.
+    """
+
+    def __init__(self, db: Database, fleet: Dict[str, Device], dead_time: int = DEFAULT_DEAD_TIME,
+                 min_samples: int = 5, settle: int = 10 * 1000, max_cycle: int = 2 * 60 * 60 * 1000,
+                 chunk: int = 7 * 24 * 60 * 60 * 1000):
+        self.db = db
+        self.multiplexer, self.channels = fleet_channels(fleet)
+        self.dead_time = dead_time
+        self.min_samples = min_samples
+        # Analyzer rows for the end of a cycle may still be on their way into SQLite
+        self.settle = settle
+        self.max_cycle = max_cycle
+        self.chunk = chunk
+        self.processed_until: Optional[int] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _history(self, start: int, end: int) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        """ip address -> (times, states) of every status change in [start, end), seeded with the state before."""
+        ips = {self.multiplexer.ip_address} | {channel.ip_address for channel in self.channels}
+        events: Dict[str, List[Tuple[int, int]]] = {ip: [] for ip in ips}
+        conn = self.db.create_connection()
+        with closing(conn):
+            for ip in ips:
+                seed = conn.execute("SELECT time, status FROM status_history WHERE ip_address = ? AND time < ? "
+                                    "ORDER BY time DESC LIMIT 1", (ip, start)).fetchone()
+                if seed:
+                    events[ip].append(seed)
+        for chunk in self.db.iter_rows('status_history', start, end):
+            for row_time, ip, status in chunk:
+                if ip in events:
+                    events[ip].append((row_time, status))
+        for chunk in self.db.iter_rows('plc_history', start, end):
+            for row_time, ip, event in chunk:
+                if ip in events and event in STATUS_UNKNOWN_EVENTS:
+                    events[ip].append((row_time, UNKNOWN))
+        history = {}
+        for ip, rows in events.items():
+            rows.sort(key=lambda row: row[0])
+            array = np.array(rows, dtype=np.int64).reshape(-1, 2)
+            history[ip] = array[:, 0], array[:, 1]
+        return history
+
+    def cycles(self, after: int, until: int, lookback: int = 0) -> List[Tuple[str, np.ndarray, np.ndarray]]:
+        """(chamber, starts, ends) of the cycles ending in (after, until], looking back ``lookback`` ms for starts."""
+        window_start = after - lookback
+        history = self._history(window_start, until + 1)
+        mux_times, mux_states = history[self.multiplexer.ip_address]
+        channel_mask = sum(1 << channel.channel_bit for channel in self.channels)
+        result = []
+        for channel in self.channels:
+            times, states = history[channel.ip_address]
+            breakpoints = np.union1d(np.union1d(mux_times, times), [window_start])
+            breakpoints = breakpoints[(breakpoints >= window_start) & (breakpoints <= until)]
+            mux, chamber = state_at(mux_times, mux_states, breakpoints), state_at(times, states, breakpoints)
+            active = ((mux != UNKNOWN) & ((mux & channel_mask) == 1 << channel.channel_bit)
+                      & (chamber != UNKNOWN) & ((chamber >> channel.closed_bit) & 1 == 1))
+            starts, ends = active_intervals(breakpoints, active)
+            # A cycle already running at the window start was cut off by the window, not by the PLCs
+            keep = (starts > window_start) & (ends > after)
+            result.append((channel.chamber, starts[keep], ends[keep]))
+        return result
+
+    def fit(self, cycles: List[Tuple[str, np.ndarray, np.ndarray]]) -> List[Tuple]:
+        """flux table rows for the given cycles, reading the measurements ``chunk`` ms at a time."""
+        if not cycles:
+            return []
+        chambers = np.concatenate([np.full(len(starts), index) for index, (_, starts, _) in enumerate(cycles)])
+        starts = np.concatenate([starts for _, starts, _ in cycles]).astype(np.int64)
+        ends = np.concatenate([ends for _, _, ends in cycles]).astype(np.int64)
+        order = np.argsort(starts, kind='stable')
+        chambers, starts, ends = chambers[order], starts[order], ends[order]
+        fit_starts = starts + self.dead_time
+        usable = fit_starts < ends
+        chambers, starts, ends, fit_starts = chambers[usable], starts[usable], ends[usable], fit_starts[usable]
+
+        rows = []
+        batch = 0
+        while batch < len(starts):
+            # Cycles starting within one chunk share a single read of the data
+            stop = int(np.searchsorted(starts, starts[batch] + self.chunk, side='left'))
+            stop = max(stop, batch + 1)
+            data = [row for chunk in self.db.iter_data(int(fit_starts[batch]), int(ends[batch:stop].max()))
+                    for row in chunk]
+            table = np.array(data, dtype=np.float64).reshape(-1, 1 + len(GAS_COLUMNS))
+            counts, fits = fit_cycles(table[:, 0].astype(np.int64), table[:, 1:], fit_starts[batch:stop],
+                                      ends[batch:stop], self.min_samples)
+            names = [cycles[index][0] for index in chambers[batch:stop]]
+            for i, (chamber, start, end, count) in enumerate(zip(names, starts[batch:stop].tolist(),
+                                                                  ends[batch:stop].tolist(), counts.tolist())):
+                if count:
+                    rows.append((start, chamber, end, count, *fits[i].ravel().tolist()))
+            batch = stop
+        return rows
+
+    def store(self, rows: List[Tuple]) -> int:
+        if rows:
+            conn = self.db.create_connection()
+            with closing(conn), conn:
+                conn.executemany(INSERT_FLUX_SQL, rows)
+            for row in rows:
+                FLUX_CYCLES.inc(chamber=row[1])
+        return len(rows)
+
+    def process(self, start: Any = None, end: Any = None) -> int:
+        """Fit and store every cycle ending in (start, end]; returns how many were stored."""
+        after = to_epoch_ms(start) if start is not None else 0
+        until = to_epoch_ms(end) if end is not None else now_ms() - self.settle
+        with FLUX_UPDATE_SECONDS.time():
+            stored = self.store(self.fit(self.cycles(after, until, self.max_cycle if after else 0)))
+        logger.info(f"Stored {stored} flux cycles")
+        return stored
+
+    def update(self) -> int:
+        """Fit the cycles that ended since the last update."""
+        until = now_ms() - self.settle
+        if self.processed_until is None:
+            conn = self.db.create_connection()
+            with closing(conn):
+                latest = conn.execute("SELECT max(end_time) FROM flux").fetchone()[0]
+            # Live updates only catch up on recent cycles; run flux.py for older history
+            self.processed_until = max(latest or 0, until - self.max_cycle)
+        if until <= self.processed_until:
+            return 0
+        with FLUX_UPDATE_SECONDS.time():
+            stored = self.store(self.fit(self.cycles(self.processed_until, until, self.max_cycle)))
+        self.processed_until = until
+        return stored
+
+    def start(self, interval: float = 5.0):
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.update()
+                except Exception as e:
+                    logger.error(f"Flux update failed: {e}")
+
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=run, name="flux", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute per-cycle chamber fluxes from the recorded history")
+    parser.add_argument('--db', default=os.getenv("DB_PATH", "my_database.sqlite"), help="SQLite database file")
+    parser.add_argument('--fleet', default=os.getenv("FLEET_FILE", "fleet.json"), help="fleet definition file")
+    parser.add_argument('--start', help="ISO timestamp, default: beginning of the history")
+    parser.add_argument('--end', help="ISO timestamp, default: now")
+    parser.add_argument('--dead-time', type=float, default=DEFAULT_DEAD_TIME / 1000,
+                        help="seconds after closing left out of the fit")
+    parser.add_argument('--min-samples', type=int, default=5, help="readings needed to fit a cycle")
+    args = parser.parse_args()
+
+    db = Database(args.db)
+    db.create_table()
+    engine = FluxEngine(db, load_fleet(args.fleet), dead_time=int(args.dead_time * 1000),
+                        min_samples=args.min_samples)
+    started = time.perf_counter()
+    stored = engine.process(args.start, args.end)
+    print(f"{args.db}: {stored} cycles in {time.perf_counter() - started:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
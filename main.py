@@ -5,6 +5,9 @@ def main():
     # Start the database process
     database_process = subprocess.Popen(["python3", "database.py"])
 
+    # Start the PLC daemon, the only process that talks to the PLCs
+    plc_process = subprocess.Popen(["python3", "plc_daemon.py"])
+
     # Start the app process
     app_process = subprocess.Popen(["python3", "app.py"])
 
@@ -15,6 +18,7 @@ def main():
     except KeyboardInterrupt:
         print("Terminating processes...")
         database_process.terminate()
+        plc_process.terminate()
         app_process.terminate()
 
 
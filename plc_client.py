@@ -0,0 +1,135 @@
+import base64
+import json
+import logging
+import os
+import random
+import socket
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = os.getenv("PLC_SOCKET", "/tmp/hydrokum-plc.sock")
+# Never sent twice: once the request is out, the daemon may be running it even if no reply comes back
+NOT_RETRIED = {'command'}
+
+
+class PLCDaemonError(ConnectionError):
+    """The PLC daemon is not running or did not answer."""
+
+
+class PLCClient:
+    """Talks to plc_daemon.py over its Unix socket, one JSON object per line.
+
+    Safe to share between threads: each thread keeps its own connection, so
+    concurrent Dash callbacks never wait on each other.
+    """
+
+    def __init__(self, socket_path: str = DEFAULT_SOCKET, timeout: float = 5.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._stop = threading.Event()
+
+    def _connect(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def _close_local(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is not None:
+            sock.close()
+        self._local.sock = self._local.rfile = None
+
+    def call(self, method: str, **params) -> Any:
+        """Run one RPC; retried once on a fresh connection if the old one went away.
+
+        A request that failed after it was sent, e.g. on a reply timeout, is
+        only retried for methods that are safe to run twice (not NOT_RETRIED).
+        """
+        request_id = getattr(self._local, 'next_id', 0) + 1
+        self._local.next_id = request_id
+        line = json.dumps({'id': request_id, 'method': method, 'params': params}).encode() + b'\n'
+        for attempt in range(2):
+            sent = False
+            try:
+                if getattr(self._local, 'sock', None) is None:
+                    self._local.sock = self._connect()
+                    self._local.rfile = self._local.sock.makefile('rb')
+                self._local.sock.sendall(line)
+                sent = True
+                reply = self._local.rfile.readline()
+                if not reply:
+                    raise ConnectionError("PLC daemon closed the connection")
+                break
+            except OSError as e:
+                self._close_local()
+                if attempt or (sent and method in NOT_RETRIED):
+                    raise PLCDaemonError(f"PLC daemon at {self.socket_path} unavailable: {e}") from e
+        response = json.loads(reply)
+        if response.get('id') != request_id:
+            self._close_local()
+            raise PLCDaemonError(f"Out of order reply from PLC daemon: {response}")
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return response['result']
+
+    def fleet(self) -> List[Dict[str, Any]]:
+        return self.call('fleet')
+
+    def status(self, plc_ids: Optional[List[str]] = None) -> Dict[str, Dict[str, Any]]:
+        """plc id -> {'signature', 'state', 'indicators'} for the given or all PLCs."""
+        return self.call('status', plc_ids=plc_ids)
+
+    def command(self, plc_id: str, name: str) -> Dict[str, Any]:
+        """Queue a command; returns the handle as a dict without waiting for the PLC."""
+        return self.call('command', plc_id=plc_id, name=name)
+
+    def command_result(self, handle_id: int) -> Optional[Dict[str, Any]]:
+        return self.call('command_result', handle_id=handle_id)
+
+    def camera_frame(self) -> Tuple[Optional[bytes], Optional[str]]:
+        """The daemon's latest camera frame and its ETag, or (None, None)."""
+        result = self.call('camera_frame')
+        if result is None:
+            return None, None
+        return base64.b64decode(result['frame']), result['etag']
+
+    def subscribe(self, callback: Callable[[str, Dict[str, Any]], None], backoff_max: float = 10.0):
+        """Call callback(event, data) for every daemon event, from a background thread.
+
+        The daemon starts each subscription with the status of every PLC, so a
+        reconnect after a daemon restart brings the subscriber up to date.
+        """
+
+        def run():
+            attempt = 0
+            while not self._stop.is_set():
+                try:
+                    with self._connect() as sock:
+                        sock.settimeout(None)
+                        sock.sendall(json.dumps({'id': 0, 'method': 'subscribe'}).encode() + b'\n')
+                        attempt = 0
+                        for line in sock.makefile('rb'):
+                            message = json.loads(line)
+                            try:
+                                callback(message['event'], message['data'])
+                            except Exception as e:
+                                logger.error(f"PLC event subscriber failed: {e}")
+                except OSError as e:
+                    logger.debug(f"PLC daemon event stream unavailable: {e}")
+                delay = min(backoff_max, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.0)
+                attempt += 1
+                self._stop.wait(delay)
+
+        threading.Thread(target=run, name="plc-events", daemon=True).start()
+
+    def close(self):
+        self._stop.set()
+        self._close_local()
@@ -0,0 +1,288 @@
+import argparse
+import base64
+import json
+import logging
+import os
+import queue
+import signal
+import socket
+import socketserver
+import sys
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+from dotenv import load_dotenv
+
+import metrics
+from camera import CameraGrabber
+from database import GAS_COLUMNS, Database
+from fleet import Device, build_plcs, load_fleet, poll_intervals
+from flux import FluxEngine
+from plc_client import DEFAULT_SOCKET
+from PLC_kumlib import CommandDispatcher, ConnectionManager, MockPLC, PLCPoller, generate_status_indicators
+from push import DataWatcher
+from ringbuffer import LiveBuffer
+
+logger = logging.getLogger(__name__)
+
+RPC_SECONDS = metrics.histogram('hydrokum_plc_rpc_seconds', "PLC daemon RPC handling time", ['method'])
+
+
+class PLCDaemon:
+    """Owns the PLC connections, status polling and command queues for every dashboard worker.
+
+    Only one process may talk to the PLCs, so the dashboard runs stateless
+    under any number of WSGI workers and reaches the PLCs through this
+    daemon's Unix socket (see plc_client.PLCClient). Each line on the socket is
+    a JSON request {"id", "method", "params"} answered by {"id", "result"} or
+    {"id", "error"}; the 'subscribe' method turns the connection into a
+    stream of {"event", "data"} lines instead.
+
+    It also runs the background jobs there must only be one of, however many
+    workers serve the dashboard: the camera grabber, whose frames workers
+    fetch once per new ETag, and the watcher that publishes new data rows.
+    """
+
+    def __init__(self, fleet: Dict[str, Device], db: Optional[Database] = None,
+                 plc_factory: Optional[Callable[[], object]] = None, socket_path: str = DEFAULT_SOCKET,
+                 max_queue: int = 1000, camera: Optional[CameraGrabber] = None):
+        self.fleet = fleet
+        self.db = db
+        self.socket_path = socket_path
+        self.max_queue = max_queue
+        self.plcs = build_plcs(fleet, db, plc_factory=plc_factory)
+        self.connections = ConnectionManager(self.plcs)
+        self.poller = PLCPoller(self.plcs, interval=1.0, intervals=poll_intervals(fleet))
+        self.dispatcher = CommandDispatcher(self.plcs)
+        self.camera = camera
+        self.data_watcher = DataWatcher(db, self, GAS_COLUMNS) if db is not None else None
+        self.subscribers: List[queue.Queue] = []
+        self._lock = threading.Lock()
+        self.server: Optional[socketserver.ThreadingUnixStreamServer] = None
+        self.methods: Dict[str, Callable[..., Any]] = {
+            'fleet': self.describe_fleet,
+            'status': self.status,
+            'command': self.command,
+            'command_result': self.command_result,
+            'camera_frame': self.camera_frame,
+        }
+
+        self.poller.subscribe(lambda event: self.publish('status', self.status_payload(event.plc_id)))
+        self.connections.subscribe(lambda plc_id, state: self.publish('status', self.status_payload(plc_id)))
+        self.dispatcher.subscribe(lambda handle: self.publish('command', handle.as_dict()))
+        if camera is not None:
+            camera.subscribe(lambda etag: self.publish('camera', {'etag': etag}))
+
+    def start(self):
+        self._claim_socket()
+        self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, _Handler)
+        self.server.daemon_threads = True
+        self.server.plc_daemon = self
+        os.chmod(self.socket_path, 0o660)
+        self.connections.start()
+        self.poller.start()
+        self.dispatcher.start()
+        if self.camera is not None:
+            self.camera.start()
+        if self.data_watcher is not None:
+            self.data_watcher.start()
+        threading.Thread(target=self.server.serve_forever, name="plc-rpc", daemon=True).start()
+        logger.info(f"PLC daemon serving {len(self.plcs)} PLCs on {self.socket_path}")
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+        if self.camera is not None:
+            self.camera.stop()
+        if self.data_watcher is not None:
+            self.data_watcher.stop()
+        self.dispatcher.stop()
+        self.poller.stop()
+        self.connections.stop()
+        for plc in self.plcs.values():
+            if plc.connected:
+                plc.disconnect()
+
+    def _claim_socket(self):
+        """Remove a socket left by a crashed daemon, refuse to start next to a running one."""
+        if not os.path.exists(self.socket_path):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+        except OSError:
+            os.unlink(self.socket_path)
+        else:
+            raise RuntimeError(f"A PLC daemon is already listening on {self.socket_path}")
+        finally:
+            probe.close()
+
+    def status_payload(self, plc_id: str) -> Dict[str, Any]:
+        plc = self.plcs[plc_id]
+        state = self.connections.states[plc_id]
+        return {'plc_id': plc_id, 'state': state,
+                # What an indicator shows; dashboards only re-render a PLC when this changes
+                'signature': f"{state}:{int(plc.connected)}:{plc.status_data['status']}",
+                'indicators': generate_status_indicators(plc, state)}
+
+    def describe_fleet(self) -> List[Dict[str, Any]]:
+        return [{'plc_id': device.plc_id, 'ip_address': device.ip_address, 'device_type': device.device_type,
+                 'label': device.label, 'commands': list(device.commands)} for device in self.fleet.values()]
+
+    def status(self, plc_ids: Optional[List[str]] = None) -> Dict[str, Dict[str, Any]]:
+        return {plc_id: self.status_payload(plc_id) for plc_id in (plc_ids or self.plcs)}
+
+    def command(self, plc_id: str, name: str) -> Dict[str, Any]:
+        if plc_id not in self.plcs:
+            raise ValueError(f"Unknown PLC {plc_id!r}")
+        if name not in self.plcs[plc_id].commands:
+            raise ValueError(f"Unknown command {name!r} for {plc_id}")
+        return self.dispatcher.submit(plc_id, name).as_dict()
+
+    def command_result(self, handle_id: int) -> Optional[Dict[str, Any]]:
+        handle = self.dispatcher.get(handle_id)
+        return handle.as_dict() if handle is not None else None
+
+    def camera_frame(self) -> Optional[Dict[str, str]]:
+        """The latest camera frame, base64 encoded, and its ETag; None without a camera or before the first grab."""
+        frame, etag = self.camera.latest() if self.camera is not None else (None, None)
+        if frame is None:
+            return None
+        return {'etag': etag, 'frame': base64.b64encode(frame).decode('ascii')}
+
+    def call(self, method: str, params: Dict[str, Any]) -> Any:
+        if method not in self.methods:
+            raise ValueError(f"Unknown method {method!r}")
+        with RPC_SECONDS.time(method=method):
+            return self.methods[method](**params)
+
+    def publish(self, event: str, data: Any):
+        line = json.dumps({'event': event, 'data': data}).encode() + b'\n'
+        with self._lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(line)
+            except queue.Full:
+                # A stuck dashboard worker must not hold up the others; it reconnects
+                logger.warning("PLC event subscriber fell behind, dropping it")
+                self.unsubscribe(subscriber)
+                # Make room for the sentinel so the stream ends promptly
+                try:
+                    subscriber.get_nowait()
+                    subscriber.put_nowait(None)
+                except (queue.Empty, queue.Full):
+                    pass
+
+    @property
+    def has_clients(self) -> bool:
+        # Lets the DataWatcher publish through the daemon as it would through an EventBroker
+        return bool(self.subscribers)
+
+    def subscribe(self) -> queue.Queue:
+        subscriber: queue.Queue = queue.Queue(maxsize=self.max_queue)
+        with self._lock:
+            self.subscribers.append(subscriber)
+        for plc_id in self.plcs:
+            subscriber.put_nowait(json.dumps({'event': 'status', 'data': self.status_payload(plc_id)}).encode()
+                                  + b'\n')
+        return subscriber
+
+    def unsubscribe(self, subscriber: queue.Queue):
+        with self._lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        daemon: PLCDaemon = self.server.plc_daemon
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                request_id, method = request.get('id'), request['method']
+            except (ValueError, KeyError, AttributeError):
+                self._send({'id': None, 'error': "Malformed request"})
+                continue
+            if method == 'subscribe':
+                self._stream(daemon)
+                return
+            try:
+                self._send({'id': request_id, 'result': daemon.call(method, request.get('params') or {})})
+            except (ValueError, KeyError, TypeError) as e:
+                self._send({'id': request_id, 'error': str(e)})
+
+    def _send(self, response: Dict[str, Any]):
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+
+    def _stream(self, daemon: PLCDaemon):
+        subscriber = daemon.subscribe()
+        try:
+            while True:
+                line = subscriber.get()
+                if line is None:
+                    return
+                self.wfile.write(line)
+        except OSError:
+            pass
+        finally:
+            daemon.unsubscribe(subscriber)
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Own the PLC connections and serve them to dashboard workers")
+    parser.add_argument('--fleet', default=os.getenv("FLEET_FILE", "fleet.json"), help="fleet definition file")
+    parser.add_argument('--db', default=os.getenv("DB_PATH", "my_database.sqlite"),
+                        help="SQLite database for status and command history")
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help="Unix socket to listen on")
+    parser.add_argument('--mock', action='store_true', default=os.getenv("MOCK_PLCS", "") not in ("", "0"),
+                        help="simulate the PLCs, for development and benchmarks")
+    parser.add_argument('--metrics-port', type=int, default=9102, help="Prometheus /metrics port, 0 to disable")
+    parser.add_argument('--flux-interval', type=float, default=5.0,
+                        help="seconds between fitting newly finished chamber cycles, 0 to disable")
+    parser.add_argument('--camera-interval', type=float, default=float(os.getenv("CAMERA_INTERVAL", "10")),
+                        help="seconds between camera snapshots; the camera is BASE_URL, if set")
+    parser.add_argument('--live-buffer', default=os.getenv("LIVE_BUFFER", "hydrokum_live"),
+                        help="shared memory written by the ingest, read for new data rows; '' to disable")
+    args = parser.parse_args()
+
+    db = Database(args.db, live=LiveBuffer(args.live_buffer) if args.live_buffer else None)
+    db.create_table()
+    plc_factory = (lambda: MockPLC(latency=0.01)) if args.mock else None
+    fleet = load_fleet(args.fleet)
+    camera = None
+    if os.getenv("BASE_URL"):
+        camera = CameraGrabber(f"{os.getenv('BASE_URL')}&user={os.getenv('USER_NAME')}"
+                               f"&password={os.getenv('PASSWORD')}&width=640&height=480",
+                               interval=args.camera_interval)
+    daemon = PLCDaemon(fleet, db, plc_factory, args.socket, camera=camera)
+    if args.metrics_port:
+        metrics.start_http_server(args.metrics_port)
+
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+    signal.signal(signal.SIGINT, lambda *_: stopped.set())
+    daemon.start()
+    flux = None
+    if args.flux_interval:
+        # The daemon records the multiplexer and chamber status the cycles are cut from
+        try:
+            flux = FluxEngine(db, fleet)
+            flux.start(args.flux_interval)
+        except ValueError as e:
+            logger.warning(f"Flux computation disabled: {e}")
+    stopped.wait()
+    logger.info("Stopping PLC daemon")
+    if flux is not None:
+        flux.stop()
+    daemon.stop()
+    db.close()
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+import json
+import logging
+import queue
+import threading
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple
+
+import metrics
+from database import now_ms
+
+logger = logging.getLogger(__name__)
+
+PUSH_CLIENTS = metrics.gauge('hydrokum_push_clients', "Connected Server-Sent Events clients")
+PUSH_EVENTS = metrics.counter('hydrokum_push_events_total', "Events published to push clients", ['event'])
+PUSH_DROPPED = metrics.counter('hydrokum_push_dropped_clients_total', "Push clients dropped for falling behind")
+
+_CLOSED = object()
+
+
+class EventBroker:
+    """Fans events out to every connected browser, one bounded queue per client.
+
+    publish() never blocks: a client whose queue is full is dropped, and its
+    EventSource reconnects and starts again from a fresh snapshot.
+    """
+
+    def __init__(self, max_queue: int = 1000):
+        self.max_queue = max_queue
+        self._clients: List[queue.Queue] = []
+        self._lock = threading.Lock()
+        PUSH_CLIENTS.set_function(lambda: len(self._clients))
+
+    @property
+    def has_clients(self) -> bool:
+        return bool(self._clients)
+
+    def subscribe(self) -> queue.Queue:
+        client: queue.Queue = queue.Queue(maxsize=self.max_queue)
+        with self._lock:
+            self._clients.append(client)
+        return client
+
+    def unsubscribe(self, client: queue.Queue):
+        with self._lock:
+            if client in self._clients:
+                self._clients.remove(client)
+
+    def publish(self, event: str, data: Any):
+        message = format_event(event, data)
+        PUSH_EVENTS.inc(event=event)
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            try:
+                client.put_nowait(message)
+            except queue.Full:
+                logger.warning("Push client fell behind, dropping it")
+                PUSH_DROPPED.inc()
+                self.unsubscribe(client)
+                # Make room for the sentinel so the client's stream ends promptly
+                try:
+                    client.get_nowait()
+                    client.put_nowait(_CLOSED)
+                except (queue.Empty, queue.Full):
+                    pass
+
+    def stream(self, snapshot: Optional[Callable[[], Iterable[Tuple[str, Any]]]] = None,
+               keepalive: float = 15.0) -> Iterator[str]:
+        """Yield Server-Sent Events for one client until it disconnects or is dropped."""
+        client = self.subscribe()
+        try:
+            # Tell EventSource how long to wait before reconnecting
+            yield "retry: 2000\n\n"
+            for event, data in (snapshot() if snapshot else ()):
+                yield format_event(event, data)
+            while True:
+                try:
+                    message = client.get(timeout=keepalive)
+                except queue.Empty:
+                    # Comment line, keeps proxies from closing an idle connection
+                    yield ": keepalive\n\n"
+                    continue
+                if message is _CLOSED:
+                    return
+                yield message
+        finally:
+            self.unsubscribe(client)
+
+
+def format_event(event: str, data: Any) -> str:
+    # Strict JSON: a NaN would make the browser's JSON.parse drop the whole event
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'), allow_nan=False)}\n\n"
+
+
+class DataWatcher:
+    """Publishes new measurement rows to the broker as they land in the database.
+
+    The analyzer ingest runs in its own process, so new rows are picked up with
+    one indexed range query per ``interval``, and only while someone is
+    listening. After an idle spell it starts ``lookback`` ms back; browsers
+    skip rows their graph already has. ``broker`` may be anything with
+    publish() and has_clients, such as the PLC daemon, which runs the one
+    watcher shared by all dashboard workers.
+    """
+
+    def __init__(self, db, broker: EventBroker, columns: List[str], interval: float = 1.0,
+                 lookback: int = 60 * 1000):
+        self.db = db
+        self.broker = broker
+        self.columns = columns
+        self.interval = interval
+        self.lookback = lookback
+        self.last_time: Optional[int] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="push-data-watcher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def check(self) -> int:
+        """Publish rows newer than the last ones seen and return how many there were."""
+        if self.last_time is None:
+            self.last_time = now_ms() - self.lookback
+        rows = self.db.query_data(self.last_time)
+        if rows:
+            self.last_time = rows[-1][0]
+            self.broker.publish('data', {'columns': self.columns, 'rows': [list(row) for row in rows]})
+        return len(rows)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if not self.broker.has_clients:
+                # Nobody is listening; start from recent rows when someone connects
+                self.last_time = None
+                continue
+            try:
+                self.check()
+            except Exception as e:
+                logger.error(f"Push data watcher failed: {e}")
+
+
+def register_push_route(server, broker: EventBroker, route: str = '/events',
+                        snapshot: Optional[Callable[[], Iterable[Tuple[str, Any]]]] = None):
+    """Serve the broker as a Server-Sent Events stream; ``snapshot`` is sent first to every new client."""
+    from flask import Response, stream_with_context
+
+    def events():
+        response = Response(stream_with_context(broker.stream(snapshot)), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'  # nginx would otherwise buffer the stream
+        return response
+
+    server.add_url_rule(route, 'push_events', events)
+    return route
@@ -0,0 +1,229 @@
+import bisect
+import logging
+import os
+import sys
+import time
+from multiprocessing import resource_tracker, shared_memory
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_NAME = 'hydrokum_live'
+DEFAULT_CAPACITY = 2 ** 17  # rows; a day and a half at 1 Hz, a week at the default 5 s period
+N_VALUES = 4  # N2O, CO2, CH4, NH3
+
+MAGIC = 0x484B524E47  # "HKRNG"
+VERSION = 1
+# Header slots (int64)
+_MAGIC, _VERSION, _CAPACITY, _HEAD, _WRITER_PID, _OPEN = range(6)
+HEADER_SIZE = 8
+
+
+def _layout(capacity: int) -> Tuple[int, int, int]:
+    """Byte offsets of the times and values arrays, and the total segment size."""
+    times_offset = HEADER_SIZE * 8
+    values_offset = times_offset + capacity * 8
+    return times_offset, values_offset, values_offset + capacity * N_VALUES * 8
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    shm = shared_memory.SharedMemory(name=name)
+    # Before 3.13 attaching registers the segment with this process's resource
+    # tracker, which would unlink it when the process exits and pull it out
+    # from under the other side.
+    if sys.version_info < (3, 13):
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+class SharedRingBuffer:
+    """Fixed-size ring of the latest measurements in shared memory.
+
+    The analyzer ingest is the single writer; any number of dashboard
+    processes read without locks. A row is written into its slot before the
+    head counter is advanced, and readers check the head again after copying,
+    discarding any rows the writer lapped in the meantime. Times must be
+    appended in increasing order, which lets readers binary search them.
+    """
+
+    def __init__(self, shm: shared_memory.SharedMemory, writer: bool):
+        self.shm = shm
+        self.writer = writer
+        self.header = np.ndarray((HEADER_SIZE,), dtype=np.int64, buffer=shm.buf)
+        self.capacity = int(self.header[_CAPACITY])
+        times_offset, values_offset, _ = _layout(self.capacity)
+        self.times = np.ndarray((self.capacity,), dtype=np.int64, buffer=shm.buf, offset=times_offset)
+        self.values = np.ndarray((self.capacity, N_VALUES), dtype=np.float64, buffer=shm.buf, offset=values_offset)
+
+    @classmethod
+    def create(cls, name: str = DEFAULT_NAME, capacity: int = DEFAULT_CAPACITY) -> 'SharedRingBuffer':
+        """Open the buffer for writing, reusing a segment left by an earlier run if it matches."""
+        size = _layout(capacity)[2]
+        try:
+            shm = _attach(name)
+        except FileNotFoundError:
+            shm = None
+        if shm is not None:
+            header = np.ndarray((HEADER_SIZE,), dtype=np.int64, buffer=shm.buf)
+            if shm.size >= size and header[_MAGIC] == MAGIC and header[_VERSION] == VERSION \
+                    and header[_CAPACITY] == capacity:
+                del header
+                logger.info(f"Reusing shared ring buffer {name} with {capacity} rows")
+            else:
+                if header[_MAGIC] == MAGIC:
+                    header[_OPEN] = 0  # readers let go of the old segment and attach to the new one
+                del header
+                logger.warning(f"Replacing incompatible shared memory segment {name}")
+                shm.close()
+                if sys.version_info < (3, 13):
+                    resource_tracker.register(shm._name, 'shared_memory')
+                shm.unlink()
+                shm = None
+        if shm is None:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            # The writer does not unlink on exit either, so the segment survives ingest restarts
+            if sys.version_info < (3, 13):
+                resource_tracker.unregister(shm._name, 'shared_memory')
+            header = np.ndarray((HEADER_SIZE,), dtype=np.int64, buffer=shm.buf)
+            header[:] = 0
+            header[_MAGIC], header[_VERSION], header[_CAPACITY] = MAGIC, VERSION, capacity
+            del header
+        buffer = cls(shm, writer=True)
+        buffer.header[_WRITER_PID] = os.getpid()
+        buffer.header[_OPEN] = 1
+        return buffer
+
+    @classmethod
+    def attach(cls, name: str = DEFAULT_NAME) -> 'SharedRingBuffer':
+        """Open an existing buffer read-only; raises FileNotFoundError if no writer created it."""
+        shm = _attach(name)
+        header = np.ndarray((HEADER_SIZE,), dtype=np.int64, buffer=shm.buf)
+        valid = header[_MAGIC] == MAGIC and header[_VERSION] == VERSION
+        del header
+        if not valid:
+            shm.close()
+            raise ValueError(f"Shared memory segment {name} is not a ring buffer")
+        return cls(shm, writer=False)
+
+    def close(self):
+        if self.writer:
+            self.header[_OPEN] = 0
+        # Views into the segment must go before it can be closed
+        del self.header, self.times, self.values
+        self.shm.close()
+
+    def unlink(self):
+        """Remove the segment; processes that still have it open keep their mapping."""
+        if sys.version_info < (3, 13):
+            # unlink() unregisters from the resource tracker, balance the unregister done when opening
+            resource_tracker.register(self.shm._name, 'shared_memory')
+        self.shm.unlink()
+
+    @property
+    def head(self) -> int:
+        """Total number of rows ever appended."""
+        return int(self.header[_HEAD])
+
+    @property
+    def live(self) -> bool:
+        """True while the writer process is running."""
+        if not self.header[_OPEN]:
+            return False
+        try:
+            os.kill(int(self.header[_WRITER_PID]), 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def append(self, sample_time: int, values: Sequence[float]):
+        head = int(self.header[_HEAD])
+        slot = head % self.capacity
+        self.times[slot] = sample_time
+        self.values[slot] = [np.nan if value is None else value for value in values]
+        # Publish only after the slot is complete
+        self.header[_HEAD] = head + 1
+
+    def _time_at(self, seq: int) -> int:
+        return int(self.times[seq % self.capacity])
+
+    def _copy(self, first: int, last: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Copy rows with sequence numbers [first, last), dropping any the writer overwrote meanwhile."""
+        if first >= last:
+            return np.empty(0, dtype=np.int64), np.empty((0, N_VALUES))
+        start, stop = first % self.capacity, (last - 1) % self.capacity + 1
+        if start < stop:
+            times, values = self.times[start:stop].copy(), self.values[start:stop].copy()
+        else:
+            times = np.concatenate((self.times[start:], self.times[:stop]))
+            values = np.concatenate((self.values[start:], self.values[:stop]))
+        lapped = self.head - self.capacity - first
+        if lapped > 0:
+            times, values = times[lapped:], values[lapped:]
+        return times, values
+
+    def _bounds(self) -> Tuple[int, int]:
+        head = self.head
+        return max(0, head - self.capacity), head
+
+    def oldest_time(self) -> Optional[int]:
+        first, last = self._bounds()
+        return self._time_at(first) if first < last else None
+
+    def read(self, start: Optional[int] = None, end: Optional[int] = None,
+             after: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Rows with start <= time < end (or time > after), as (times, values) arrays.
+
+        Cost is a binary search plus a copy of the rows returned, so asking for
+        what is new since the last call is O(new rows).
+        """
+        first, last = self._bounds()
+        key = self._time_at
+        seqs = range(first, last)
+        if after is not None:
+            first = bisect.bisect_right(seqs, after, key=key) + seqs.start
+        elif start is not None:
+            first = bisect.bisect_left(seqs, start, key=key) + seqs.start
+        if end is not None:
+            last = bisect.bisect_left(seqs, end, key=key) + seqs.start
+        return self._copy(first, last)
+
+    def latest(self, n: int) -> Tuple[np.ndarray, np.ndarray]:
+        first, last = self._bounds()
+        return self._copy(max(first, last - n), last)
+
+
+def to_rows(times: np.ndarray, values: np.ndarray) -> List[Tuple]:
+    """(time, N2O, CO2, CH4, NH3) tuples like Database.query_data returns, None for missing values."""
+    # NaN would come out of json.dumps as a bare NaN token, which the browser's JSON.parse rejects
+    columns = values.T.astype(object)
+    columns[np.isnan(values.T)] = None
+    return list(zip(times.tolist(), *columns.tolist()))
+
+
+class LiveBuffer:
+    """Reader side used by Database: attaches lazily, so the ingest may start later or restart."""
+
+    def __init__(self, name: str = DEFAULT_NAME, retry_interval: float = 5.0):
+        self.name = name
+        self.retry_interval = retry_interval
+        self.buffer: Optional[SharedRingBuffer] = None
+        self._next_attempt = 0.0
+
+    def get(self) -> Optional[SharedRingBuffer]:
+        """The attached buffer while its writer is running, else None."""
+        if self.buffer is None and time.monotonic() >= self._next_attempt:
+            self._next_attempt = time.monotonic() + self.retry_interval
+            try:
+                self.buffer = SharedRingBuffer.attach(self.name)
+                logger.info(f"Attached to shared ring buffer {self.name}")
+            except (FileNotFoundError, ValueError):
+                pass
+        if self.buffer is not None and not self.buffer.live:
+            # Writer stopped; let go so a restarted or resized writer is picked up
+            self.buffer.close()
+            self.buffer = None
+        return self.buffer